@@ -28,32 +28,46 @@ import xml.etree.ElementTree as ET
 import argparse
 import base64
 import copy
+import filecmp
 import sys
 import re
 import html
 import os
 import glob
+import gzip
 import mimetypes
+import multiprocessing
+import pickle
 import shutil
 import struct
 import subprocess
+import threading
 import urllib.parse
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from enum import Flag
+from hashlib import sha1
 from types import SimpleNamespace as Empty
-from typing import Tuple, Dict, Any, List
+from typing import Tuple, Dict, Set, Any, List
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import TextLexer, BashSessionLexer, get_lexer_by_name, find_lexer_class_for_filename
+from pygments.lexers import TextLexer, BashSessionLexer
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plugins'))
 import dot2svg
 import latex2svg
 import latex2svgextra
 import ansilexer
+import pygmentsextra
+import rendercache
+import xmlbackend
+
+# Brotli is needed only if M_PRECOMPRESS_BROTLI is enabled
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 class ResultFlag(Flag):
     HAS_SUFFIX = 1 << 0
@@ -80,11 +94,31 @@ class ResultFlag(Flag):
     ENUM_VALUE = 13 << 4
     VAR = 14 << 4
 
+# Length of the common prefix of two strings. Comparing whole slices is
+# done in native code, so a binary search over them is faster than going
+# character by character in Python.
+def _common_prefix_length(a: str, b: str) -> int:
+    begin = 0
+    end = min(len(a), len(b))
+    while begin < end:
+        middle = (begin + end + 1)//2
+        if a[begin:middle] == b[begin:middle]: begin = middle
+        else: end = middle - 1
+    return begin
+
 class ResultMap:
     # item 1 flags | item 2 flags |     | item N flags | file | item 1 |
     #   + offset   |   + offset   | ... |   + offset   | size |  data  | ...
     #    8 + 24b   |    8 + 24b   |     |    8 + 24b   |  32b |        |
     #
+    # With 32-bit offsets (search data version 1), the flags are after the
+    # offset and the file size is padded with an extra zero byte so each
+    # entry has the same size:
+    #
+    # item 1 | item 1 |     | item N | item N | file | pad |
+    # offset | flags  | ... | offset | flags  | size |     | ...
+    #  32b   |   8b   |     |  32b   |   8b   |  32b | 8b  |
+    #
     # basic item (flags & 0b11 == 0b00):
     #
     # name | \0 | URL
@@ -115,6 +149,9 @@ class ResultMap:
     #  id   | ... | name
     #  16b  |     |
     #
+    # With 32-bit result IDs (search data version 1), the prefix and alias IDs
+    # are 32-bit as well.
+    #
     offset_struct = struct.Struct('<I')
     flags_struct = struct.Struct('<B')
     prefix_struct = struct.Struct('<HB')
@@ -141,95 +178,120 @@ class ResultMap:
         self.entries += [entry]
         return len(self.entries) - 1
 
-    def serialize(self, merge_prefixes=True) -> bytearray:
+    # Replaces the entries with ones that reference the longest name prefix in
+    # some other entry, storing only the remaining part of the name and URL
+    def merge_prefixes(self):
+        # Group entries with the same name, in order, and remember the
+        # longest suffix in each group
+        by_name = {}
+        max_suffix_length = {}
+        for index, e in enumerate(self.entries):
+            by_name.setdefault(e.name, []).append(index)
+            max_suffix_length[e.name] = max(max_suffix_length.get(e.name, 0), e.suffix_length)
+
+        # For every name find the longest other name that's its prefix.
+        # In a sorted list all names starting with given prefix are right
+        # after it, so it's enough to keep a stack of names that are
+        # prefixes of the current one. Empty names are never a prefix.
+        longest_prefix_name = {}
+        stack = []
+        for name in sorted(by_name):
+            while stack and not name.startswith(stack[-1]): stack.pop()
+            longest_prefix_name[name] = stack[-1] if stack else None
+            if name: stack += [name]
+
+        # Create a new list with merged prefixes
+        merged = []
+        for index, e in enumerate(self.entries):
+            # Allow self-reference only when referenced result suffix is
+            # longer (otherwise cycles happen). This is for functions that
+            # should appear when searching for foo (so they get ordered
+            # properly based on the name length) and also when searching
+            # for foo() (so everything that's not a function gets
+            # filtered out). Such entries are completely the same except
+            # for a different suffix length. Otherwise take the longest
+            # shared name prefix that is already fully contained in some
+            # other entry.
+            longest_prefix = by_name[e.name]
+            if not e.name or max_suffix_length[e.name] <= e.suffix_length:
+                name = longest_prefix_name[e.name]
+                longest_prefix = by_name[name] if name is not None else None
+
+            # Name prefix found, for all possible URLs find the one that
+            # shares the longest prefix
+            if longest_prefix:
+                max_prefix = (0, -1)
+                for longest_index in longest_prefix:
+                    # Ignore self (function self-reference, see above)
+                    if longest_index == index: continue
+
+                    prefix_length = _common_prefix_length(e.url, self.entries[longest_index].url)
+                    if max_prefix[1] < prefix_length:
+                        max_prefix = (longest_index, prefix_length)
+
+                        # Can't get any better than the whole URL
+                        if prefix_length == len(e.url): break
+
+                # Expect we found something
+                assert max_prefix[1] != -1
+
+                # Save the entry with reference to the prefix
+                entry = Empty()
+                assert e.name.startswith(self.entries[longest_prefix[0]].name)
+                entry.name = e.name[len(self.entries[longest_prefix[0]].name):]
+                entry.url = e.url[max_prefix[1]:]
+                entry.flags = e.flags|ResultFlag.HAS_PREFIX
+                entry.alias = e.alias
+                entry.prefix = max_prefix[0]
+                entry.prefix_length = max_prefix[1]
+                entry.suffix_length = e.suffix_length
+                merged += [entry]
+
+            # No prefix found, copy the entry verbatim
+            else: merged += [e]
+
+        # Everything merged, replace the original list
+        self.entries = merged
+
+    # Raises OverflowError if the offsets don't fit into given number of
+    # bytes, in which case merge_prefixes has to be False for the second try
+    # as the prefixes are already merged
+    def serialize(self, merge_prefixes=True, result_id_bytes=2, offset_bytes=3) -> bytearray:
         output = bytearray()
 
-        if merge_prefixes:
-            # Put all entry names into a trie to discover common prefixes
-            trie = Trie()
-            for index, e in enumerate(self.entries):
-                trie.insert(e.name, index)
-
-            # Create a new list with merged prefixes
-            merged = []
-            for index, e in enumerate(self.entries):
-                # Search in the trie and get the longest shared name prefix
-                # that is already fully contained in some other entry
-                current = trie
-                longest_prefix = None
-                for c in e.name.encode('utf-8'):
-                    for candidate, child in current.children.items():
-                        if c == candidate:
-                            current = child[1]
-                            break
-                    else: assert False # pragma: no cover
-
-                    # Allow self-reference only when referenced result suffix
-                    # is longer (otherwise cycles happen). This is for
-                    # functions that should appear when searching for foo (so
-                    # they get ordered properly based on the name length) and
-                    # also when searching for foo() (so everything that's not
-                    # a function gets filtered out). Such entries are
-                    # completely the same except for a different suffix length.
-                    if index in current.results:
-                        for i in current.results:
-                            if self.entries[i].suffix_length > self.entries[index].suffix_length:
-                                longest_prefix = current
-                                break
-                    elif current.results:
-                        longest_prefix = current
-
-                # Name prefix found, for all possible URLs find the one that
-                # shares the longest prefix
-                if longest_prefix:
-                    max_prefix = (0, -1)
-                    for longest_index in longest_prefix.results:
-                        # Ignore self (function self-reference, see above)
-                        if longest_index == index: continue
-
-                        prefix_length = 0
-                        for i in range(min(len(e.url), len(self.entries[longest_index].url))):
-                            if e.url[i] != self.entries[longest_index].url[i]: break
-                            prefix_length += 1
-                        if max_prefix[1] < prefix_length:
-                            max_prefix = (longest_index, prefix_length)
-
-                    # Expect we found something
-                    assert max_prefix[1] != -1
-
-                    # Save the entry with reference to the prefix
-                    entry = Empty()
-                    assert e.name.startswith(self.entries[longest_prefix.results[0]].name)
-                    entry.name = e.name[len(self.entries[longest_prefix.results[0]].name):]
-                    entry.url = e.url[max_prefix[1]:]
-                    entry.flags = e.flags|ResultFlag.HAS_PREFIX
-                    entry.alias = e.alias
-                    entry.prefix = max_prefix[0]
-                    entry.prefix_length = max_prefix[1]
-                    entry.suffix_length = e.suffix_length
-                    merged += [entry]
-
-                # No prefix found, copy the entry verbatim
-                else: merged += [e]
-
-            # Everything merged, replace the original list
-            self.entries = merged
-
-        # Write the offset array. Starting offset for items is after the offset
-        # array and the file size
-        offset = (len(self.entries) + 1)*4
+        if merge_prefixes: self.merge_prefixes()
+
+        # With 24-bit offsets the flags are the topmost byte of the offset,
+        # otherwise they're after it
+        if offset_bytes == 3:
+            offset_struct = self.offset_struct
+            offset_limit = 2**24
+        else:
+            assert offset_bytes == 4
+            offset_struct = struct.Struct('<IB')
+            offset_limit = 2**32
+        if result_id_bytes == 2:
+            prefix_struct = self.prefix_struct
+            alias_struct = self.alias_struct
+        else:
+            assert result_id_bytes == 4
+            prefix_struct = struct.Struct('<IB')
+            alias_struct = struct.Struct('<I')
+
+        # Calculate the offset array. Starting offset for items is after the
+        # offset array and the file size
+        offsets = []
+        offset = (len(self.entries) + 1)*(offset_bytes + 1)
         for e in self.entries:
-            assert offset < 2**24
-            output += self.offset_struct.pack(offset)
-            self.flags_struct.pack_into(output, len(output) - 1, e.flags.value)
+            offsets += [offset]
 
             # The entry is an alias, extra field for alias index
             if e.flags & ResultFlag._TYPE == ResultFlag.ALIAS:
-                offset += 2
+                offset += alias_struct.size
 
             # Extra field for prefix index and length
             if e.flags & ResultFlag.HAS_PREFIX:
-                offset += 3
+                offset += prefix_struct.size
 
             # Extra field for suffix length
             if e.flags & ResultFlag.HAS_SUFFIX:
@@ -243,17 +305,28 @@ class ResultMap:
             if e.name and e.url:
                  offset += len(e.url.encode('utf-8')) + 1
 
-        # Write file size
-        output += self.offset_struct.pack(offset)
+        # The file size is the largest offset
+        if offset >= offset_limit:
+            raise OverflowError("result map offset {} doesn't fit into {} bytes".format(offset, offset_bytes))
+
+        # Write the offset array and file size
+        if offset_bytes == 3:
+            for e, entry_offset in zip(self.entries, offsets):
+                output += offset_struct.pack(entry_offset | (e.flags.value << 24))
+            output += offset_struct.pack(offset)
+        else:
+            for e, entry_offset in zip(self.entries, offsets):
+                output += offset_struct.pack(entry_offset, e.flags.value)
+            output += offset_struct.pack(offset, 0)
 
         # Write the entries themselves
         for e in self.entries:
             if e.flags & ResultFlag._TYPE == ResultFlag.ALIAS:
                 assert not e.alias is None
                 assert not e.url
-                output += self.alias_struct.pack(e.alias)
+                output += alias_struct.pack(e.alias)
             if e.flags & ResultFlag.HAS_PREFIX:
-                output += self.prefix_struct.pack(e.prefix, e.prefix_length)
+                output += prefix_struct.pack(e.prefix, e.prefix_length)
             if e.flags & ResultFlag.HAS_SUFFIX:
                 output += self.suffix_length_struct.pack(e.suffix_length)
             output += e.name.encode('utf-8')
@@ -268,36 +341,59 @@ class Trie:
     #  root  |     |     header         | results | child 1 | child 1 | child 1 |
     # offset | ... | result # | value # |   ...   |  char   | barrier | offset  | ...
     #  32b   |     |    8b    |   8b    |  n*16b  |   8b    |    1b   |   23b   |
+    #
+    # In search data version 1, a result count of 255 means the actual count
+    # is in a 16-bit field right after the header. Results can be 32-bit and
+    # child offsets 31-bit, in which case the char is after the offset:
+    #
+    #     header         | result | results | child 1 | child 1 | child 1 |
+    # result # | value # | count  |   ...   | barrier | offset  |  char   | ...
+    #    8b    |   8b    |  16b   |  n*32b  |    1b   |   31b   |   8b    |
     root_offset_struct = struct.Struct('<I')
     header_struct = struct.Struct('<BB')
     result_struct = struct.Struct('<H')
     child_struct = struct.Struct('<I')
     child_char_struct = struct.Struct('<B')
 
+    # The nodes are stored in flat arrays indexed by node ID instead of being
+    # objects pointing to each other, with the root being 0. Children of each
+    # node are a dict from the character to child node ID, kept in insertion
+    # order as that's the order in which they get serialized. The lookahead
+    # barrier flag is stored for the child node, as each node has exactly one
+    # parent. Most nodes have no results, so these are in a dict from node ID
+    # to a list of results. Inserting, sorting and serializing is done
+    # iteratively, so huge symbol sets don't hit the recursion limit and
+    # there's no per-character copying of the path and barrier list.
     def __init__(self):
-        self.results = []
-        self.children = {}
-
-    def _insert(self, path: bytes, result, lookahead_barriers):
-        if not path:
-            self.results += [result]
-            return
-
-        char = path[0]
-        if not char in self.children:
-            self.children[char] = (False, Trie())
-        if lookahead_barriers and lookahead_barriers[0] == 0:
-            lookahead_barriers = lookahead_barriers[1:]
-            self.children[char] = (True, self.children[char][1])
-        self.children[char][1]._insert(path[1:], result, [b - 1 for b in lookahead_barriers])
+        self.results = {}
+        self.children = [{}]
+        self.lookahead_barriers = bytearray(1)
 
     def insert(self, path: str, result, lookahead_barriers=[]):
-        self._insert(path.encode('utf-8'), result, lookahead_barriers)
-
-    def _sort(self, key):
-        self.results.sort(key=key)
-        for _, child in self.children.items():
-            child[1]._sort(key)
+        results = self.results
+        children = self.children
+        node_barriers = self.lookahead_barriers
+        barriers = iter(lookahead_barriers)
+        barrier = next(barriers, None)
+
+        node = 0
+        for i, char in enumerate(path.encode('utf-8')):
+            node_children = children[node]
+            child = node_children.get(char)
+            if child is None:
+                child = node_children[char] = len(children)
+                children.append({})
+                node_barriers.append(0)
+
+            # The barriers are expected to be sorted, a barrier that was
+            # skipped blocks all following ones
+            if barrier == i:
+                node_barriers[child] = 1
+                barrier = next(barriers, None)
+
+            node = child
+
+        results.setdefault(node, []).append(result)
 
     def sort(self, result_map: ResultMap):
         # What the shit, why can't I just take two elements and say which one
@@ -321,57 +417,192 @@ class Trie:
                 len(entry.name)
             ]
 
-        self._sort(key)
-
-    # Returns offset of the serialized thing in `output`
-    def _serialize(self, hashtable, output: bytearray, merge_subtrees) -> int:
-        # Serialize all children first
-        child_offsets = []
-        for char, child in self.children.items():
-            offset = child[1]._serialize(hashtable, output, merge_subtrees=merge_subtrees)
-            child_offsets += [(char, child[0], offset)]
-
-        # Serialize this node
-        serialized = bytearray()
-        serialized += self.header_struct.pack(len(self.results), len(self.children))
-        for v in self.results:
-            serialized += self.result_struct.pack(v)
-
-        # Serialize child offsets
-        for char, lookahead_barrier, abs_offset in child_offsets:
-            assert abs_offset < 2**23
-
-            # write them over each other because that's the only way to pack
-            # a 24 bit field
-            offset = len(serialized)
-            serialized += self.child_struct.pack(abs_offset | ((1 if lookahead_barrier else 0) << 23))
-            self.child_char_struct.pack_into(serialized, offset + 3, char)
-
-        # Subtree merging: if this exact tree is already in the table, return
-        # its offset. Otherwise add it and return the new offset.
-        # TODO: why hashable = bytes(output[base_offset:] + serialized) didn't work?
-        hashable = bytes(serialized)
-        if merge_subtrees and hashable in hashtable:
-            return hashtable[hashable]
-        else:
-            offset = len(output)
-            output += serialized
-            if merge_subtrees: hashtable[hashable] = offset
-            return offset
-
-    def serialize(self, merge_subtrees=True) -> bytearray:
+        # Calculate the key just once for every result instead of for every
+        # node it's in
+        keys = {}
+        for results in self.results.values():
+            for result in results:
+                if result not in keys: keys[result] = key(result)
+            if len(results) > 1: results.sort(key=keys.__getitem__)
+
+    # Splits the trie into one trie per child of the root, each containing
+    # just the paths starting with that byte. Results in each are renumbered
+    # in order of appearance, the returned list maps the new result IDs to the
+    # original ones.
+    def split(self) -> dict:
+        out = {}
+        for root_char, root_child in self.children[0].items():
+            trie = Trie()
+            ids = {}
+            stack = [(root_child, 0, root_char)]
+            while stack:
+                node, parent, char = stack.pop()
+                new = trie.children[parent][char] = len(trie.children)
+                trie.children.append({})
+                trie.lookahead_barriers.append(self.lookahead_barriers[node])
+                if node in self.results:
+                    trie.results[new] = [ids.setdefault(result, len(ids)) for result in self.results[node]]
+
+                # Children pushed in reverse to be added in the original order
+                stack += [(child, new, child_char) for child_char, child in reversed(list(self.children[node].items()))]
+
+            out[root_char] = (trie, list(ids))
+        return out
+
+    # Nodes with 255 and more results can be stored only in search data
+    # version 1
+    def max_result_count(self) -> int:
+        return max((len(results) for results in self.results.values()), default=0)
+
+    # Raises OverflowError if the child offsets don't fit into given number of
+    # bytes
+    def serialize(self, merge_subtrees=True, result_id_bytes=2, offset_bytes=3) -> bytearray:
         output = bytearray(b'\x00\x00\x00\x00')
         hashtable = {}
-        self.root_offset_struct.pack_into(output, 0, self._serialize(hashtable, output, merge_subtrees=merge_subtrees))
+
+        # Whole node is packed at once with a struct made for given result and
+        # child count. With 23-bit offsets the child char is the topmost byte
+        # of the child offset field, otherwise it's after it.
+        node_structs = {}
+        assert result_id_bytes in [2, 4] and offset_bytes in [3, 4]
+        result_format = 'H' if result_id_bytes == 2 else 'I'
+        child_format = 'I' if offset_bytes == 3 else 'IB'
+        offset_limit = 2**(offset_bytes*8 - 1)
+
+        # Serialize the nodes in post-order (all children, in order, before
+        # their parent), remembering the offset of each
+        offsets = [None]*len(self.children)
+        stack = [(0, False)]
+        while stack:
+            node, children_done = stack.pop()
+            children = self.children[node]
+            if not children_done:
+                stack += [(node, True)]
+                stack += [(child, False) for child in reversed(list(children.values()))]
+                continue
+
+            results = self.results.get(node, [])
+            counts = (len(results), len(children))
+            node_struct = node_structs.get(counts)
+            if not node_struct:
+                # 255 and more results have the count in an extra field
+                if counts[0] < 255:
+                    header_format = 'BB'
+                else:
+                    assert counts[0] < 2**16
+                    header_format = 'BBH'
+                node_struct = node_structs[counts] = (struct.Struct('<' + header_format + result_format*counts[0] + child_format*counts[1]), counts if counts[0] < 255 else (255, counts[1], counts[0]))
+
+            child_offsets = []
+            for char, child in children.items():
+                abs_offset = offsets[child]
+                if abs_offset >= offset_limit:
+                    raise OverflowError("trie offset {} doesn't fit into {} bytes".format(abs_offset, offset_bytes))
+                if offset_bytes == 3:
+                    child_offsets += [abs_offset | (self.lookahead_barriers[child] << 23) | (char << 24)]
+                else:
+                    child_offsets += [abs_offset | (self.lookahead_barriers[child] << 31), char]
+            serialized = node_struct[0].pack(*node_struct[1], *results, *child_offsets)
+
+            # Subtree merging: if this exact tree is already in the table, use
+            # its offset. Otherwise add it and use the new offset.
+            if merge_subtrees and serialized in hashtable:
+                offsets[node] = hashtable[serialized]
+            else:
+                offsets[node] = len(output)
+                output += serialized
+                if merge_subtrees: hashtable[serialized] = offsets[node]
+
+        self.root_offset_struct.pack_into(output, 0, offsets[0])
         return output
 
+# magic | version | symbol | result map |
+# header|   (0)   | count  |   offset   | ...
+#  24b  |    8b   |  16b   |    32b     |
 search_data_header_struct = struct.Struct('<3sBHI')
 
+# magic | version | result | trie offset | map offset | symbol | result map |
+# header|   (1)   |  ID    |   bytes     |   bytes    | count  |   offset   | ...
+#  24b  |    8b   |  bytes |     8b      |     8b     |  32b   |    32b     |
+#       |         |   8b   |             |            |        |            |
+search_data_header_v1_struct = struct.Struct('<3sBBBBII')
+
 def serialize_search_data(trie: Trie, map: ResultMap, symbol_count, merge_subtrees=True, merge_prefixes=True) -> bytearray:
-    serialized_trie = trie.serialize(merge_subtrees=merge_subtrees)
-    serialized_map = map.serialize(merge_prefixes=merge_prefixes)
-    # magic header, version, symbol count, offset of result map
-    return search_data_header_struct.pack(b'MCS', 0, symbol_count, len(serialized_trie) + 10) + serialized_trie + serialized_map
+    # Result IDs are 16-bit unless there's too many of them
+    result_id_bytes = 2 if len(map.entries) <= 2**16 else 4
+
+    # Try with the smaller offsets first, if they overflow, use 32-bit ones.
+    # The result map merges the prefixes in the first try already.
+    try:
+        trie_offset_bytes = 3
+        serialized_trie = trie.serialize(merge_subtrees=merge_subtrees, result_id_bytes=result_id_bytes, offset_bytes=trie_offset_bytes)
+    except OverflowError:
+        trie_offset_bytes = 4
+        serialized_trie = trie.serialize(merge_subtrees=merge_subtrees, result_id_bytes=result_id_bytes, offset_bytes=trie_offset_bytes)
+    try:
+        map_offset_bytes = 3
+        serialized_map = map.serialize(merge_prefixes=merge_prefixes, result_id_bytes=result_id_bytes, offset_bytes=map_offset_bytes)
+    except OverflowError:
+        map_offset_bytes = 4
+        serialized_map = map.serialize(merge_prefixes=False, result_id_bytes=result_id_bytes, offset_bytes=map_offset_bytes)
+
+    # Use the original format if everything fits, so small projects don't
+    # pay for the wider fields and remain readable by older search.js
+    if result_id_bytes == 2 and trie_offset_bytes == 3 and map_offset_bytes == 3 and symbol_count < 2**16 and trie.max_result_count() < 255:
+        # magic header, version, symbol count, offset of result map
+        return search_data_header_struct.pack(b'MCS', 0, symbol_count, len(serialized_trie) + search_data_header_struct.size) + serialized_trie + serialized_map
+
+    # magic header, version, result ID, trie and result map offset sizes,
+    # symbol count, offset of result map
+    return search_data_header_v1_struct.pack(b'MCS', 1, result_id_bytes, trie_offset_bytes, map_offset_bytes, symbol_count, len(serialized_trie) + search_data_header_v1_struct.size) + serialized_trie + serialized_map
+
+# magic | version | symbol | data | shard | shard 1 |
+# header|   (0)   | count  | size | count |  byte   | ...
+#  24b  |    8b   |  32b   | 32b  |  16b  |   8b    |
+search_manifest_header_struct = struct.Struct('<3sBIIH')
+
+# Splits the search data into shards by the first byte of the search string,
+# so the client needs to download only the shard for what's being typed. Each
+# shard is a complete search data file with its own result map. The prefixes
+# are merged for the whole map first and each shard then gets the results in
+# its trie together with all prefixes and alias targets they reference, so
+# entries sharing a prefix don't need to repeat it in every shard. The symbol
+# count is stored only in the manifest, together with the total size and list
+# of shards. Returns the manifest and a dict of shards.
+def serialize_search_data_sharded(trie: Trie, map: ResultMap, symbol_count, merge_subtrees=True, merge_prefixes=True):
+    if merge_prefixes: map.merge_prefixes()
+
+    shards = {}
+    for char, (shard_trie, ids) in trie.split().items():
+        # The list gets extended with referenced entries while iterating, so
+        # these get their references added as well
+        remap = {id: i for i, id in enumerate(ids)}
+        for id in ids:
+            e = map.entries[id]
+            for reference in ([e.alias] if e.alias is not None else []) + ([e.prefix] if e.flags & ResultFlag.HAS_PREFIX else []):
+                if reference not in remap:
+                    remap[reference] = len(ids)
+                    ids += [reference]
+
+        shard_map = ResultMap()
+        for id in ids:
+            e = map.entries[id]
+            entry = Empty()
+            entry.name = e.name
+            entry.url = e.url
+            entry.flags = e.flags
+            entry.alias = None if e.alias is None else remap[e.alias]
+            entry.prefix = remap[e.prefix] if e.flags & ResultFlag.HAS_PREFIX else 0
+            entry.prefix_length = e.prefix_length
+            entry.suffix_length = e.suffix_length
+            shard_map.entries += [entry]
+
+        shards[char] = serialize_search_data(shard_trie, shard_map, 0, merge_subtrees=merge_subtrees, merge_prefixes=False)
+
+    manifest = bytearray(search_manifest_header_struct.pack(b'MCM', 0, symbol_count, 0, len(shards)))
+    manifest += bytes(shards.keys())
+    search_manifest_header_struct.pack_into(manifest, 0, b'MCM', 0, symbol_count, len(manifest) + sum(len(shard) for shard in shards.values()), len(shards))
+    return manifest, shards
 
 xref_id_rx = re.compile(r"""(.*)_1(_[a-z-]+[0-9]+|@)$""")
 slugify_nonalnum_rx = re.compile(r"""[^\w\s-]""")
@@ -384,6 +615,9 @@ class StateCompound:
         self.name: str
         self.url: str
         self.brief: str
+        # Whether the brief can be reused in parse_xml() instead of parsing
+        # it again, see _is_page_independent_desc()
+        self.brief_is_page_independent: bool = False
         self.has_details: bool
         self.is_deprecated: bool
         self.is_final: bool = None
@@ -399,6 +633,22 @@ class State:
         self.examples: List[Any] = []
         self.doxyfile: Dict[str, str] = {}
         self.images: List[str] = []
+        # XML trees parsed during the metadata pre-pass that are kept for
+        # parse_xml() so the files don't need to be parsed again. Only files
+        # listed in xml_trees_to_keep are kept, and only until the size of the
+        # kept files reaches xml_trees_budget bytes. Files over the budget are
+        # parsed again.
+        self.xml_trees: Dict[str, ET.ElementTree] = {}
+        self.xml_trees_to_keep: Set[str] = set()
+        self.xml_trees_budget = 0
+        # Files larger than this many bytes are parsed in a streaming way,
+        # see _parse_xml_streamed(). Zero means never.
+        self.xml_streaming_threshold = 0
+        # Whether to skip writing output files that didn't change
+        self.write_if_changed = False
+        # (suffix, level) pairs of precompressed siblings to write next to
+        # output files, see _precompress_output()
+        self.precompress: List[Tuple[str, int]] = []
         self.current = '' # current file being processed (for logging)
         # Current kind of compound being processed. Affects current_include
         # below (i.e., per-entry includes are parsed only for namespaces or
@@ -1392,34 +1642,10 @@ def parse_desc_internal(state: State, element: ET.Element, immediate_parent: ET.
             if not filename.startswith('.') and not code.strip():
                 logging.warning("{}: @include / @snippet / @skip[line] produced an empty code block, probably a wrong match expression?".format(state.current))
 
-            # Custom mapping of filenames to languages
-            mapping = [('.h', 'c++'),
-                       ('.h.cmake', 'c++'),
-                       # Pygments knows only .vert, .frag, .geo
-                       ('.glsl', 'glsl'),
-                       ('.conf', 'ini'),
-                       ('.xml-jinja', 'xml+jinja'),
-                       ('.html-jinja', 'html+jinja'),
-                       ('.jinja', 'jinja'),
-                       ('.ansi', ansilexer.AnsiLexer)]
-            for key, v in mapping:
-                if not filename.endswith(key): continue
-
-                if isinstance(v, str):
-                    lexer = get_lexer_by_name(v)
-                else:
-                    lexer = v()
-                break
-
-            # Otherwise try to find lexer by filename
-            else:
-                # Put some bogus prefix to the filename in case it is just
-                # `.ext`
-                lexer = find_lexer_class_for_filename("code" + filename)
-                if not lexer:
-                    logging.warning("{}: unrecognized language of {} in <programlisting>, highlighting disabled".format(state.current, filename))
-                    lexer = TextLexer()
-                else: lexer = lexer()
+            lexer = pygmentsextra.lexer_for_filename(filename)
+            if not lexer:
+                logging.warning("{}: unrecognized language of {} in <programlisting>, highlighting disabled".format(state.current, filename))
+                lexer = TextLexer()
 
             # Style console sessions differently
             if (isinstance(lexer, BashSessionLexer) or
@@ -1428,11 +1654,8 @@ def parse_desc_internal(state: State, element: ET.Element, immediate_parent: ET.
             else:
                 class_ = 'm-code'
 
-            if isinstance(lexer, ansilexer.AnsiLexer):
-                formatter = ansilexer.HtmlAnsiFormatter()
-            else:
-                formatter = HtmlFormatter(nowrap=True)
-            highlighted = highlight(code, lexer, formatter)
+            formatter = pygmentsextra.formatter_for(lexer)
+            highlighted = pygmentsextra.highlight_cached(code, lexer, formatter)
             # Strip whitespace around if inline code, strip only trailing
             # whitespace if a block
             highlighted = highlighted.rstrip()
@@ -2325,17 +2548,145 @@ def parse_define(state: State, element: ET.Element):
         return define
     return None
 
+# Math formulas get IDs unique only in given page and anchors / section IDs
+# are relative to current compound, so output for descriptions containing
+# these can't be reused between the metadata pre-pass and parse_xml()
+_page_dependent_desc_tags = ['formula', 'anchor', 'sect1', 'sect2', 'sect3', 'sect4']
+
+def _is_page_independent_desc(element: ET.Element) -> bool:
+    for i in element.iter():
+        if i.tag in _page_dependent_desc_tags: return False
+    return True
+
+# Streaming parsing of huge compound XML files. First the whole file is
+# parsed without the <memberdef> elements, which gives a tree that's small
+# but otherwise contains everything parse_xml() and extract_metadata() need
+# up front (the compound brief, location etc. are *after* all sections in the
+# file). Each <sectiondef> in it is then replaced with a _StreamedSectiondef
+# that, when iterated, parses the file once more and yields its <memberdef>
+# elements one by one, throwing each away once the consumer is done with it.
+# The sections are processed in file order, so a single pass is shared by all
+# of them. Both passes use the XML backend, so the elements are of the same
+# type as in the rest of the trees.
+class _MemberStream:
+    def __init__(self, xml, document_all_stuff):
+        self.xml = xml
+        self.document_all_stuff = document_all_stuff
+        self.members = None
+        self.pending = None
+        # The _StreamedSectiondef elements, which have to be kept alive with
+        # lxml, see xmlbackend.make_custom_element() and _StreamedTree
+        self.sectiondefs = []
+
+    def _parse(self):
+        index = -1
+        stack = []
+        for event, element in xmlbackend.iterparse(self.xml, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == 'sectiondef' and len(stack) == 2: index += 1
+                stack += [element]
+                continue
+
+            stack.pop()
+            if element.tag == 'memberdef' and stack[-1].tag == 'sectiondef':
+                yield index, element
+                stack[-1].remove(element)
+                element.clear()
+            elif element.tag == 'listofallmembers':
+                element.clear()
+
+    def take(self, index):
+        if self.members is None: self.members = self._parse()
+
+        while True:
+            if self.pending is None:
+                self.pending = next(self.members, None)
+                if self.pending is None: return
+
+            # Skip members of sections that weren't iterated, stop at members
+            # of the sections that follow
+            member_index, memberdef = self.pending
+            if member_index > index: return
+            self.pending = None
+            if member_index < index: continue
+
+            if self.document_all_stuff: _document_all_stuff(memberdef)
+            yield memberdef
+
+class _StreamedSectiondef:
+    def __iter__(self):
+        return self.stream.take(self.index)
+
+    def findall(self, path, namespaces=None):
+        if path == 'memberdef': return self.stream.take(self.index)
+        return super().findall(path, namespaces)
+
+# Returned from _parse_xml_streamed() in place of an ElementTree, keeping the
+# stream alive for as long as the tree is used
+class _StreamedTree:
+    def __init__(self, root, stream):
+        self.root = root
+        self.stream = stream
+
+    def getroot(self):
+        return self.root
+
+def _parse_xml_streamed(state: State, xml) -> ET.ElementTree:
+    stack = []
+    parser = xmlbackend.iterparse(xml, events=('start', 'end'))
+    for event, element in parser:
+        if event == 'start':
+            stack += [element]
+            continue
+
+        stack.pop()
+        if element.tag == 'memberdef' and stack[-1].tag == 'sectiondef':
+            stack[-1].remove(element)
+        # Not used for anything and can be huge as well
+        elif element.tag == 'listofallmembers':
+            element.clear()
+
+    root = parser.root
+    if root.tag != 'doxygen' or not len(root) or root[0].tag != 'compounddef': return xmlbackend.element_tree(root)
+
+    stream = _MemberStream(xml, state.doxyfile['M_SHOW_UNDOCUMENTED'])
+    compounddef = root[0]
+    index = 0
+    for i, child in enumerate(compounddef):
+        if child.tag != 'sectiondef': continue
+        sectiondef = xmlbackend.make_custom_element(_StreamedSectiondef, child.tag, dict(child.attrib))
+        sectiondef.extend(list(child)) # <header> and <description>
+        sectiondef.stream = stream
+        sectiondef.index = index
+        stream.sectiondefs += [sectiondef]
+        compounddef[i] = sectiondef
+        index += 1
+    return _StreamedTree(root, stream)
+
+def _is_xml_streamed(state: State, xml) -> bool:
+    return state.xml_streaming_threshold and os.path.basename(xml) != 'index.xml' and os.path.getsize(xml) > state.xml_streaming_threshold
+
+def _parse_xml_or_reuse(state: State, xml):
+    tree = state.xml_trees.pop(xml, None)
+    if tree is not None: return tree
+    if _is_xml_streamed(state, xml):
+        logging.debug("{}: parsing in streaming mode".format(os.path.basename(xml)))
+        return _parse_xml_streamed(state, xml)
+    return xmlbackend.parse(xml)
+
 # Used for the M_SHOW_UNDOCUMENTED option
 def _document_all_stuff(compounddef: ET.Element):
-    for i in compounddef.findall('.//briefdescription/..'):
+    # Members of a _StreamedSectiondef are not visible to iter(), those are
+    # processed by the stream as they're parsed
+    for i in compounddef.iter():
         brief = i.find('briefdescription')
-        if not brief and not i.find('detaileddescription'):
+        if brief is not None and not brief and not i.find('detaileddescription'):
             # Add an empty <span> to the paragraph so it doesn't look empty.
             # Can't use strong/emphasis, as those are collapsed if empty as
             # well; on the other hand it's very unlikely that someone would
             # want to use @m_span with empty contents.
-            dim = ET.Element('{http://mcss.mosra.cz/doxygen/}span')
-            para = ET.Element('para')
+            dim = brief.makeelement('{http://mcss.mosra.cz/doxygen/}span', {})
+            para = brief.makeelement('para', {})
             para.append(dim)
             brief.append(para)
 
@@ -2343,11 +2694,22 @@ def extract_metadata(state: State, xml):
     logging.debug("Extracting metadata from {}".format(os.path.basename(xml)))
 
     try:
-        tree = ET.parse(xml)
-    except ET.ParseError as e:
+        streamed = _is_xml_streamed(state, xml)
+        tree = _parse_xml_streamed(state, xml) if streamed else xmlbackend.parse(xml)
+    except xmlbackend.ParseError as e:
         logging.error("{}: XML parse error, skipping: {}".format(os.path.basename(xml), e))
         return
 
+    # Keep the tree for parse_xml() / parse_index_xml() if it fits into the
+    # budget. Those mutate the tree only in an idempotent way (which is also
+    # the case for _document_all_stuff() below), so it can be reused as-is.
+    # Streamed trees can't be iterated twice, so those are never kept.
+    if xml in state.xml_trees_to_keep and not streamed:
+        size = os.path.getsize(xml)
+        if size <= state.xml_trees_budget:
+            state.xml_trees[xml] = tree
+            state.xml_trees_budget -= size
+
     root = tree.getroot()
 
     # We need just list of all example files in correct order, nothing else
@@ -2384,9 +2746,11 @@ def extract_metadata(state: State, xml):
     # This is similar to compound.url_base handling in parse_xml() below.
     compound.url = 'index.html' if compound.kind == 'page' and compound.id == 'indexpage' else compound.id + '.html'
     compound.brief = parse_desc(state, compounddef.find('briefdescription'))
+    compound.brief_is_page_independent = _is_page_independent_desc(compounddef.find('briefdescription'))
     # Groups and pages are explicitly created so they *have details*, other
-    # things need to have at least some documentation
-    compound.has_details = compound.kind in ['group', 'page'] or compound.brief or compounddef.find('detaileddescription')
+    # things need to have at least some documentation. Stored as a plain bool
+    # and not the element, as the compound gets pickled and hashed.
+    compound.has_details = compound.kind in ['group', 'page'] or bool(compound.brief) or len(compounddef.find('detaileddescription')) != 0
     compound.children = []
 
     # Deprecation status
@@ -2432,6 +2796,7 @@ def extract_metadata(state: State, xml):
             compound.children += [i.attrib['refid']]
 
     state.compounds[compound.id] = compound
+    return compound
 
 def postprocess_state(state: State):
     # Save parent for each child
@@ -2550,7 +2915,7 @@ def postprocess_state(state: State):
     if state.doxyfile['M_FAVICON']:
         state.doxyfile['M_FAVICON'] = (state.doxyfile['M_FAVICON'], mimetypes.guess_type(state.doxyfile['M_FAVICON'])[0])
 
-def build_search_data(state: State, merge_subtrees=True, add_lookahead_barriers=True, merge_prefixes=True) -> bytearray:
+def build_search_trie(state: State, add_lookahead_barriers=True):
     trie = Trie()
     map = ResultMap()
 
@@ -2650,12 +3015,24 @@ def build_search_data(state: State, merge_subtrees=True, add_lookahead_barriers=
     # order by default
     trie.sort(map)
 
+    return trie, map, symbol_count
+
+def build_search_data(state: State, merge_subtrees=True, add_lookahead_barriers=True, merge_prefixes=True) -> bytearray:
+    trie, map, symbol_count = build_search_trie(state, add_lookahead_barriers=add_lookahead_barriers)
     return serialize_search_data(trie, map, symbol_count, merge_subtrees=merge_subtrees, merge_prefixes=merge_prefixes)
 
+def build_search_data_sharded(state: State, merge_subtrees=True, add_lookahead_barriers=True, merge_prefixes=True):
+    trie, map, symbol_count = build_search_trie(state, add_lookahead_barriers=add_lookahead_barriers)
+    return serialize_search_data_sharded(trie, map, symbol_count, merge_subtrees=merge_subtrees, merge_prefixes=merge_prefixes)
+
 def base85encode_search_data(data: bytearray) -> bytearray:
     return (b"/* Generated by https://mcss.mosra.cz/documentation/doxygen/. Do not edit. */\n" +
             b"Search.load('" + base64.b85encode(data, True) + b"');\n")
 
+def base85encode_search_shard(char: int, data: bytearray) -> bytearray:
+    return (b"/* Generated by https://mcss.mosra.cz/documentation/doxygen/. Do not edit. */\n" +
+            b"Search.loadShard(" + str(char).encode('utf-8') + b", '" + base64.b85encode(data, True) + b"');\n")
+
 def parse_xml(state: State, xml: str):
     # Reset counter for unique math formulas
     latex2svgextra.counter = 0
@@ -2665,8 +3042,8 @@ def parse_xml(state: State, xml: str):
     logging.debug("Parsing {}".format(state.current))
 
     try:
-        tree = ET.parse(xml)
-    except ET.ParseError as e:
+        tree = _parse_xml_or_reuse(state, xml)
+    except xmlbackend.ParseError as e:
         logging.error("{}: XML parse error, skipping: {}".format(state.current, e))
         return
 
@@ -2715,7 +3092,11 @@ def parse_xml(state: State, xml: str):
     compound.include = None
     compound.has_template_details = False
     compound.templates = None
-    compound.brief = parse_desc(state, compounddef.find('briefdescription'))
+    # The brief was already parsed in extract_metadata(), reuse it if possible
+    if compound.id in state.compounds and state.compounds[compound.id].brief_is_page_independent:
+        compound.brief = state.compounds[compound.id].brief
+    else:
+        compound.brief = parse_desc(state, compounddef.find('briefdescription'))
     compound.description, templates, compound.sections, footer_navigation, example_navigation, search_keywords, compound.is_deprecated = parse_toplevel_desc(state, compounddef.find('detaileddescription'))
     compound.example_navigation = None
     compound.footer_navigation = None
@@ -3427,7 +3808,7 @@ def parse_xml(state: State, xml: str):
 def parse_index_xml(state: State, xml):
     logging.debug("Parsing {}".format(os.path.basename(xml)))
 
-    tree = ET.parse(xml)
+    tree = _parse_xml_or_reuse(state, xml)
     root = tree.getroot()
     assert root.tag == 'doxygenindex'
 
@@ -3571,9 +3952,14 @@ def parse_doxyfile(state: State, doxyfile, config = None):
         'M_LINKS_NAVBAR1': ['pages', 'namespaces'],
         'M_LINKS_NAVBAR2': ['annotated', 'files'],
         'M_MATH_CACHE_FILE': ['m.math.cache'],
+        'M_CODE_CACHE_FILE': ['m.code.cache'],
+        'M_DOT_CACHE_FILE': ['m.dot.cache'],
+        'M_METADATA_CACHE_FILE': [''],
         'M_PAGE_FINE_PRINT': ['[default]'],
         'M_SEARCH_DISABLED': ['NO'],
         'M_SEARCH_DOWNLOAD_BINARY': ['NO'],
+        'M_SEARCH_SHARDED': ['NO'],
+        'M_SEARCH_WORKER': ['NO'],
         'M_SEARCH_HELP': [
 """<p class="m-noindent">Search for symbols, directories, files, pages or
 modules. You can omit any prefix from the symbol or file path; adding a
@@ -3589,7 +3975,9 @@ copy a link to the result using <span class="m-label m-dim">⌘</span>
 """],
         'M_SEARCH_BASE_URL': [''],
         'M_SEARCH_EXTERNAL_URL': [''],
-        'M_SHOW_UNDOCUMENTED': ['NO']
+        'M_SHOW_UNDOCUMENTED': ['NO'],
+        'M_PRECOMPRESS_GZIP': ['0'],
+        'M_PRECOMPRESS_BROTLI': ['0']
     }
 
     # Defaults so we don't fail with minimal Doxyfiles and also that the
@@ -3688,6 +4076,9 @@ copy a link to the result using <span class="m-label m-dim">⌘</span>
               'M_THEME_COLOR',
               'M_FAVICON',
               'M_MATH_CACHE_FILE',
+              'M_CODE_CACHE_FILE',
+              'M_DOT_CACHE_FILE',
+              'M_METADATA_CACHE_FILE',
               'M_SEARCH_HELP',
               'M_SEARCH_EXTERNAL_URL',
               'M_SEARCH_BASE_URL']:
@@ -3696,7 +4087,9 @@ copy a link to the result using <span class="m-label m-dim">⌘</span>
     # Int values that we want
     for i in ['DOT_FONTSIZE',
               'M_CLASS_TREE_EXPAND_LEVELS',
-              'M_FILE_TREE_EXPAND_LEVELS']:
+              'M_FILE_TREE_EXPAND_LEVELS',
+              'M_PRECOMPRESS_GZIP',
+              'M_PRECOMPRESS_BROTLI']:
         if i in config: state.doxyfile[i] = int(' '.join(config[i]))
 
     # Boolean values that we want
@@ -3708,6 +4101,8 @@ copy a link to the result using <span class="m-label m-dim">⌘</span>
               'M_EXPAND_INNER_TYPES',
               'M_SEARCH_DISABLED',
               'M_SEARCH_DOWNLOAD_BINARY',
+              'M_SEARCH_SHARDED',
+              'M_SEARCH_WORKER',
               'M_SHOW_UNDOCUMENTED']:
         if i in config: state.doxyfile[i] = ' '.join(config[i]) == 'YES'
 
@@ -3727,12 +4122,403 @@ copy a link to the result using <span class="m-label m-dim">⌘</span>
 default_index_pages = ['pages', 'files', 'namespaces', 'modules', 'annotated']
 default_wildcard = '*.xml'
 default_templates = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'templates/doxygen/')
+default_xml_tree_cache_size = 128
+default_xml_streaming_threshold = 32
+
+# Template cache is either None (disabled) or a path to a cache directory
+def make_environment(templates, template_cache=None):
+    # If custom template dir was supplied, use the default template directory
+    # as a fallback
+    template_paths = [templates]
+    if templates != default_templates: template_paths += [default_templates]
+    env = Environment(loader=FileSystemLoader(template_paths),
+                      trim_blocks=True, lstrip_blocks=True)
+
+    # Cache compiled templates so they don't need to be compiled again on
+    # every run. Jinja checks the template source to decide whether the
+    # cached version is up-to-date.
+    if template_cache:
+        env.bytecode_cache = FileSystemBytecodeCache(template_cache, '__m.css_doxygen_%s.cache')
+
+    # Filter to return file basename or the full URL, if absolute
+    def basename_or_url(path):
+        if urllib.parse.urlparse(path).netloc: return path
+        return os.path.basename(path)
+    env.filters['basename_or_url'] = basename_or_url
+    env.filters['urljoin'] = urllib.parse.urljoin
+
+    return env
+
+# Writes output files from background threads so rendering can continue while
+# the data are being written. At most queue_size files are waiting to be
+# written, after that submit() blocks until some of them are done, in order
+# to not keep the whole output in memory. Errors from the threads are
+# propagated in flush().
+class OutputWriter:
+    def __init__(self, threads, queue_size):
+        self.executor = ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.futures = []
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures += [future]
+
+    def flush(self):
+        futures = self.futures
+        self.futures = []
+        for future in futures: future.result()
+
+    def shutdown(self):
+        self.flush()
+        self.executor.shutdown()
+
+_output_writer: OutputWriter = None
+
+# Output files for which precompressed siblings are written, if enabled. The
+# rest (mostly PNG and JPEG images) is compressed already.
+precompressed_extensions = ['.html', '.css', '.js', '.bin', '.svg', '.xml']
+
+def _compress(suffix, data: bytes, level) -> bytes:
+    # Zero mtime to have the output reproducible and not differing on every
+    # run, otherwise write_if_changed would be useless for these
+    if suffix == '.gz': return gzip.compress(data, level, mtime=0)
+    assert suffix == '.br'
+    return brotli.compress(data, quality=level)
+
+# Writes a .gz / .br file next to the output, so a static file server (such
+# as nginx with gzip_static / brotli_static) doesn't need to compress on the
+# fly. This is done by whoever writes the file itself, so the compression
+# happens in parallel when output threads or multiple jobs are used. If the
+# output itself didn't change, only siblings that are missing get written,
+# as compression (especially Brotli) is slow.
+def _precompress_output(output, data: bytes, precompress, changed):
+    if os.path.splitext(output)[1] not in precompressed_extensions: return
+
+    for suffix, level in precompress:
+        if not changed and os.path.exists(output + suffix): continue
+        _write_output(output + suffix, _compress(suffix, data, level), False)
+
+def _write_output(output, data: bytes, if_changed, precompress=[]):
+    changed = True
+    if if_changed and os.path.exists(output) and os.path.getsize(output) == len(data):
+        with open(output, 'rb') as f:
+            changed = f.read() != data
+
+    # The siblings are written first so they don't stay outdated if writing
+    # the output gets interrupted
+    _precompress_output(output, data, precompress, changed)
+
+    if not changed: return
+
+    with open(output, 'wb') as f:
+        f.write(data)
+
+# If state.write_if_changed is set, files that already exist with the same
+# contents are not written again, preserving their modification time
+def write_output(state: State, output, data: bytes):
+    if _output_writer: _output_writer.submit(_write_output, output, data, state.write_if_changed, state.precompress)
+    else: _write_output(output, data, state.write_if_changed, state.precompress)
+
+def write_rendered(state: State, output, rendered: str):
+    # Add back a trailing newline so we don't need to bother with patching
+    # test files to include a trailing newline to make Git happy
+    # TODO could keep_trailing_newline fix this better?
+    write_output(state, output, rendered.encode('utf-8') + b'\n')
+
+def _copy_output(source, output, if_changed, precompress=[]):
+    changed = not if_changed or not os.path.exists(output) or not filecmp.cmp(source, output, shallow=False)
+
+    if precompress and os.path.splitext(output)[1] in precompressed_extensions and (changed or not all(os.path.exists(output + suffix) for suffix, _ in precompress)):
+        with open(source, 'rb') as f:
+            _precompress_output(output, f.read(), precompress, changed)
+
+    if not changed: return
+
+    shutil.copy(source, output)
+
+def copy_output(state: State, source, output):
+    if _output_writer: _output_writer.submit(_copy_output, source, output, state.write_if_changed, state.precompress)
+    else: _copy_output(source, output, state.write_if_changed, state.precompress)
+
+# Returns list of written files, relative to html_output
+def render_xml(state: State, env: Environment, file, html_output, index_pages) -> List[str]:
+    outputs = []
+
+    if os.path.basename(file) == 'index.xml':
+        parsed = parse_index_xml(state, file)
+
+        for i in index_pages:
+            file = '{}.html'.format(i)
+
+            template = env.get_template(file)
+            rendered = template.render(index=parsed.index,
+                DOXYGEN_VERSION=parsed.version,
+                FILENAME=file,
+                **state.doxyfile)
+
+            write_rendered(state, os.path.join(html_output, file), rendered)
+            outputs += [file]
+    else:
+        # Graphs on the page are rendered in a single batch at the end
+        dot2svg.defer()
+        parsed = parse_xml(state, file)
+        dot2svg.render_deferred()
+        if not parsed: return outputs
+
+        template = env.get_template('{}.html'.format(parsed.compound.kind))
+        rendered = dot2svg.substitute_deferred(template.render(compound=parsed.compound,
+            DOXYGEN_VERSION=parsed.version,
+            FILENAME=parsed.compound.url,
+            **state.doxyfile))
+
+        write_rendered(state, os.path.join(html_output, parsed.compound.url), rendered)
+        outputs += [parsed.compound.url]
+
+    return outputs
+
+# A dict that remembers which keys were looked up in it. Used for
+# state.compounds and state.includes in incremental builds to know what
+# a file depends on.
+class RecordingDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.accessed.add(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self.accessed.add(key)
+        return super().get(key, default)
+
+# Renders a single file and returns everything it added to global state --
+# search data, referenced images, used math formulas and, in case of
+# incremental builds, compounds and includes it looked up
+def _render_xml_and_collect(state: State, env: Environment, file, html_output, index_pages):
+    state.search = []
+    state.images = []
+    if isinstance(state.compounds, RecordingDict):
+        state.compounds.accessed = set()
+        state.includes.accessed = set()
+
+    record = Empty()
+    record.outputs = render_xml(state, env, file, html_output, index_pages)
+    record.search = state.search
+    record.images = state.images
+    record.math = latex2svgextra.take_used_cache_entries()
+    record.code = pygmentsextra.take_used_cache_entries()
+    record.dot = dot2svg.take_used_cache_entries()
+    if isinstance(state.compounds, RecordingDict):
+        record.compounds = state.compounds.accessed
+        record.includes = state.includes.accessed
+    return record
+
+# Formulas that aren't cached yet are rendered in batches, in parallel, before
+# the files are, instead of one LaTeX run for each as they're encountered. The
+# XML doesn't need to be parsed for that, <formula> contains just text.
+_formula_src = re.compile(r"""<formula[^>]*>(?P<formula>[^<]*)</formula>""")
+
+def render_formulas(files):
+    formulas = []
+    for file in files:
+        with open(file, 'r', encoding='utf-8') as f:
+            contents = f.read()
+        if not '<formula' in contents: continue
+        formulas += [html.unescape(match.group('formula')) for match in _formula_src.finditer(contents)]
+
+    if formulas: logging.debug("rendering up to {} formulas in batches".format(len(formulas)))
+    return latex2svgextra.render_batch(formulas)
+
+# Per-process data for parallel rendering, filled in _init_worker(). The
+# state is shipped to each worker only once, the workers then send back only
+# what got added to state.search, state.images and the math cache.
+_worker = None
+
+def _init_worker(state: State, xml_backend, templates, template_cache, html_output, index_pages, math_cache_file, math_cache_entries, code_cache_file, dot_cache_file):
+    global _worker, _output_writer
+    # Worker processes write their output directly. The background writer
+    # threads of the parent process don't exist here.
+    _output_writer = None
+    _worker = Empty()
+    _worker.state = state
+    _worker.env = make_environment(templates, template_cache)
+    _worker.html_output = html_output
+    _worker.index_pages = index_pages
+
+    # Module-level configuration is not inherited when the processes are not
+    # forked, so set it up again
+    xmlbackend.use(xml_backend)
+    dot2svg.configure(state.doxyfile['DOT_FONTNAME'], state.doxyfile['DOT_FONTSIZE'])
+    latex2svgextra.unpickle_cache(math_cache_file)
+    latex2svgextra.merge_cache_entries(math_cache_entries)
+    latex2svgextra.record_used_cache_entries()
+    latex2svgextra.configure_format(os.path.dirname(os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], state.doxyfile['M_MATH_CACHE_FILE'])) if state.doxyfile['M_MATH_CACHE_FILE'] else None)
+    pygmentsextra.unpickle_cache(code_cache_file)
+    pygmentsextra.record_used_cache_entries()
+    dot2svg.unpickle_cache(dot_cache_file)
+    dot2svg.record_used_cache_entries()
+
+# Elements without children are tested with `not element` all over the place
+@xmlbackend.ignore_truth_testing_warnings()
+def _render_xml_in_worker(file):
+    record = _render_xml_and_collect(_worker.state, _worker.env, file, _worker.html_output, _worker.index_pages)
+    # So the parent knows whether the shared render cache needs evicting
+    record.rendercache_added = rendercache.take_added()
+    return record
+
+# Incremental builds. The manifest remembers, for every input file, hash of
+# its contents, signatures of all compounds and includes looked up while
+# rendering it, files it produced and what it added to global state. If
+# neither of those changed and the global signature (configuration,
+# templates, this script) is the same, the file doesn't need to be rendered
+# again. The manifest is versioned the same way as the math cache.
+_manifest_version = 2
+
+def _file_hash(path) -> bytes:
+    with open(path, 'rb') as f:
+        return sha1(f.read()).digest()
+
+def _build_signature(state: State, templates) -> bytes:
+    hash = sha1(repr((_manifest_version, sorted(state.doxyfile.items()), [(i.id, i.name) for i in state.examples])).encode('utf-8'))
+    hash.update(_file_hash(os.path.realpath(__file__)))
+    template_paths = [templates]
+    if templates != default_templates: template_paths += [default_templates]
+    for path in template_paths:
+        for file in sorted(glob.glob(os.path.join(path, '**'), recursive=True)):
+            if not os.path.isfile(file): continue
+            hash.update(file.encode('utf-8'))
+            hash.update(_file_hash(file))
+    return hash.digest()
+
+# Only plain values are hashed, as repr() of an object (such as a template
+# parameter) contains its address, which would make the signature different on
+# every run
+def _compound_signature(state: State, id):
+    compound = dict.get(state.compounds, id)
+    if compound is None: return None
+    templates = getattr(compound, 'templates', None)
+    return sha1(repr((
+        compound.kind, compound.name, getattr(compound, 'leaf_name', None),
+        compound.url, compound.brief, compound.brief_is_page_independent,
+        compound.has_details, compound.is_deprecated, compound.is_final,
+        compound.children, compound.parent,
+        [(i.type, i.name, i.default, i.description) for i in templates] if templates else templates
+    )).encode('utf-8')).digest()
+
+def _manifest_entry_up_to_date(state: State, entry, xml_hash, html_output) -> bool:
+    if entry.xml_hash != xml_hash: return False
+    for output in entry.outputs:
+        if not os.path.exists(os.path.join(html_output, output)): return False
+    for id, signature in entry.compounds.items():
+        if _compound_signature(state, id) != signature: return False
+    for file, id in entry.includes.items():
+        if dict.get(state.includes, file) != id: return False
+    return True
+
+def load_manifest(file, signature):
+    if not file or not os.path.exists(file): return {}
+
+    with open(file, 'rb') as f:
+        version, manifest_signature, entries = pickle.load(f)
+    if version != _manifest_version or manifest_signature != signature: return {}
+    return entries
+
+def save_manifest(file, signature, entries):
+    with open(file, 'wb') as f:
+        pickle.dump((_manifest_version, signature, entries), f)
+
+# Cache of the metadata pre-pass. For every XML file it remembers its size,
+# modification time and hash together with what extract_metadata() produced
+# from it. Files with the same size and modification time are not read at
+# all, files where only the modification time differs (such as when Doxygen
+# regenerates all XML output) are only hashed. The whole cache is invalidated
+# when the Doxyfile or this script changes.
+_metadata_cache_version = 2
+
+def _metadata_signature(state: State) -> bytes:
+    hash = sha1(repr((_metadata_cache_version, sorted(state.doxyfile.items()))).encode('utf-8'))
+    hash.update(_file_hash(os.path.realpath(__file__)))
+    return hash.digest()
+
+def load_metadata_cache(file, signature):
+    if not file or not os.path.exists(file): return {}
+
+    with open(file, 'rb') as f:
+        version, cache_signature, entries = pickle.load(f)
+    if version != _metadata_cache_version or cache_signature != signature: return {}
+    return entries
+
+def save_metadata_cache(file, signature, entries):
+    with open(file, 'wb') as f:
+        pickle.dump((_metadata_cache_version, signature, entries), f)
+
+def extract_metadata_or_reuse(state: State, xml, cache):
+    stat = os.stat(xml)
+    hash = None
+    entry = cache.get(os.path.basename(xml))
+    if entry and entry.size == stat.st_size:
+        if entry.mtime != stat.st_mtime_ns:
+            hash = _file_hash(xml)
+            if hash == entry.hash: entry.mtime = stat.st_mtime_ns
+        if entry.mtime == stat.st_mtime_ns:
+            logging.debug("Reusing cached metadata for {}".format(os.path.basename(xml)))
+            # The compound gets modified by postprocess_state(), so put a
+            # copy into the state to keep the cached one pristine
+            if entry.compound: state.compounds[entry.compound.id] = copy.copy(entry.compound)
+            state.examples += entry.examples
+            state.images += entry.images
+            latex2svgextra.mark_cache_entries_used(entry.math)
+            pygmentsextra.mark_cache_entries_used(entry.code)
+            dot2svg.mark_cache_entries_used(entry.dot)
+            return entry
+
+    examples_count = len(state.examples)
+    images_count = len(state.images)
+    latex2svgextra.take_used_cache_entries()
+    pygmentsextra.take_used_cache_entries()
+    dot2svg.take_used_cache_entries()
+    compound = extract_metadata(state, xml)
+
+    entry = Empty()
+    entry.size = stat.st_size
+    entry.mtime = stat.st_mtime_ns
+    entry.hash = hash or _file_hash(xml)
+    entry.compound = copy.copy(compound)
+    entry.examples = state.examples[examples_count:]
+    entry.images = state.images[images_count:]
+    entry.math = list(latex2svgextra.take_used_cache_entries().keys())
+    entry.code = list(pygmentsextra.take_used_cache_entries().keys())
+    entry.dot = list(dot2svg.take_used_cache_entries().keys())
+    return entry
+
+@xmlbackend.ignore_truth_testing_warnings()
+def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_pages=default_index_pages, search_add_lookahead_barriers=True, search_merge_subtrees=True, search_merge_prefixes=True, sort_globbed_files=False, jobs=1, xml_tree_cache_size=default_xml_tree_cache_size, incremental=False, xml_streaming_threshold=default_xml_streaming_threshold, template_cache=True, write_if_changed=False, output_threads=0):
+    global _output_writer
 
-def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_pages=default_index_pages, search_add_lookahead_barriers=True, search_merge_subtrees=True, search_merge_prefixes=True, sort_globbed_files=False):
     state = State()
     state.basedir = os.path.dirname(doxyfile)
+    state.write_if_changed = write_if_changed
+    state.xml_streaming_threshold = xml_streaming_threshold*1024*1024
 
     parse_doxyfile(state, doxyfile)
+
+    # Precompressed siblings of the output files, zero level means disabled
+    if state.doxyfile['M_PRECOMPRESS_GZIP']:
+        state.precompress += [('.gz', state.doxyfile['M_PRECOMPRESS_GZIP'])]
+    if state.doxyfile['M_PRECOMPRESS_BROTLI']:
+        if not brotli:
+            logging.fatal("{}: M_PRECOMPRESS_BROTLI needs the brotli module, install it or disable the option".format(doxyfile))
+            raise ImportError("brotli")
+        state.precompress += [('.br', state.doxyfile['M_PRECOMPRESS_BROTLI'])]
+
     xml_input = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], state.doxyfile['XML_OUTPUT'])
     xml_files_metadata = [os.path.join(xml_input, f) for f in glob.glob(os.path.join(xml_input, "*.xml"))]
     xml_files = [os.path.join(xml_input, f) for f in glob.glob(os.path.join(xml_input, wildcard))]
@@ -3747,6 +4533,23 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
     else:
         latex2svgextra.unpickle_cache(None)
 
+    # If the cache is enabled, the math preamble is precompiled next to it
+    latex2svgextra.configure_format(os.path.dirname(math_cache_file) if state.doxyfile['M_MATH_CACHE_FILE'] else None)
+
+    # The same for the code highlighting cache
+    code_cache_file = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], state.doxyfile['M_CODE_CACHE_FILE'])
+    if state.doxyfile['M_CODE_CACHE_FILE'] and os.path.exists(code_cache_file):
+        pygmentsextra.unpickle_cache(code_cache_file)
+    else:
+        pygmentsextra.unpickle_cache(None)
+
+    # And for the graph rendering cache
+    dot_cache_file = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], state.doxyfile['M_DOT_CACHE_FILE'])
+    if state.doxyfile['M_DOT_CACHE_FILE'] and os.path.exists(dot_cache_file):
+        dot2svg.unpickle_cache(dot_cache_file)
+    else:
+        dot2svg.unpickle_cache(None)
+
     # Configure graphviz/dot
     dot2svg.configure(state.doxyfile['DOT_FONTNAME'], state.doxyfile['DOT_FONTSIZE'])
 
@@ -3757,19 +4560,17 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
     if not os.path.exists(html_output):
         os.makedirs(html_output)
 
-    # If custom template dir was supplied, use the default template directory
-    # as a fallback
-    template_paths = [templates]
-    if templates != default_templates: template_paths += [default_templates]
-    env = Environment(loader=FileSystemLoader(template_paths),
-                      trim_blocks=True, lstrip_blocks=True, enable_async=True)
+    # Template cache is either False (disabled), True (a directory next to
+    # the other caches in the output directory) or a path to a cache
+    # directory
+    if template_cache is True:
+        template_cache = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], 'm.templates.cache')
+    if template_cache:
+        os.makedirs(template_cache, exist_ok=True)
+    else:
+        template_cache = None
 
-    # Filter to return file basename or the full URL, if absolute
-    def basename_or_url(path):
-        if urllib.parse.urlparse(path).netloc: return path
-        return os.path.basename(path)
-    env.filters['basename_or_url'] = basename_or_url
-    env.filters['urljoin'] = urllib.parse.urljoin
+    env = make_environment(templates, template_cache)
 
     # Do a pre-pass and gather:
     # - brief descriptions of all classes, namespaces, dirs and files because
@@ -3778,51 +4579,129 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
     #   linking pages
     # - get URLs of namespace, classe, file docs and pages so we can link to
     #   them from breadcrumb navigation
+    #
+    # The parsed XML trees are kept for the rendering pass, up to given memory
+    # budget. Not done for parallel rendering, as sending the trees to worker
+    # processes would be slower than parsing them again there.
+    if jobs <= 1:
+        state.xml_trees_to_keep = set(xml_files)
+        state.xml_trees_budget = xml_tree_cache_size*1024*1024
+    #
+    # If the metadata cache is enabled, results for files that didn't change
+    # since the last run are taken from there.
     file: str
-    for file in xml_files_metadata:
-        extract_metadata(state, file)
+    if state.doxyfile['M_METADATA_CACHE_FILE']:
+        metadata_cache_file = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], state.doxyfile['M_METADATA_CACHE_FILE'])
+        metadata_signature = _metadata_signature(state)
+        metadata_cache = load_metadata_cache(metadata_cache_file, metadata_signature)
+        latex2svgextra.record_used_cache_entries()
+        pygmentsextra.record_used_cache_entries()
+        dot2svg.record_used_cache_entries()
+        entries = {}
+        for file in xml_files_metadata:
+            entries[os.path.basename(file)] = extract_metadata_or_reuse(state, file, metadata_cache)
+        save_metadata_cache(metadata_cache_file, metadata_signature, entries)
+    else:
+        for file in xml_files_metadata:
+            extract_metadata(state, file)
 
     postprocess_state(state)
 
-    for file in xml_files:
-        if os.path.basename(file) == 'index.xml':
-            parsed = parse_index_xml(state, file)
-
-            for i in index_pages:
-                file = '{}.html'.format(i)
-
-                template = env.get_template(file)
-                rendered = template.render(index=parsed.index,
-                    DOXYGEN_VERSION=parsed.version,
-                    FILENAME=file,
-                    **state.doxyfile)
-
-                output = os.path.join(html_output, file)
-                with open(output, 'wb') as f:
-                    f.write(rendered.encode('utf-8'))
-                    # Add back a trailing newline so we don't need to bother
-                    # with patching test files to include a trailing newline to
-                    # make Git happy
-                    # TODO could keep_trailing_newline fix this better?
-                    f.write(b'\n')
-        else:
-            parsed = parse_xml(state, file)
-            if not parsed: continue
+    # For incremental builds, load the manifest from the previous run, check
+    # which files are up to date and reuse what they contributed to global
+    # state. The index.xml is always processed, as it depends on everything.
+    records = {}
+    files_to_render = []
+    if incremental:
+        signature = _build_signature(state, templates)
+        manifest_file = os.path.join(state.basedir, state.doxyfile['OUTPUT_DIRECTORY'], 'm.incremental.cache')
+        manifest = load_manifest(manifest_file, signature)
+        state.compounds = RecordingDict(state.compounds)
+        state.includes = RecordingDict(state.includes)
+        latex2svgextra.record_used_cache_entries()
+        pygmentsextra.record_used_cache_entries()
+        dot2svg.record_used_cache_entries()
+
+        xml_hashes = {}
+        for file in xml_files:
+            xml_hashes[file] = _file_hash(file)
+            entry = manifest.get(os.path.basename(file))
+            if os.path.basename(file) == 'index.xml' or not entry or not _manifest_entry_up_to_date(state, entry, xml_hashes[file], html_output):
+                files_to_render += [file]
+                continue
 
-            template = env.get_template('{}.html'.format(parsed.compound.kind))
-            rendered = template.render(compound=parsed.compound,
-                DOXYGEN_VERSION=parsed.version,
-                FILENAME=parsed.compound.url,
-                **state.doxyfile)
+            logging.debug("{} is up to date, skipping".format(os.path.basename(file)))
+            latex2svgextra.mark_cache_entries_used(entry.math)
+            pygmentsextra.mark_cache_entries_used(entry.code)
+            dot2svg.mark_cache_entries_used(entry.dot)
+            state.xml_trees.pop(file, None)
+            records[file] = entry
+    else:
+        files_to_render = xml_files
+
+    # Render all formulas that the files need and that aren't cached yet
+    math_cache_entries = render_formulas(files_to_render)
+
+    # Write output files from background threads, if requested
+    if output_threads:
+        _output_writer = OutputWriter(output_threads, queue_size=16*output_threads)
+
+    # Render all files. The per-file work is independent after the pre-pass,
+    # so it can be fanned out to worker processes. Results are collected in
+    # the original order so the output (and search data) is the same as with
+    # serial processing.
+    if jobs > 1:
+        logging.debug("rendering {} files using {} jobs".format(len(files_to_render), jobs))
+
+        # The workers load the math, code and graph cache on their own, same
+        # as above, and get the formulas rendered above in addition
+        worker_math_cache_file = math_cache_file if state.doxyfile['M_MATH_CACHE_FILE'] and os.path.exists(math_cache_file) else None
+        worker_code_cache_file = code_cache_file if state.doxyfile['M_CODE_CACHE_FILE'] and os.path.exists(code_cache_file) else None
+        worker_dot_cache_file = dot_cache_file if state.doxyfile['M_DOT_CACHE_FILE'] and os.path.exists(dot_cache_file) else None
+        with multiprocessing.Pool(jobs, initializer=_init_worker,
+            initargs=(state, xmlbackend.backend, templates, template_cache, html_output, index_pages, worker_math_cache_file, math_cache_entries, worker_code_cache_file, worker_dot_cache_file)) as pool:
+            for file, record in zip(files_to_render, pool.imap(_render_xml_in_worker, files_to_render)):
+                latex2svgextra.merge_cache_entries(record.math)
+                pygmentsextra.merge_cache_entries(record.code)
+                dot2svg.merge_cache_entries(record.dot)
+                rendercache.merge_added(record.rendercache_added)
+                records[file] = record
+    else:
+        # Images referenced from the pre-pass need to be preserved
+        images = state.images
+        for file in files_to_render:
+            records[file] = _render_xml_and_collect(state, env, file, html_output, index_pages)
+        state.search = []
+        state.images = images
 
-            output = os.path.join(html_output, parsed.compound.url)
-            with open(output, 'wb') as f:
-                f.write(rendered.encode('utf-8'))
-                # Add back a trailing newline so we don't need to bother with
-                # patching test files to include a trailing newline to make Git
-                # happy
-                # TODO could keep_trailing_newline fix this better?
-                f.write(b'\n')
+    for file in xml_files:
+        state.search += records[file].search
+        state.images += records[file].images
+
+    # Wait until all rendered files are written before going further, to
+    # surface any errors before the manifest is saved
+    if _output_writer: _output_writer.flush()
+
+    # Save the manifest for the next incremental run, remembering signatures
+    # of everything the rendered files depended on
+    if incremental:
+        entries = {}
+        for file in xml_files:
+            record = records[file]
+            if file in files_to_render:
+                entry = Empty()
+                entry.xml_hash = xml_hashes[file]
+                entry.outputs = record.outputs
+                entry.compounds = {id: _compound_signature(state, id) for id in record.compounds}
+                entry.includes = {file: dict.get(state.includes, file) for file in record.includes}
+                entry.search = record.search
+                entry.images = record.images
+                entry.math = list(record.math.keys())
+                entry.code = list(record.code.keys())
+                entry.dot = list(record.dot.keys())
+                record = entry
+            entries[os.path.basename(file)] = record
+        save_manifest(manifest_file, signature, entries)
 
     # Empty index page in case no mainpage documentation was provided so
     # there's at least some entrypoint. Doxygen version is not set in this
@@ -3840,26 +4719,27 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
             DOXYGEN_VERSION='0',
             FILENAME='index.html',
             **state.doxyfile)
-        output = os.path.join(html_output, 'index.html')
-        with open(output, 'wb') as f:
-            f.write(rendered.encode('utf-8'))
-            # Add back a trailing newline so we don't need to bother with
-            # patching test files to include a trailing newline to make Git
-            # happy
-            # TODO could keep_trailing_newline fix this better?
-            f.write(b'\n')
+        write_rendered(state, os.path.join(html_output, 'index.html'), rendered)
 
     if not state.doxyfile['M_SEARCH_DISABLED']:
         logging.debug("building search data for {} symbols".format(len(state.search)))
 
-        data = build_search_data(state, add_lookahead_barriers=search_add_lookahead_barriers, merge_subtrees=search_merge_subtrees, merge_prefixes=search_merge_prefixes)
+        # With sharding, the main file is just a manifest and the shards are
+        # downloaded on demand
+        if state.doxyfile['M_SEARCH_SHARDED']:
+            data, shards = build_search_data_sharded(state, add_lookahead_barriers=search_add_lookahead_barriers, merge_subtrees=search_merge_subtrees, merge_prefixes=search_merge_prefixes)
+            for char, shard in shards.items():
+                if state.doxyfile['M_SEARCH_DOWNLOAD_BINARY']:
+                    write_output(state, os.path.join(html_output, "searchdata-{:02x}.bin".format(char)), shard)
+                else:
+                    write_output(state, os.path.join(html_output, "searchdata-{:02x}.js".format(char)), base85encode_search_shard(char, shard))
+        else:
+            data = build_search_data(state, add_lookahead_barriers=search_add_lookahead_barriers, merge_subtrees=search_merge_subtrees, merge_prefixes=search_merge_prefixes)
 
         if state.doxyfile['M_SEARCH_DOWNLOAD_BINARY']:
-            with open(os.path.join(html_output, "searchdata.bin"), 'wb') as f:
-                f.write(data)
+            write_output(state, os.path.join(html_output, "searchdata.bin"), data)
         else:
-            with open(os.path.join(html_output, "searchdata.js"), 'wb') as f:
-                f.write(base85encode_search_data(data))
+            write_output(state, os.path.join(html_output, "searchdata.js"), base85encode_search_data(data))
 
         # OpenSearch metadata, in case we have the base URL
         if state.doxyfile['M_SEARCH_BASE_URL']:
@@ -3867,14 +4747,7 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
 
             template = env.get_template('opensearch.xml')
             rendered = template.render(**state.doxyfile)
-            output = os.path.join(html_output, 'opensearch.xml')
-            with open(output, 'wb') as f:
-                f.write(rendered.encode('utf-8'))
-                # Add back a trailing newline so we don't need to bother with
-                # patching test files to include a trailing newline to make Git
-                # happy
-                # TODO could keep_trailing_newline fix this better?
-                f.write(b'\n')
+            write_rendered(state, os.path.join(html_output, 'opensearch.xml'), rendered)
 
     # Copy all referenced files
     for i in state.images + state.doxyfile['HTML_EXTRA_STYLESHEET'] + state.doxyfile['HTML_EXTRA_FILES'] + ([state.doxyfile['M_FAVICON'][0]] if state.doxyfile['M_FAVICON'] else []) + ([] if state.doxyfile['M_SEARCH_DISABLED'] else ['search.js']):
@@ -3890,11 +4763,23 @@ def run(doxyfile, templates=default_templates, wildcard=default_wildcard, index_
             i = os.path.join(os.path.dirname(os.path.realpath(__file__)), i)
 
         logging.debug("copying {} to output".format(i))
-        shutil.copy(i, os.path.join(html_output, os.path.basename(i)))
+        copy_output(state, i, os.path.join(html_output, os.path.basename(i)))
+
+    if _output_writer:
+        _output_writer.shutdown()
+        _output_writer = None
 
     # Save updated math cache file
     if state.doxyfile['M_MATH_CACHE_FILE']:
         latex2svgextra.pickle_cache(math_cache_file)
+    if state.doxyfile['M_CODE_CACHE_FILE']:
+        pygmentsextra.pickle_cache(code_cache_file)
+    if state.doxyfile['M_DOT_CACHE_FILE']:
+        dot2svg.pickle_cache(dot_cache_file)
+
+    # Evict least recently used entries from the shared render cache, if
+    # anything was put there by this process or the --jobs workers
+    rendercache.evict()
 
 if __name__ == '__main__': # pragma: no cover
     parser = argparse.ArgumentParser()
@@ -3907,6 +4792,14 @@ if __name__ == '__main__': # pragma: no cover
     parser.add_argument('--search-no-lookahead-barriers', help="don't insert search lookahead barriers", action='store_true')
     parser.add_argument('--search-no-prefix-merging', help="don't merge search result prefixes", action='store_true')
     parser.add_argument('--sort-globbed-files', help="sort globbed files for better reproducibility", action='store_true')
+    parser.add_argument('--jobs', help="number of parallel rendering jobs", type=int, default=1)
+    parser.add_argument('--incremental', help="render only files whose inputs changed since the previous run", action='store_true')
+    parser.add_argument('--xml-tree-cache-size', help="size of XML files, in MB, to keep parsed between the metadata and rendering pass", type=int, default=default_xml_tree_cache_size)
+    parser.add_argument('--template-cache-dir', help="directory to cache compiled templates in. Defaults to m.templates.cache in the output directory.")
+    parser.add_argument('--no-template-cache', help="don't cache compiled templates", action='store_true')
+    parser.add_argument('--xml-streaming-threshold', help="size of a XML file, in MB, above which it's parsed in a streaming way to save memory. Set to 0 to disable.", type=int, default=default_xml_streaming_threshold)
+    parser.add_argument('--output-threads', help="number of threads writing output files in the background", type=int, default=0)
+    parser.add_argument('--write-if-changed', help="don't rewrite output files that didn't change", action='store_true')
     parser.add_argument('--debug', help="verbose debug output", action='store_true')
     args = parser.parse_args()
 
@@ -3922,4 +4815,4 @@ if __name__ == '__main__': # pragma: no cover
         logging.debug("running Doxygen on {}".format(args.doxyfile))
         subprocess.run(["doxygen", doxyfile], cwd=os.path.dirname(doxyfile))
 
-    run(doxyfile, os.path.abspath(args.templates), args.wildcard, args.index_pages, search_merge_subtrees=not args.search_no_subtree_merging, search_add_lookahead_barriers=not args.search_no_lookahead_barriers, search_merge_prefixes=not args.search_no_prefix_merging)
+    run(doxyfile, os.path.abspath(args.templates), args.wildcard, args.index_pages, search_merge_subtrees=not args.search_no_subtree_merging, search_add_lookahead_barriers=not args.search_no_lookahead_barriers, search_merge_prefixes=not args.search_no_prefix_merging, jobs=args.jobs, xml_tree_cache_size=args.xml_tree_cache_size, incremental=args.incremental, xml_streaming_threshold=args.xml_streaming_threshold, template_cache=False if args.no_template_cache else args.template_cache_dir or True, write_if_changed=args.write_if_changed, output_threads=args.output_threads)
@@ -28,6 +28,7 @@ import argparse
 import copy
 import docutils
 import enum
+import filecmp
 import urllib.parse
 import html
 import importlib
@@ -86,6 +87,9 @@ default_config = {
 
     'PYBIND11_COMPATIBILITY': False,
 
+    'TEMPLATE_CACHE': None,
+    'WRITE_IF_CHANGED': False,
+
     'SEARCH_DISABLED': False,
     'SEARCH_DOWNLOAD_BINARY': False,
     'SEARCH_HELP': """.. raw:: html
@@ -347,16 +351,33 @@ def extract_annotation(state: State, annotation) -> str:
     if annotation.__module__ == 'typing': return map_name_prefix(state, str(annotation))
     return map_name_prefix(state, extract_type(annotation))
 
+# If WRITE_IF_CHANGED is set, files that already exist with the same contents
+# are not written again, preserving their modification time. Behaves the same
+# as _write_output() and _copy_output() in doxygen.py, except that there are no
+# precompressed siblings and no background writer threads. Keep them in sync.
+def write_output(config, output, data: bytes):
+    if config['WRITE_IF_CHANGED'] and os.path.exists(output) and os.path.getsize(output) == len(data):
+        with open(output, 'rb') as f:
+            if f.read() == data: return
+
+    with open(output, 'wb') as f:
+        f.write(data)
+
+def write_rendered(config, output, rendered: str):
+    # Add back a trailing newline so we don't need to bother with patching
+    # test files to include a trailing newline to make Git happy
+    # TODO could keep_trailing_newline fix this better?
+    write_output(config, output, rendered.encode('utf-8') + b'\n')
+
+def copy_output(config, source, output):
+    if config['WRITE_IF_CHANGED'] and os.path.exists(output) and filecmp.cmp(source, output, shallow=False): return
+
+    shutil.copy(source, output)
+
 def render(config, template: str, page, env: jinja2.Environment):
     template = env.get_template(template)
     rendered = template.render(page=page, FILENAME=page.url, **config)
-    with open(os.path.join(config['OUTPUT'], page.url), 'wb') as f:
-        f.write(rendered.encode('utf-8'))
-        # Add back a trailing newline so we don't need to bother with
-        # patching test files to include a trailing newline to make Git
-        # happy
-        # TODO could keep_trailing_newline fix this better?
-        f.write(b'\n')
+    write_rendered(config, os.path.join(config['OUTPUT'], page.url), rendered)
 
 def extract_module_doc(state: State, path: List[str], module):
     assert inspect.ismodule(module)
@@ -1052,7 +1073,13 @@ def run(basedir, config, templates):
     # Prepare Jinja environment
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(templates), trim_blocks=True,
-        lstrip_blocks=True, enable_async=True)
+        lstrip_blocks=True)
+    # Cache compiled templates so they don't need to be compiled again on
+    # every run. Jinja checks the template source to decide whether the
+    # cached version is up-to-date.
+    if config['TEMPLATE_CACHE']:
+        os.makedirs(config['TEMPLATE_CACHE'], exist_ok=True)
+        env.bytecode_cache = jinja2.FileSystemBytecodeCache(config['TEMPLATE_CACHE'], '__m.css_python_%s.cache')
     # Filter to return file basename or the full URL, if absolute
     def basename_or_url(path):
         if urllib.parse.urlparse(path).netloc: return path
@@ -1144,13 +1171,7 @@ def run(basedir, config, templates):
     for file in ['modules.html', 'classes.html', 'pages.html']:
         template = env.get_template(file)
         rendered = template.render(index=index, FILENAME=file, **config)
-        with open(os.path.join(config['OUTPUT'], file), 'wb') as f:
-            f.write(rendered.encode('utf-8'))
-            # Add back a trailing newline so we don't need to bother with
-            # patching test files to include a trailing newline to make Git
-            # happy
-            # TODO could keep_trailing_newline fix this better?
-            f.write(b'\n')
+        write_rendered(config, os.path.join(config['OUTPUT'], file), rendered)
 
     # Create index.html if it was not provided by the user
     if 'index.rst' not in [os.path.basename(i) for i in config['INPUT_PAGES']]:
@@ -1175,7 +1196,7 @@ def run(basedir, config, templates):
             i = os.path.join(os.path.dirname(os.path.realpath(__file__)), i)
 
         logging.debug("copying %s to output", i)
-        shutil.copy(i, os.path.join(config['OUTPUT'], os.path.basename(i)))
+        copy_output(config, i, os.path.join(config['OUTPUT'], os.path.basename(i)))
 
     # Call all registered finalization hooks for the first time
     for hook in state.hooks_post_run: hook()
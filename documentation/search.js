@@ -31,6 +31,19 @@ var Search = {
     symbolCount: 0,
     maxResults: 0,
 
+    /* Field sizes of given search data. Version 0 has 16-bit result IDs,
+       23-bit trie child offsets with the lookahead barrier and char in the top
+       bits, and 24-bit result map offsets with flags in the top byte. Version
+       1 can have 32-bit result IDs and offsets, with the char and flags being
+       after the offset. */
+    dataVersion: 0,
+    resultIdSize: 2,
+    trieChildSize: 4,
+    trieOffsetMask: 0x007fffff,
+    trieBarrierMask: 0x00800000,
+    mapEntrySize: 4,
+    mapOffsetMask: 0x00ffffff,
+
     /* Always contains at least the root node offset and then one node offset
        per entered character */
     searchString: '',
@@ -49,71 +62,192 @@ var Search = {
        onkeypress event and reset after each oninput event. */
     autocompleteNextInputEvent: false,
 
-    init: function(buffer, maxResults) {
+    /* Sharded search data. If set, for every first byte of the search string
+       that has some results contains either null if the shard wasn't
+       requested yet, false if it's being downloaded or the parsed shard. Only
+       one shard is used for searching at a time. */
+    shards: null,
+    shardUrl: '',
+    currentShard: null,
+
+    /* If set, the search data are in a Web Worker running this same file,
+       see startWorker(). The main thread then only sends search requests to
+       it and renders the replies, ignoring replies to anything else than the
+       last request. */
+    worker: null,
+    workerRequest: 0,
+
+    /* In the worker, a search request waiting for a shard to download */
+    pendingRequest: null,
+
+    /* External search engine URL with a {query} placeholder, taken from the
+       search-external link on the main thread. The link is pointed to the
+       search string if nothing is found, externalSearchHref is what it was
+       last set to. */
+    externalSearchUrl: '',
+    externalSearchHref: '',
+
+    init: function(buffer, maxResults, shardUrl) {
+        let view = new DataView(buffer);
+
+        /* Sharded data, the file is just a manifest with the total symbol
+           count, data size and list of shards. The shards get downloaded when
+           needed. */
+        if(view.byteLength >= 4 &&
+           view.getUint8(0) == 'M'.charCodeAt(0) &&
+           view.getUint8(1) == 'C'.charCodeAt(0) &&
+           view.getUint8(2) == 'M'.charCodeAt(0)) {
+            if(view.byteLength < 14 || view.byteLength < 14 + view.getUint16(12, true)) {
+                console.error("Search data too short");
+                return false;
+            }
+
+            if(view.getUint8(3) != 0) {
+                console.error("Invalid search data version");
+                return false;
+            }
+
+            this.shards = {};
+            for(let i = 0; i != view.getUint16(12, true); ++i)
+                this.shards[view.getUint8(14 + i)] = null;
+            this.shardUrl = shardUrl;
+            this.currentShard = null;
+            this.trie = null;
+            this.map = null;
+            this.dataSize = view.getUint32(8, true);
+            this.symbolCount = view.getUint32(4, true);
+            this.searchStack = [];
+
+        /* Everything in a single file */
+        } else {
+            let data = this.parse(buffer);
+            if(!data) return false;
+
+            this.shards = null;
+            this.use(data);
+            this.dataSize = buffer.byteLength;
+            this.symbolCount = data.symbolCount;
+        }
+
+        /* Set initial properties */
+        this.maxResults = maxResults ? maxResults : 100;
+        this.searchString = '';
+
+        /* istanbul ignore if */
+        if(typeof document !== 'undefined') this.ready();
+
+        return true;
+    },
+
+    /* Enables the search input once the data are loaded, either here or in
+       the worker */
+    ready: /* istanbul ignore next */ function() {
+        document.getElementById('search-symbolcount').innerHTML =
+            this.symbolCount + " symbols (" + Math.round(this.dataSize/102.4)/10 + " kB)";
+        document.getElementById('search-input').disabled = false;
+        document.getElementById('search-input').placeholder = "Type something here …";
+        document.getElementById('search-input').focus();
+
+        /* Search for the input value (there might be something already,
+           for example when going back in the browser) */
+        let value = document.getElementById('search-input').value;
+
+        /* Otherwise check the GET parameters for `q` and fill the input
+           with that */
+        if(!value.length) {
+            var args = decodeURIComponent(window.location.search.substr(1)).trim().split('&');
+            for(var i = 0; i != args.length; ++i) {
+                if(args[i].substring(0, 2) != 'q=') continue;
+
+                value = document.getElementById('search-input').value = args[i].substring(2);
+                break;
+            }
+        }
+
+        if(value.length) Search.searchAndRender(value);
+    },
+
+    /* Parses search data, returning the trie, result map and their field
+       sizes, or null on error */
+    parse: function(buffer) {
         let view = new DataView(buffer);
 
         /* The file is too short to contain at least the headers */
         if(view.byteLength < 20) {
             console.error("Search data too short");
-            return false;
+            return null;
         }
 
         if(view.getUint8(0) != 'M'.charCodeAt(0) ||
            view.getUint8(1) != 'C'.charCodeAt(0) ||
            view.getUint8(2) != 'S'.charCodeAt(0)) {
             console.error("Invalid search data signature");
-            return false;
+            return null;
         }
 
-        if(view.getUint8(3) != 0) {
+        /* Version 0 has a fixed layout, version 1 specifies sizes of result
+           IDs, trie and result map offsets in the header */
+        let headerSize, symbolCount, resultIdSize, trieOffsetSize, mapOffsetSize;
+        if(view.getUint8(3) == 0) {
+            headerSize = 10;
+            symbolCount = view.getUint16(4, true);
+            resultIdSize = 2;
+            trieOffsetSize = 3;
+            mapOffsetSize = 3;
+        } else if(view.getUint8(3) == 1) {
+            headerSize = 15;
+            resultIdSize = view.getUint8(4);
+            trieOffsetSize = view.getUint8(5);
+            mapOffsetSize = view.getUint8(6);
+            symbolCount = view.getUint32(7, true);
+        } else {
             console.error("Invalid search data version");
-            return false;
+            return null;
         }
 
-        /* Separate the data into the trie and the result map */
-        let mapOffset = view.getUint32(6, true);
-        this.trie = new DataView(buffer, 10, mapOffset - 10);
-        this.map = new DataView(buffer, mapOffset);
+        if((resultIdSize != 2 && resultIdSize != 4) ||
+           (trieOffsetSize != 3 && trieOffsetSize != 4) ||
+           (mapOffsetSize != 3 && mapOffsetSize != 4)) {
+            console.error("Invalid search data field sizes");
+            return null;
+        }
 
-        /* Set initial properties */
-        this.dataSize = buffer.byteLength;
-        this.symbolCount = view.getUint16(4, true);
-        this.maxResults = maxResults ? maxResults : 100;
+        /* Separate the data into the trie and the result map. The topmost bit
+           of a trie offset is the lookahead barrier. Offsets are always read
+           as 32-bit and masked. */
+        let mapOffset = view.getUint32(headerSize - 4, true);
+        return {
+            trie: new DataView(buffer, headerSize, mapOffset - headerSize),
+            map: new DataView(buffer, mapOffset),
+            symbolCount: symbolCount,
+            dataVersion: view.getUint8(3),
+            resultIdSize: resultIdSize,
+            trieChildSize: trieOffsetSize + 1,
+            trieBarrierMask: trieOffsetSize == 3 ? 0x00800000 : 0x80000000,
+            trieOffsetMask: trieOffsetSize == 3 ? 0x007fffff : 0x7fffffff,
+            mapEntrySize: mapOffsetSize + 1,
+            mapOffsetMask: mapOffsetSize == 3 ? 0x00ffffff : 0xffffffff
+        };
+    },
+
+    /* Switches to search data returned from parse() */
+    use: function(data) {
+        this.trie = data.trie;
+        this.map = data.map;
+        this.dataVersion = data.dataVersion;
+        this.resultIdSize = data.resultIdSize;
+        this.trieChildSize = data.trieChildSize;
+        this.trieBarrierMask = data.trieBarrierMask;
+        this.trieOffsetMask = data.trieOffsetMask;
+        this.mapEntrySize = data.mapEntrySize;
+        this.mapOffsetMask = data.mapOffsetMask;
         this.searchString = '';
         this.searchStack = [this.trie.getUint32(0, true)];
-
-        /* istanbul ignore if */
-        if(typeof document !== 'undefined') {
-            document.getElementById('search-symbolcount').innerHTML =
-                this.symbolCount + " symbols (" + Math.round(this.dataSize/102.4)/10 + " kB)";
-            document.getElementById('search-input').disabled = false;
-            document.getElementById('search-input').placeholder = "Type something here …";
-            document.getElementById('search-input').focus();
-
-            /* Search for the input value (there might be something already,
-               for example when going back in the browser) */
-            let value = document.getElementById('search-input').value;
-
-            /* Otherwise check the GET parameters for `q` and fill the input
-               with that */
-            if(!value.length) {
-                var args = decodeURIComponent(window.location.search.substr(1)).trim().split('&');
-                for(var i = 0; i != args.length; ++i) {
-                    if(args[i].substring(0, 2) != 'q=') continue;
-
-                    value = document.getElementById('search-input').value = args[i].substring(2);
-                    break;
-                }
-            }
-
-            if(value.length) Search.searchAndRender(value);
-        }
-
-        return true;
     },
 
-    download: /* istanbul ignore next */ function(url) {
-        var req = window.XDomainRequest ? new XDomainRequest() : new XMLHttpRequest();
+    /* Not using window.XDomainRequest, as there's no window in a worker */
+    downloadBuffer: /* istanbul ignore next */ function(url, callback) {
+        var req = typeof XDomainRequest !== 'undefined' ? new XDomainRequest() : new XMLHttpRequest();
         if(!req) return;
 
         req.open("GET", url, true);
@@ -121,11 +255,71 @@ var Search = {
         req.onreadystatechange = function() {
             if(req.readyState != 4) return;
 
-            Search.init(req.response);
+            callback(req.response);
         }
         req.send();
     },
 
+    /* With a worker, it downloads the data on its own */
+    download: /* istanbul ignore next */ function(url) {
+        if(this.worker) {
+            this.worker.postMessage({type: 'download', url: url});
+            return;
+        }
+
+        this.downloadBuffer(url, function(buffer) {
+            Search.init(buffer, undefined, url.replace(/\.bin$/, '-{}.bin'));
+        });
+    },
+
+    /* Binary shards are downloaded directly, base85-encoded shards are
+       scripts calling loadShard(). In a worker they're imported
+       synchronously. */
+    downloadShard: /* istanbul ignore next */ function(shard) {
+        let url = this.shardUrl.replace('{}', ('0' + shard.toString(16)).substr(-2));
+        if(url.substr(-4) == '.bin') {
+            this.downloadBuffer(url, function(buffer) {
+                Search.loadShard(shard, buffer);
+            });
+        } else if(typeof importScripts === 'function') {
+            try {
+                importScripts(url);
+            } catch(e) {
+                Search.loadShard(shard, null);
+            }
+        } else {
+            let script = document.createElement('script');
+            script.src = url;
+            script.async = true;
+            script.onerror = function() { Search.loadShard(shard, null); };
+            document.head.appendChild(script);
+        }
+    },
+
+    /* Takes either an ArrayBuffer or a base85-encoded string. A shard that
+       fails to load (or null data) is treated as not present. Afterwards the
+       search is repeated with the current input value, either using the shard
+       or reporting that nothing was found. */
+    loadShard: function(shard, data) {
+        if(typeof data === 'string') data = this.base85decode(data);
+
+        let parsed = data ? this.parse(data) : null;
+        if(parsed) this.shards[shard] = parsed;
+        else delete this.shards[shard];
+
+        /* istanbul ignore if */
+        if(typeof document !== 'undefined') {
+            let value = document.getElementById('search-input').value;
+            if(value.trim().length) this.searchAndRender(value);
+
+        /* In a worker, repeat the request that was waiting for the shard */
+        } else if(this.pendingRequest) {
+            this.onWorkerRequest(this.pendingRequest);
+        }
+
+        return !!parsed;
+    },
+
     base85decode: function(base85string) {
         function charValue(char) {
             if(char >=  48 && char <  58) /* 0-9 -> 0-9 */
@@ -181,8 +375,106 @@ var Search = {
         return buffer;
     },
 
+    /* With a worker, the data are decoded there */
     load: function(base85string) {
-        return this.init(this.base85decode(base85string));
+        if(this.worker) {
+            this.worker.postMessage({type: 'load', data: base85string});
+            return true;
+        }
+
+        return this.init(this.base85decode(base85string), undefined, 'searchdata-{}.js');
+    },
+
+    /* Moves decoding of the search data and searching into a Web Worker
+       running this same file, so the page doesn't stall while typing. Has to
+       be called before the data are loaded. If the worker can't be created
+       (for example Chrome doesn't allow that for pages opened from the local
+       filesystem), everything stays on the main thread. */
+    startWorker: /* istanbul ignore next */ function(url) {
+        try {
+            this.worker = new Worker(url);
+        } catch(e) {
+            console.warn("Can't start the search worker, searching on the main thread:", e.message);
+            return false;
+        }
+
+        this.worker.onmessage = function(event) {
+            Search.onWorkerReply(event.data);
+        };
+        return true;
+    },
+
+    /* Message protocol of the worker. Requests are {type: 'download', url},
+       {type: 'load', data} with base85-encoded data, {type: 'init', buffer,
+       maxResults, shardUrl} and {type: 'search', id, value}. The first three
+       are answered with {type: 'init', ok, symbolCount, dataSize,
+       maxResults}, search with {type: 'search', id, value, results, time}.
+       If a shard needs to be downloaded first, the search reply is sent once
+       it arrives, and only for the last such request. */
+    onWorkerRequest: function(request) {
+        if(request.type == 'download') {
+            /* istanbul ignore next */
+            this.downloadBuffer(request.url, function(buffer) {
+                Search.onWorkerRequest({type: 'init', buffer: buffer, shardUrl: request.url.replace(/\.bin$/, '-{}.bin')});
+            });
+
+        } else if(request.type == 'load' || request.type == 'init') {
+            let ok = request.type == 'load' ? this.load(request.data) :
+                this.init(request.buffer, request.maxResults, request.shardUrl);
+            this.postReply({type: 'init',
+                            ok: ok,
+                            symbolCount: this.symbolCount,
+                            dataSize: this.dataSize,
+                            maxResults: this.maxResults});
+
+        } else if(request.type == 'search') {
+            /* Set before searching, as a shard imported synchronously from
+               search() calls back into this function */
+            this.pendingRequest = request;
+
+            let prev = performance.now();
+            let results = this.search(request.value);
+            let after = performance.now();
+
+            if(!results) return;
+
+            this.pendingRequest = null;
+            this.postReply({type: 'search',
+                            id: request.id,
+                            value: request.value,
+                            searchString: this.normalize(request.value),
+                            results: results,
+                            time: after - prev});
+        }
+    },
+
+    postReply: /* istanbul ignore next */ function(reply) {
+        postMessage(reply);
+    },
+
+    /* Returns false if the reply was ignored */
+    onWorkerReply: function(reply) {
+        if(reply.type == 'init') {
+            if(!reply.ok) return false;
+
+            this.symbolCount = reply.symbolCount;
+            this.dataSize = reply.dataSize;
+            this.maxResults = reply.maxResults;
+
+            /* istanbul ignore if */
+            if(typeof document !== 'undefined') this.ready();
+            return true;
+        }
+
+        /* A newer request was sent in the meantime, its reply will come */
+        if(reply.id != this.workerRequest) return false;
+
+        if(!reply.results[0].length) this.updateExternalSearch(reply.searchString);
+
+        /* istanbul ignore if */
+        if(typeof document !== 'undefined')
+            this.renderResultsAndStatus(reply.value, reply.results, reply.time);
+        return true;
     },
 
     /* http://ecmanaut.blogspot.com/2006/07/encoding-decoding-utf8-in-javascript.html */
@@ -225,10 +517,37 @@ var Search = {
     },
 
     /* Returns the values in UTF-8, but input is in whatever shitty 16bit
-       encoding JS has */
+       encoding JS has. With sharded data returns null if the shard needed for
+       given search string is still being downloaded. */
     search: function(searchString) {
         /* Normalize the search string first, convert to UTF-8 */
-        searchString = this.toUtf8(searchString.toLowerCase().trim());
+        searchString = this.toUtf8(this.normalize(searchString));
+
+        /* With sharded data, switch to the shard for the first byte. If it
+           isn't downloaded yet, request it, loadShard() then repeats the
+           search. */
+        if(this.shards) {
+            if(!searchString.length) return [[], ''];
+
+            let shard = searchString.charCodeAt(0);
+            if(!(shard in this.shards)) return [[], ''];
+
+            if(!this.shards[shard]) {
+                if(this.shards[shard] === null) {
+                    this.shards[shard] = false;
+
+                    /* istanbul ignore if */
+                    if(typeof document !== 'undefined' || typeof importScripts === 'function')
+                        this.downloadShard(shard);
+                }
+                return null;
+            }
+
+            if(this.currentShard !== shard) {
+                this.use(this.shards[shard]);
+                this.currentShard = shard;
+            }
+        }
 
         /* TODO: maybe i could make use of InputEvent.data and others here */
 
@@ -249,17 +568,16 @@ var Search = {
         for(; foundPrefix != searchString.length; ++foundPrefix) {
             /* Calculate offset and count of children */
             let offset = this.searchStack[this.searchStack.length - 1];
-            let relChildOffset = 2 + this.trie.getUint8(offset)*2;
             let childCount = this.trie.getUint8(offset + 1);
 
             /* Go through all children and find the next offset */
-            let childOffset = offset + relChildOffset;
+            let childOffset = this.trieChildOffset(offset);
             let found = false;
             for(let j = 0; j != childCount; ++j) {
-                if(String.fromCharCode(this.trie.getUint8(childOffset + j*4 + 3)) != searchString[foundPrefix])
+                if(String.fromCharCode(this.trie.getUint8(childOffset + (j + 1)*this.trieChildSize - 1)) != searchString[foundPrefix])
                     continue;
 
-                this.searchStack.push(this.trie.getUint32(childOffset + j*4, true) & 0x007fffff);
+                this.searchStack.push(this.trie.getUint32(childOffset + j*this.trieChildSize, true) & this.trieOffsetMask);
                 found = true;
                 break;
             }
@@ -273,15 +591,8 @@ var Search = {
 
         /* If the whole thing was not found, return an empty result and offer
            external search */
-        if(foundPrefix != searchString.length) {
-            /* istanbul ignore if */
-            if(typeof document !== 'undefined') {
-                let link = document.getElementById('search-external');
-                if(link)
-                    link.href = link.dataset.searchEngine.replace('{query}', encodeURIComponent(searchString));
-            }
+        if(foundPrefix != searchString.length)
             return [[], ''];
-        }
 
         /* Otherwise gather the results */
         let suggestedTabAutocompletionChars = [];
@@ -294,9 +605,10 @@ var Search = {
             let suffixLength = current[1];
 
             /* Populate the results with all values associated with this node */
-            let resultCount = this.trie.getUint8(offset);
+            let resultCount = this.trieResultCount(offset);
+            let resultOffset = this.trieResultOffset(offset);
             for(let i = 0; i != resultCount; ++i) {
-                let index = this.trie.getUint16(offset + (i + 1)*2, true);
+                let index = this.readResultId(this.trie, resultOffset + i*this.resultIdSize);
                 results.push(this.gatherResult(index, suffixLength, 0xffffff)); /* should be enough haha */
 
                 /* 'nuff said. */
@@ -306,17 +618,16 @@ var Search = {
 
             /* Dig deeper */
             /* TODO: hmmm. this is helluvalot duplicated code. hmm. */
-            let relChildOffset = 2 + this.trie.getUint8(offset)*2;
             let childCount = this.trie.getUint8(offset + 1);
-            let childOffset = offset + relChildOffset;
+            let childOffset = this.trieChildOffset(offset);
             for(let j = 0; j != childCount; ++j) {
-                let offsetBarrier = this.trie.getUint32(childOffset + j*4, true);
+                let offsetBarrier = this.trie.getUint32(childOffset + j*this.trieChildSize, true);
 
                 /* Lookahead barrier, don't dig deeper */
-                if(offsetBarrier & 0x00800000) continue;
+                if(offsetBarrier & this.trieBarrierMask) continue;
 
                 /* Append to the queue */
-                leaves.push([offsetBarrier & 0x007fffff, suffixLength + 1]);
+                leaves.push([offsetBarrier & this.trieOffsetMask, suffixLength + 1]);
 
                 /* We don't have anything yet and this is the only path
                    forward, add the char to suggested Tab autocompletion. Can't
@@ -327,36 +638,80 @@ var Search = {
                    absolutely unwanted when all I want is check for truncated
                    UTF-8. */
                 if(!results.length && leaves.length == 1 && childCount == 1)
-                    suggestedTabAutocompletionChars.push(this.trie.getUint8(childOffset + j*4 + 3));
+                    suggestedTabAutocompletionChars.push(this.trie.getUint8(childOffset + (j + 1)*this.trieChildSize - 1));
             }
         }
 
         return [results, this.autocompletedCharsToString(suggestedTabAutocompletionChars)];
     },
 
+    normalize: function(searchString) {
+        return searchString.toLowerCase().trim();
+    },
+
+    /* Called on the main thread only, as the search itself can be in a
+       worker that has no access to the page */
+    updateExternalSearch: function(searchString) {
+        if(!this.externalSearchUrl) return;
+
+        this.externalSearchHref = this.externalSearchUrl.replace('{query}', encodeURIComponent(searchString));
+
+        /* istanbul ignore if */
+        if(typeof document !== 'undefined')
+            document.getElementById('search-external').href = this.externalSearchHref;
+    },
+
+    /* In version 1, a node result count of 255 means the actual count is in
+       an extra 16-bit field after the node header */
+    trieResultCount: function(offset) {
+        let resultCount = this.trie.getUint8(offset);
+        if(this.dataVersion && resultCount == 255)
+            return this.trie.getUint16(offset + 2, true);
+        return resultCount;
+    },
+
+    trieResultOffset: function(offset) {
+        if(this.dataVersion && this.trie.getUint8(offset) == 255)
+            return offset + 4;
+        return offset + 2;
+    },
+
+    trieChildOffset: function(offset) {
+        return this.trieResultOffset(offset) + this.trieResultCount(offset)*this.resultIdSize;
+    },
+
+    readResultId: function(view, offset) {
+        return this.resultIdSize == 2 ? view.getUint16(offset, true) : view.getUint32(offset, true);
+    },
+
+    /* The mask would make a 32-bit offset negative, >>> 0 fixes that */
+    mapResultOffset: function(index) {
+        return (this.map.getUint32(index*this.mapEntrySize, true) & this.mapOffsetMask) >>> 0;
+    },
+
     gatherResult: function(index, suffixLength, maxUrlPrefix) {
-        let flags = this.map.getUint8(index*4 + 3);
-        let resultOffset = this.map.getUint32(index*4, true) & 0x00ffffff;
+        let flags = this.map.getUint8((index + 1)*this.mapEntrySize - 1);
+        let resultOffset = this.mapResultOffset(index);
 
         /* The result is an alias, parse the aliased prefix */
         let aliasedIndex = null;
         if((flags & 0xf0) == 0x00) {
-            aliasedIndex = this.map.getUint16(resultOffset, true);
-            resultOffset += 2;
+            aliasedIndex = this.readResultId(this.map, resultOffset);
+            resultOffset += this.resultIdSize;
         }
 
         /* The result has a prefix, parse that first, recursively */
         let name = '';
         let url = '';
         if(flags & (1 << 3)) {
-            let prefixIndex = this.map.getUint16(resultOffset, true);
-            let prefixUrlPrefixLength = Math.min(this.map.getUint8(resultOffset + 2), maxUrlPrefix);
+            let prefixIndex = this.readResultId(this.map, resultOffset);
+            let prefixUrlPrefixLength = Math.min(this.map.getUint8(resultOffset + this.resultIdSize), maxUrlPrefix);
 
             let prefix = this.gatherResult(prefixIndex, 0 /*ignored*/, prefixUrlPrefixLength);
             name = prefix.name;
             url = prefix.url;
 
-            resultOffset += 3;
+            resultOffset += this.resultIdSize + 1;
         }
 
         /* The result has a suffix, extract its length */
@@ -366,7 +721,7 @@ var Search = {
             ++resultOffset;
         }
 
-        let nextResultOffset = this.map.getUint32((index + 1)*4, true) & 0x00ffffff;
+        let nextResultOffset = this.mapResultOffset(index + 1);
 
         /* Extract name */
         let j = resultOffset;
@@ -560,13 +915,30 @@ var Search = {
     },
 
     searchAndRender: /* istanbul ignore next */ function(value) {
+        /* The worker searches and onWorkerReply() renders the results */
+        if(this.worker) {
+            this.worker.postMessage({type: 'search', id: ++this.workerRequest, value: value});
+            return;
+        }
+
         let prev = performance.now();
         let results = this.search(value);
         let after = performance.now();
+
+        /* The shard is being downloaded, keep the previous results until
+           it arrives */
+        if(!results) return;
+
+        if(!results[0].length) this.updateExternalSearch(this.normalize(value));
+
+        this.renderResultsAndStatus(value, results, after - prev);
+    },
+
+    renderResultsAndStatus: /* istanbul ignore next */ function(value, results, time) {
         this.renderResults(value, results);
         if(value.trim().length) {
             document.getElementById('search-symbolcount').innerHTML =
-                results[0].length + (results.length >= this.maxResults ? '+' : '') + " results (" + Math.round((after - prev)*10)/10 + " ms)";
+                results[0].length + (results.length >= this.maxResults ? '+' : '') + " results (" + Math.round(time*10)/10 + " ms)";
         } else
             document.getElementById('search-symbolcount').innerHTML =
                 this.symbolCount + " symbols (" + Math.round(this.dataSize/102.4)/10 + " kB)";
@@ -649,6 +1021,9 @@ function copyToKeyboard(text) {
 /* Only in case we're running in a browser. Why a simple if(document) doesn't
    work is beyond me. */ /* istanbul ignore if */
 if(typeof document !== 'undefined') {
+    let externalSearch = document.getElementById('search-external');
+    if(externalSearch) Search.externalSearchUrl = externalSearch.dataset.searchEngine;
+
     document.getElementById('search-input').oninput = function(event) {
         Search.searchAndRender(document.getElementById('search-input').value);
     };
@@ -782,5 +1157,12 @@ if(typeof document !== 'undefined') {
     if(window.location.hash == '#search') updateForSearchVisible();
 }
 
+/* Running in a worker created by Search.startWorker() */ /* istanbul ignore if */
+if(typeof document === 'undefined' && typeof importScripts === 'function') {
+    onmessage = function(event) {
+        Search.onWorkerRequest(event.data);
+    };
+}
+
 /* For Node.js testing */ /* istanbul ignore else */
 if(typeof module !== 'undefined') { module.exports = { Search: Search }; }
@@ -44,8 +44,8 @@ class BaseTestCase(unittest.TestCase):
     def setUp(self):
         if os.path.exists(os.path.join(self.path, 'html')): shutil.rmtree(os.path.join(self.path, 'html'))
 
-    def run_doxygen(self, templates=default_templates, wildcard=default_wildcard, index_pages=default_index_pages):
-        run(os.path.join(self.path, 'Doxyfile'), templates=templates, wildcard=wildcard, index_pages=index_pages, sort_globbed_files=True)
+    def run_doxygen(self, templates=default_templates, wildcard=default_wildcard, index_pages=default_index_pages, jobs=1, incremental=False, xml_streaming_threshold=0, write_if_changed=False, output_threads=0, template_cache=True):
+        run(os.path.join(self.path, 'Doxyfile'), templates=templates, wildcard=wildcard, index_pages=index_pages, sort_globbed_files=True, jobs=jobs, incremental=incremental, xml_streaming_threshold=xml_streaming_threshold, write_if_changed=write_if_changed, output_threads=output_threads, template_cache=template_cache)
 
     def actual_expected_contents(self, actual, expected = None):
         if not expected: expected = actual
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+# Compares build_search_data() against the original recursive Trie and the
+# ResultMap prefix merging that used it, on a synthetic symbol set with
+# nested namespaces, classes, functions and variables. Both have to produce
+# the same output, which is verified as well.
+
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+from types import SimpleNamespace as Empty
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import doxygen
+from doxygen import ResultFlag, ResultMap, build_search_data
+
+# The original implementation, kept here for comparison
+class RecursiveTrie:
+    root_offset_struct = struct.Struct('<I')
+    header_struct = struct.Struct('<BB')
+    result_struct = struct.Struct('<H')
+    child_struct = struct.Struct('<I')
+    child_char_struct = struct.Struct('<B')
+
+    def __init__(self):
+        self.results = []
+        self.children = {}
+
+    def _insert(self, path: bytes, result, lookahead_barriers):
+        if not path:
+            self.results += [result]
+            return
+
+        char = path[0]
+        if not char in self.children:
+            self.children[char] = (False, RecursiveTrie())
+        if lookahead_barriers and lookahead_barriers[0] == 0:
+            lookahead_barriers = lookahead_barriers[1:]
+            self.children[char] = (True, self.children[char][1])
+        self.children[char][1]._insert(path[1:], result, [b - 1 for b in lookahead_barriers])
+
+    def insert(self, path: str, result, lookahead_barriers=[]):
+        self._insert(path.encode('utf-8'), result, lookahead_barriers)
+
+    def _sort(self, key):
+        self.results.sort(key=key)
+        for _, child in self.children.items():
+            child[1]._sort(key)
+
+    def sort(self, result_map: ResultMap):
+        def key(item: int):
+            entry = result_map.entries[item]
+            return [
+                2 if entry.flags & ResultFlag.DEPRECATED else 1 if entry.flags & ResultFlag.DELETED else 0,
+                (entry.flags & ResultFlag._TYPE).value,
+                entry.suffix_length,
+                len(entry.name)
+            ]
+
+        self._sort(key)
+
+    def _serialize(self, hashtable, output: bytearray, merge_subtrees) -> int:
+        child_offsets = []
+        for char, child in self.children.items():
+            offset = child[1]._serialize(hashtable, output, merge_subtrees=merge_subtrees)
+            child_offsets += [(char, child[0], offset)]
+
+        serialized = bytearray()
+        serialized += self.header_struct.pack(len(self.results), len(self.children))
+        for v in self.results:
+            serialized += self.result_struct.pack(v)
+
+        for char, lookahead_barrier, abs_offset in child_offsets:
+            assert abs_offset < 2**23
+            offset = len(serialized)
+            serialized += self.child_struct.pack(abs_offset | ((1 if lookahead_barrier else 0) << 23))
+            self.child_char_struct.pack_into(serialized, offset + 3, char)
+
+        hashable = bytes(serialized)
+        if merge_subtrees and hashable in hashtable:
+            return hashtable[hashable]
+        else:
+            offset = len(output)
+            output += serialized
+            if merge_subtrees: hashtable[hashable] = offset
+            return offset
+
+    def max_result_count(self) -> int:
+        return max([len(self.results)] + [child.max_result_count() for _, child in self.children.values()])
+
+    # Only the version 0 format is implemented here
+    def serialize(self, merge_subtrees=True, result_id_bytes=2, offset_bytes=3) -> bytearray:
+        assert result_id_bytes == 2 and offset_bytes == 3
+        output = bytearray(b'\x00\x00\x00\x00')
+        hashtable = {}
+        self.root_offset_struct.pack_into(output, 0, self._serialize(hashtable, output, merge_subtrees=merge_subtrees))
+        return output
+
+class RecursiveTrieResultMap(ResultMap):
+    def serialize(self, merge_prefixes=True, result_id_bytes=2, offset_bytes=3) -> bytearray:
+        if merge_prefixes:
+            trie = RecursiveTrie()
+            for index, e in enumerate(self.entries):
+                trie.insert(e.name, index)
+
+            merged = []
+            for index, e in enumerate(self.entries):
+                current = trie
+                longest_prefix = None
+                for c in e.name.encode('utf-8'):
+                    for candidate, child in current.children.items():
+                        if c == candidate:
+                            current = child[1]
+                            break
+                    else: assert False # pragma: no cover
+
+                    if index in current.results:
+                        for i in current.results:
+                            if self.entries[i].suffix_length > self.entries[index].suffix_length:
+                                longest_prefix = current
+                                break
+                    elif current.results:
+                        longest_prefix = current
+
+                if longest_prefix:
+                    max_prefix = (0, -1)
+                    for longest_index in longest_prefix.results:
+                        if longest_index == index: continue
+
+                        prefix_length = 0
+                        for i in range(min(len(e.url), len(self.entries[longest_index].url))):
+                            if e.url[i] != self.entries[longest_index].url[i]: break
+                            prefix_length += 1
+                        if max_prefix[1] < prefix_length:
+                            max_prefix = (longest_index, prefix_length)
+
+                    assert max_prefix[1] != -1
+
+                    entry = Empty()
+                    assert e.name.startswith(self.entries[longest_prefix.results[0]].name)
+                    entry.name = e.name[len(self.entries[longest_prefix.results[0]].name):]
+                    entry.url = e.url[max_prefix[1]:]
+                    entry.flags = e.flags|ResultFlag.HAS_PREFIX
+                    entry.alias = e.alias
+                    entry.prefix = max_prefix[0]
+                    entry.prefix_length = max_prefix[1]
+                    entry.suffix_length = e.suffix_length
+                    merged += [entry]
+
+                else: merged += [e]
+
+            self.entries = merged
+
+        # The serialization itself is the same, just with prefixes merged
+        # already
+        return ResultMap.serialize(self, merge_prefixes=False, result_id_bytes=result_id_bytes, offset_bytes=offset_bytes)
+
+def generate(count, seed):
+    rng = random.Random(seed)
+    syllables = ['ma', 'gnum', 'vec', 'tor', 'ran', 'ge', 'min', 'max', 'at', 'tri', 'bute', 'mesh', 'tex', 'ture', 'sha', 'der', 'gl', 'im', 'age', 'data']
+    def name():
+        return ''.join(rng.choice(syllables) for i in range(rng.randint(1, 4)))
+
+    scopes = [[]]
+    search = []
+    while len(search) < count:
+        prefix = rng.choice(scopes)
+        result = Empty()
+        result.name = name()
+        result.prefix = prefix
+        result.url = '{}.html#{:x}'.format('_1_1'.join(prefix) or 'index', len(search))
+        result.keywords = []
+        kind = rng.random()
+        if kind < 0.1 and len(prefix) < 5:
+            result.flags = ResultFlag.NAMESPACE
+            scopes += [prefix + [result.name]]
+        elif kind < 0.3 and len(prefix) < 5:
+            result.flags = ResultFlag.CLASS
+            scopes += [prefix + [result.name]]
+        elif kind < 0.8:
+            result.flags = ResultFlag.FUNC
+            result.params = [name() for i in range(rng.randint(0, 3))]
+            result.suffix = rng.choice(['', ' const'])
+        else:
+            result.flags = ResultFlag.VAR
+        if rng.random() < 0.05:
+            result.flags |= ResultFlag.DEPRECATED
+        search += [result]
+    return search
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbols', help="how many symbols to generate", type=int, default=10000)
+    parser.add_argument('--seed', help="random seed for generating the symbols", type=int, default=0)
+    parser.add_argument('--repeat', help="how many times to run each implementation, the best time is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    state = Empty()
+    state.search = generate(args.symbols, args.seed)
+
+    outputs = {}
+    for implementation, trie, result_map in [
+            ('recursive', RecursiveTrie, RecursiveTrieResultMap),
+            ('current', doxygen.Trie, doxygen.ResultMap)]:
+        doxygen.Trie = trie
+        doxygen.ResultMap = result_map
+
+        best = None
+        for i in range(args.repeat):
+            begin = time.perf_counter()
+            outputs[implementation] = build_search_data(state)
+            duration = time.perf_counter() - begin
+            if best is None or duration < best: best = duration
+        print("{:>9}: {:.3f} s, {:.1f} kB".format(implementation, best, len(outputs[implementation])/1024))
+
+    print("identical output: {}".format('yes' if outputs['recursive'] == outputs['current'] else 'NO'))
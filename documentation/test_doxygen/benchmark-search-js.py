@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+# Measures search.js query latency on synthetic search data of various sizes,
+# made with build_search_data() from the same symbol generator as in
+# benchmark-search-data.py. For every size, the data are saved to a temporary
+# directory both as a binary and base85-encoded together with a list of
+# queries, and benchmark-search.js then measures base85decode(), init() and
+# search() latency for each typed character of the queries in node.
+
+import argparse
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace as Empty
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from doxygen import build_search_data, base85encode_search_data
+
+# The file name isn't a valid identifier, so can't use a plain import
+generate = importlib.import_module('benchmark-search-data').generate
+
+# Half of the queries are just symbol names, half are prefixed with the full
+# scope, as if the user was searching for a particular overload
+def queries(search, count, seed):
+    rng = random.Random(seed)
+    out = []
+    for i in range(count):
+        result = rng.choice(search)
+        out += [result.name.lower() if i % 2 else '::'.join(result.prefix + [result.name]).lower()]
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--symbols', help="how many symbols to generate, one benchmark for each", type=int, nargs='+', default=[1000, 10000, 100000, 400000])
+    parser.add_argument('--seed', help="random seed for generating the symbols and queries", type=int, default=0)
+    parser.add_argument('--queries', help="how many queries to type", type=int, default=200)
+    parser.add_argument('--max-results', help="maximum result count passed to Search.init()", type=int, default=100)
+    parser.add_argument('--repeat', help="how many times to decode and init the data, the best time is reported", type=int, default=5)
+    parser.add_argument('--node', help="node executable", default='node')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.symbols:
+            state = Empty()
+            state.search = generate(count, args.seed)
+
+            begin = time.perf_counter()
+            data = build_search_data(state)
+            duration = time.perf_counter() - begin
+
+            file = os.path.join(tmp, str(count))
+            with open(file + '.bin', 'wb') as f:
+                f.write(data)
+            with open(file + '.b85', 'wb') as f:
+                f.write(base85encode_search_data(data))
+            with open(file + '.json', 'w') as f:
+                json.dump(queries(state.search, args.queries, args.seed), f)
+
+            print("{} symbols, built in {:.3f} s".format(count, duration), flush=True)
+            subprocess.run([args.node, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark-search.js'), file, str(args.max_results), str(args.repeat)], check=True)
@@ -0,0 +1,103 @@
+/*
+    This file is part of m.css.
+
+    Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+
+    Permission is hereby granted, free of charge, to any person obtaining a
+    copy of this software and associated documentation files (the "Software"),
+    to deal in the Software without restriction, including without limitation
+    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+    and/or sell copies of the Software, and to permit persons to whom the
+    Software is furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included
+    in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+    DEALINGS IN THE SOFTWARE.
+*/
+
+/* Measures base85decode(), init() and per-keystroke search() latency on data
+   generated by benchmark-search-js.py. Usage:
+
+    node benchmark-search.js <file> [maxResults] [repeat]
+
+   where <file>.bin, <file>.b85 and <file>.json with a list of queries have to
+   exist. Each query is typed character by character, so the search() latency
+   includes both walking the trie and gathering the results with prefix
+   reconstruction in gatherResult(). */
+
+"use strict"; /* it summons the Cthulhu in a proper way, they say */
+
+const { Search } = require('../search.js');
+
+const assert = require('assert');
+const fs = require('fs');
+
+/* In milliseconds */
+function measure(f) {
+    let begin = process.hrtime.bigint();
+    let result = f();
+    return [Number(process.hrtime.bigint() - begin)/1000000, result];
+}
+
+function best(repeat, f) {
+    let min = null;
+    let result;
+    for(let i = 0; i != repeat; ++i) {
+        let time;
+        [time, result] = measure(f);
+        if(min === null || time < min) min = time;
+    }
+    return [min, result];
+}
+
+function percentiles(times) {
+    times.sort(function(a, b) { return a - b; });
+    function at(p) { return times[Math.min(Math.floor(times.length*p), times.length - 1)].toFixed(3); }
+    return "p50 " + at(0.5) + " ms, p90 " + at(0.9) + " ms, p99 " + at(0.99) + " ms, max " + times[times.length - 1].toFixed(3) + " ms";
+}
+
+let file = process.argv[2];
+let maxResults = process.argv.length > 3 ? parseInt(process.argv[3]) : 100;
+let repeat = process.argv.length > 4 ? parseInt(process.argv[4]) : 5;
+
+let binary = fs.readFileSync(file + '.bin');
+let buffer = binary.buffer.slice(binary.byteOffset, binary.byteOffset + binary.byteLength);
+let b85 = fs.readFileSync(file + '.b85', {encoding: 'utf-8'});
+let queries = JSON.parse(fs.readFileSync(file + '.json', {encoding: 'utf-8'}));
+
+let [decodeTime, decoded] = best(repeat, function() { return Search.base85decode(b85); });
+console.log("  base85decode: " + decodeTime.toFixed(3) + " ms, " + (b85.length/1024).toFixed(1) + " kB");
+
+let [initTime, initialized] = best(repeat, function() { return Search.init(buffer, maxResults); });
+assert.ok(initialized);
+console.log("          init: " + initTime.toFixed(3) + " ms, " + (buffer.byteLength/1024).toFixed(1) + " kB, " + Search.symbolCount + " symbols");
+
+/* Type everything once without measuring, so the times don't include JIT
+   compilation */
+for(let query of queries) {
+    Search.search('');
+    for(let i = 1; i <= query.length; ++i) Search.search(query.substr(0, i));
+}
+
+/* Start each query from scratch, like when the search popup is opened */
+let times = [];
+let firstTimes = [];
+let resultCount = 0;
+for(let query of queries) {
+    Search.search('');
+    for(let i = 1; i <= query.length; ++i) {
+        let [time, results] = measure(function() { return Search.search(query.substr(0, i)); });
+        times.push(time);
+        if(i == 1) firstTimes.push(time);
+        resultCount += results[0].length;
+    }
+}
+console.log("        search: " + percentiles(times) + ", " + times.length + " keystrokes, " + (resultCount/times.length).toFixed(1) + " results on average");
+console.log("first keypress: " + percentiles(firstTimes));
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+# Compares the ElementTree and lxml backends of xmlbackend.py on the
+# test_doxygen fixtures. Every XML file is scaled up by repeating its members
+# (or paragraphs, for pages) and then parsed and walked the same way as in
+# the metadata pre-pass of doxygen.py. Run the tests first to have the
+# Doxygen-generated fixtures in */xml/, otherwise only the few checked-in XML
+# files are used. Alternatively, pass directories with other XML files to
+# use instead.
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../plugins'))
+
+import xmlbackend
+from doxygen import _document_all_stuff
+
+def scale(file, times):
+    tree = ET.parse(file)
+    compounddef = tree.getroot().find('compounddef')
+    if compounddef is None: return None
+
+    sectiondefs = compounddef.findall('sectiondef')
+    if sectiondefs:
+        for sectiondef in sectiondefs:
+            members = sectiondef.findall('memberdef')
+            for i in range(times - 1): sectiondef.extend(members)
+    else:
+        detaileddescription = compounddef.find('detaileddescription')
+        paragraphs = list(detaileddescription)
+        for i in range(times - 1): detaileddescription.extend(paragraphs)
+    return tree
+
+def lookup(tree):
+    compounddef = tree.getroot().find('compounddef')
+    compounddef.find('briefdescription')
+    compounddef.find('detaileddescription').findall('.//xrefsect')
+    _document_all_stuff(compounddef)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dirs', help="directories with XML files to use instead of test fixtures", nargs='*')
+    parser.add_argument('--scale', help="how many times to repeat members of each file", type=int, default=50)
+    parser.add_argument('--repeat', help="how many times to run each backend, the best time is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    basedir = os.path.dirname(os.path.realpath(__file__))
+    if args.dirs:
+        sources = sorted([file for dir in args.dirs for file in glob.glob(os.path.join(dir, '*.xml'))])
+    else:
+        sources = sorted(glob.glob(os.path.join(basedir, '*/xml/*.xml')) + glob.glob(os.path.join(basedir, '*/*.xml')))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        size = 0
+        for i, source in enumerate(sources):
+            if os.path.basename(source) == 'index.xml': continue
+            try:
+                tree = scale(source, args.scale)
+            except ET.ParseError:
+                continue
+            if not tree: continue
+
+            file = os.path.join(tmp, '{}.xml'.format(i))
+            tree.write(file)
+            files += [file]
+            size += os.path.getsize(file)
+
+        print("{} files, {:.1f} MB".format(len(files), size/1024/1024))
+
+        for backend in ['etree', 'lxml']:
+            try:
+                xmlbackend.use(backend)
+            except ImportError:
+                print("{:>6}: not available".format(backend))
+                continue
+
+            best_parse = None
+            best_lookup = None
+            for i in range(args.repeat):
+                begin = time.perf_counter()
+                trees = [xmlbackend.parse(file) for file in files]
+                parse = time.perf_counter() - begin
+
+                begin = time.perf_counter()
+                for tree in trees: lookup(tree)
+                lookup_ = time.perf_counter() - begin
+
+                if best_parse is None or parse < best_parse: best_parse = parse
+                if best_lookup is None or lookup_ < best_lookup: best_lookup = lookup_
+            print("{:>6}: parse {:.3f} s, lookup {:.3f} s".format(backend, best_parse, best_lookup))
@@ -25,12 +25,13 @@
 #
 
 import base64
+import copy
 import os
 import sys
 import pathlib
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
 
-from doxygen import Trie, ResultMap, ResultFlag, serialize_search_data
+from doxygen import Trie, ResultMap, ResultFlag, serialize_search_data, serialize_search_data_sharded, search_data_header_v1_struct
 
 basedir = pathlib.Path(os.path.dirname(os.path.realpath(__file__)))/'js-test-data'
 
@@ -39,7 +40,7 @@ with open(basedir/'short.bin', 'wb') as f:
 with open(basedir/'wrong-magic.bin', 'wb') as f:
     f.write(b'MOS\0                ')
 with open(basedir/'wrong-version.bin', 'wb') as f:
-    f.write(b'MCS\1                ')
+    f.write(b'MCS\2                ')
 with open(basedir/'empty.bin', 'wb') as f:
     f.write(serialize_search_data(Trie(), ResultMap(), 0))
 
@@ -69,11 +70,29 @@ trie.insert("subpage", map.add("Page » Subpage", "subpage.html", flags=ResultFl
 trie.insert("rectangle", map.add("Rectangle", "", alias=range_index))
 trie.insert("rect", map.add("Rectangle::Rect()", "", suffix_length=2, alias=range_index))
 
+# Both serialize_search_data() and serialize_search_data_sharded() merge the
+# prefixes in the map in-place, so operate on a copy
+manifest, shards = serialize_search_data_sharded(trie, copy.deepcopy(map), 7)
+with open(basedir/'sharded.bin', 'wb') as f:
+    f.write(manifest)
+for char, shard in shards.items():
+    with open(basedir/'sharded-{:02x}.bin'.format(char), 'wb') as f:
+        f.write(shard)
+with open(basedir/'sharded-72.b85', 'wb') as f:
+    f.write(base64.b85encode(shards[ord('r')], True))
+
 with open(basedir/'searchdata.bin', 'wb') as f:
     f.write(serialize_search_data(trie, map, 7))
 with open(basedir/'searchdata.b85', 'wb') as f:
     f.write(base64.b85encode(serialize_search_data(trie, map, 7), True))
 
+# The same data in version 1 with 32-bit result IDs and offsets, which get
+# used only for really large data otherwise. The prefixes are already merged.
+serialized_trie = trie.serialize(result_id_bytes=4, offset_bytes=4)
+serialized_map = map.serialize(merge_prefixes=False, result_id_bytes=4, offset_bytes=4)
+with open(basedir/'searchdata-v1.bin', 'wb') as f:
+    f.write(search_data_header_v1_struct.pack(b'MCS', 1, 4, 4, 4, 7, len(serialized_trie) + search_data_header_v1_struct.size) + serialized_trie + serialized_map)
+
 trie = Trie()
 map = ResultMap()
 
@@ -92,3 +111,11 @@ trie.insert("range", map.add("Magnum::Math::Range", "classMagnum_1_1Math_1_1Rang
 
 with open(basedir/'nested.bin', 'wb') as f:
     f.write(serialize_search_data(trie, map, 4))
+
+trie = Trie()
+map = ResultMap()
+for i in range(300):
+    trie.insert("math", map.add("Math", "namespaceMath.html#{}".format(i), flags=ResultFlag.NAMESPACE))
+
+with open(basedir/'many-results.bin', 'wb') as f:
+    f.write(serialize_search_data(trie, map, 300))
@@ -96,7 +96,7 @@ const { StringDecoder } = require('string_decoder');
     assert.ok(!Search.init(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength)));
 }
 
-/* Opening file with  */
+/* Opening file with unknown version */
 {
     let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/wrong-version.bin"));
     assert.ok(!Search.init(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength)));
@@ -239,6 +239,126 @@ const { StringDecoder } = require('string_decoder');
           suffixLength: 8 }], '()']);
 }
 
+/* Search in version 1 data with 32-bit result IDs and offsets. Generated
+   with the current result flag values, which differ from the above. */
+{
+    let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/searchdata-v1.bin"));
+    assert.ok(Search.init(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength)));
+    assert.equal(Search.dataSize, 751);
+    assert.equal(Search.symbolCount, 7);
+    assert.equal(Search.maxResults, 100);
+    assert.deepEqual(Search.search('min'), [[
+        { name: 'Math::min(int, int)',
+          url: 'namespaceMath.html#min',
+          flags: 169,
+          suffixLength: 10 },
+        { name: 'Math::Vector::min() const',
+          url: 'classMath_1_1Vector.html#min',
+          flags: 169,
+          suffixLength: 8 },
+        { name: 'Math::Range::min() const',
+          url: 'classMath_1_1Range.html#min',
+          flags: 173,
+          suffixLength: 8 }], '()']);
+    assert.deepEqual(Search.search('vec'), [[
+        { name: 'Math::Vector',
+          url: 'classMath_1_1Vector.html',
+          flags: 72|2, /* Deprecated */
+          suffixLength: 3 }], 'tor']);
+    assert.deepEqual(Search.search('r'), [[
+        { name: 'Rectangle::Rect()',
+          alias: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 5 },
+        { name: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 4 },
+        { name: 'Rectangle',
+          alias: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 8 }], '']);
+}
+
+/* Search in version 1 data with more than 255 results in a node */
+{
+    let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/many-results.bin"));
+    assert.ok(Search.init(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength), 1000));
+    assert.equal(Search.dataSize, 9841);
+    assert.equal(Search.symbolCount, 300);
+    let results = Search.search('math');
+    assert.equal(results[0].length, 300);
+    assert.deepEqual(results[0][299], {
+        name: 'Math',
+        url: 'namespaceMath.html#299',
+        flags: 32,
+        suffixLength: 0 });
+}
+
+/* Sharded search, the shards are loaded manually as there's no network
+   access. Generated with the current result flag values. */
+{
+    let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/sharded.bin"));
+    assert.ok(Search.init(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength), 0, 'sharded-{}.bin'));
+    assert.equal(Search.dataSize, 1044);
+    assert.equal(Search.symbolCount, 7);
+    assert.deepEqual(Object.keys(Search.shards), ['109', '114', '115', '118']);
+
+    /* Empty string gives back nothing without any shard */
+    assert.deepEqual(Search.search(''), [[], '']);
+
+    /* Nothing that starts with this letter, no need to download anything */
+    assert.deepEqual(Search.search('xyz'), [[], '']);
+
+    /* The shard is not downloaded yet, it's marked as requested */
+    assert.equal(Search.search('min'), null);
+    assert.strictEqual(Search.shards[109], false);
+
+    let shard = fs.readFileSync(path.join(__dirname, "js-test-data/sharded-6d.bin"));
+    assert.ok(Search.loadShard(109, shard.buffer.slice(shard.byteOffset, shard.byteOffset + shard.byteLength)));
+    assert.deepEqual(Search.search('min'), [[
+        { name: 'Math::min(int, int)',
+          url: 'namespaceMath.html#min',
+          flags: 169,
+          suffixLength: 10 },
+        { name: 'Math::Vector::min() const',
+          url: 'classMath_1_1Vector.html#min',
+          flags: 169,
+          suffixLength: 8 },
+        { name: 'Math::Range::min() const',
+          url: 'classMath_1_1Range.html#min',
+          flags: 173,
+          suffixLength: 8 }], '()']);
+
+    /* A base85-encoded shard, with the aliased result included */
+    assert.equal(Search.search('r'), null);
+    assert.ok(Search.loadShard(114, fs.readFileSync(path.join(__dirname, "js-test-data/sharded-72.b85"), {encoding: 'utf-8'})));
+    assert.deepEqual(Search.search('r'), [[
+        { name: 'Rectangle::Rect()',
+          alias: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 5 },
+        { name: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 4 },
+        { name: 'Rectangle',
+          alias: 'Math::Range',
+          url: 'classMath_1_1Range.html',
+          flags: 72,
+          suffixLength: 8 }], '']);
+
+    /* Switching back to an already loaded shard */
+    assert.deepEqual(Search.search('m')[0].length, 4);
+
+    /* A broken shard is treated as nonexistent */
+    assert.ok(!Search.loadShard(115, new ArrayBuffer(4)));
+    assert.deepEqual(Search.search('su'), [[], '']);
+}
+
 /* Search, Unicode */
 {
     let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/unicode.bin"));
@@ -288,4 +408,103 @@ const { StringDecoder } = require('string_decoder');
           suffixLength: 3 }], 'nge']);
 }
 
+/* Worker mode. The worker is emulated with a second instance of search.js,
+   with requests and replies passed directly instead of via postMessage() */
+{
+    delete require.cache[require.resolve('../search.js')];
+    const WorkerSearch = require('../search.js').Search;
+    assert.notStrictEqual(WorkerSearch, Search);
+
+    let replies = [];
+    WorkerSearch.postReply = function(reply) { replies.push(reply); };
+
+    /* Base85-encoded data get decoded in the worker */
+    let b85 = fs.readFileSync(path.join(__dirname, "js-test-data/searchdata.b85"), {encoding: 'utf-8'});
+    WorkerSearch.onWorkerRequest({type: 'load', data: b85});
+    assert.deepEqual(replies, [{
+        type: 'init',
+        ok: true,
+        symbolCount: 7,
+        dataSize: 640,
+        maxResults: 100}]);
+
+    /* Search results come back together with the request ID and value */
+    WorkerSearch.onWorkerRequest({type: 'search', id: 1, value: 'min'});
+    assert.equal(replies.length, 2);
+    assert.equal(replies[1].type, 'search');
+    assert.equal(replies[1].id, 1);
+    assert.equal(replies[1].value, 'min');
+    assert.equal(replies[1].results[0].length, 3);
+    assert.equal(replies[1].results[0][0].name, 'Math::min(int, int)');
+    assert.equal(replies[1].results[1], '()');
+    assert.equal(typeof replies[1].time, 'number');
+
+    /* Failure to init is reported back */
+    WorkerSearch.onWorkerRequest({type: 'init', buffer: new ArrayBuffer(3)});
+    assert.equal(replies.length, 3);
+    assert.ok(!replies[2].ok);
+
+    /* With sharded data, the reply is sent only once the shard arrives, and
+       only for the last request */
+    replies = [];
+    let buffer = fs.readFileSync(path.join(__dirname, "js-test-data/sharded.bin"));
+    WorkerSearch.onWorkerRequest({type: 'init', buffer: buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.byteLength), maxResults: 2, shardUrl: 'sharded-{}.bin'});
+    assert.deepEqual(replies, [{
+        type: 'init',
+        ok: true,
+        symbolCount: 7,
+        dataSize: 1044,
+        maxResults: 2}]);
+    WorkerSearch.onWorkerRequest({type: 'search', id: 2, value: 'mi'});
+    WorkerSearch.onWorkerRequest({type: 'search', id: 3, value: 'min'});
+    assert.equal(replies.length, 1);
+    let shard = fs.readFileSync(path.join(__dirname, "js-test-data/sharded-6d.bin"));
+    assert.ok(WorkerSearch.loadShard(109, shard.buffer.slice(shard.byteOffset, shard.byteOffset + shard.byteLength)));
+    assert.equal(replies.length, 2);
+    assert.equal(replies[1].id, 3);
+    assert.equal(replies[1].value, 'min');
+    assert.equal(replies[1].results[0].length, 2);
+    assert.strictEqual(WorkerSearch.pendingRequest, null);
+
+    /* A shard that fails to load answers the waiting request as well */
+    WorkerSearch.onWorkerRequest({type: 'search', id: 4, value: 'su'});
+    assert.equal(replies.length, 2);
+    assert.ok(!WorkerSearch.loadShard(115, null));
+    assert.equal(replies.length, 3);
+    assert.equal(replies[2].id, 4);
+    assert.deepEqual(replies[2].results, [[], '']);
+
+    /* Main thread sends the data to the worker and gets the metadata back */
+    Search.worker = { postMessage: function(request) { WorkerSearch.onWorkerRequest(request); } };
+    WorkerSearch.postReply = function(reply) { Search.onWorkerReply(reply); };
+    Search.symbolCount = 0;
+    assert.ok(Search.load(b85));
+    assert.equal(Search.symbolCount, 7);
+    assert.equal(Search.dataSize, 640);
+    assert.equal(Search.maxResults, 100);
+
+    /* Failed init is ignored */
+    assert.ok(!Search.onWorkerReply({type: 'init', ok: false}));
+
+    /* If nothing is found, the external search link is updated on the main
+       thread with the normalized search string from the reply */
+    Search.externalSearchUrl = 'https://google.com/search?q={query}';
+    Search.workerRequest = 3;
+    WorkerSearch.onWorkerRequest({type: 'search', id: 3, value: ' Hýždě Bříza '});
+    assert.equal(Search.externalSearchHref, 'https://google.com/search?q=h%C3%BD%C5%BEd%C4%9B%20b%C5%99%C3%ADza');
+
+    /* If something is found, it's left untouched */
+    Search.workerRequest = 4;
+    WorkerSearch.onWorkerRequest({type: 'search', id: 4, value: 'min'});
+    assert.equal(Search.externalSearchHref, 'https://google.com/search?q=h%C3%BD%C5%BEd%C4%9B%20b%C5%99%C3%ADza');
+    Search.externalSearchUrl = '';
+
+    /* Replies to outdated requests are ignored */
+    Search.workerRequest = 5;
+    assert.ok(!Search.onWorkerReply({type: 'search', id: 4, value: 'mi', results: [[], ''], time: 0.1}));
+    assert.ok(Search.onWorkerReply({type: 'search', id: 5, value: 'min', results: [[], ''], time: 0.1}));
+
+    Search.worker = null;
+}
+
 /* Not testing Search.download() because the xmlhttprequest npm package is *crap* */
@@ -113,6 +113,32 @@ class Detailed(IntegrationTestCase):
         self.run_doxygen(wildcard='File_8h.xml')
         self.assertEqual(*self.actual_expected_contents('File_8h.html'))
 
+# Same as above, but with all files parsed in streaming mode. The output
+# should be exactly the same.
+class ListingStreaming(IntegrationTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'listing', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='*.xml', index_pages=[], xml_streaming_threshold=1.0e-6)
+        self.assertEqual(*self.actual_expected_contents('File_8h.html'))
+        self.assertEqual(*self.actual_expected_contents('namespaceRoot_1_1Directory.html'))
+        self.assertEqual(*self.actual_expected_contents('classRoot_1_1Directory_1_1Sub_1_1Class.html'))
+
+class DetailedStreaming(IntegrationTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'detailed', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='*.xml', index_pages=[], xml_streaming_threshold=1.0e-6)
+        self.assertEqual(*self.actual_expected_contents('namespaceNamee.html'))
+        self.assertEqual(*self.actual_expected_contents('structTemplate.html'))
+        self.assertEqual(*self.actual_expected_contents('namespaceFoo.html'))
+        self.assertEqual(*self.actual_expected_contents('namespaceEno.html'))
+        self.assertEqual(*self.actual_expected_contents('namespaceType.html'))
+        self.assertEqual(*self.actual_expected_contents('namespaceVar.html'))
+        self.assertEqual(*self.actual_expected_contents('File_8h.html'))
+
 class Ignored(IntegrationTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'ignored', *args, **kwargs)
@@ -26,6 +26,7 @@ import os
 import pickle
 import re
 import shutil
+import sqlite3
 import subprocess
 import unittest
 
@@ -35,6 +36,25 @@ from distutils.version import LooseVersion
 
 from . import BaseTestCase, IntegrationTestCase, doxygen_version
 
+# The math cache is an SQLite database, convert it from / to a (version, age,
+# {hash: (age, depth, svg)}) tuple for easier comparison
+def write_math_cache(file, cache):
+    if os.path.exists(file): os.remove(file)
+    db = sqlite3.connect(file)
+    db.execute('CREATE TABLE meta (version INTEGER, age INTEGER)')
+    db.execute('CREATE TABLE formulas (hash BLOB PRIMARY KEY, age INTEGER, depth REAL, svg TEXT)')
+    db.execute('INSERT INTO meta VALUES (?, ?)', cache[:2])
+    db.executemany('INSERT INTO formulas VALUES (?, ?, ?, ?)', [(hash, ) + entry for hash, entry in cache[2].items()])
+    db.commit()
+    db.close()
+
+def read_math_cache(file):
+    db = sqlite3.connect(file)
+    version, age = db.execute('SELECT version, age FROM meta').fetchone()
+    entries = {hash: (age, depth, svg) for hash, age, depth, svg in db.execute('SELECT hash, age, depth, svg FROM formulas')}
+    db.close()
+    return (version, age, entries)
+
 def dot_version():
     return re.match(".*version (?P<version>\d+\.\d+\.\d+).*", subprocess.check_output(['dot', '-V'], stderr=subprocess.STDOUT).decode('utf-8').strip()).group('version')
 
@@ -90,6 +110,27 @@ class Code(IntegrationTestCase):
         self.run_doxygen(wildcard='warnings.xml')
         self.assertEqual(*self.actual_expected_contents('warnings.html'))
 
+    def test_cached(self):
+        if os.path.exists(os.path.join(self.path, 'm.code.cache')):
+            os.remove(os.path.join(self.path, 'm.code.cache'))
+
+        # The first run fills the cache with all highlighted snippets
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual(*self.actual_expected_contents('index.html'))
+        with open(os.path.join(self.path, 'm.code.cache'), 'rb') as f:
+            code_cache = pickle.load(f)
+        self.assertEqual(code_cache[1], 0)
+        self.assertTrue(code_cache[2])
+
+        # The second run reuses them, producing the same output and bumping
+        # the age of all entries
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual(*self.actual_expected_contents('index.html'))
+        with open(os.path.join(self.path, 'm.code.cache'), 'rb') as f:
+            code_cache_actual = pickle.load(f)
+        self.assertEqual(code_cache_actual, (code_cache[0], 1, {
+            hash: (1, highlighted) for hash, (age, highlighted) in code_cache[2].items()}))
+
 class CodeLanguage(IntegrationTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'code_language', *args, **kwargs)
@@ -198,28 +239,28 @@ class MathCached(IntegrationTestCase):
         math_cache = (0, 5, {
             self.tau_half_hash: (5, 0.344841, self.tau_half),
             self.fermat_hash: (5, 0.0, self.fermat),
-            b'does not exist': (5, 0.0, 'something')})
-        with open(os.path.join(self.path, 'xml/math.cache'), 'wb') as f:
-            pickle.dump(math_cache, f)
+            b'used by another build': (5, 0.0, 'something'),
+            b'does not exist': (4, 0.0, 'something')})
+        write_math_cache(os.path.join(self.path, 'xml/math.cache'), math_cache)
 
         self.run_doxygen(wildcard='math.xml')
         self.assertEqual(*self.actual_expected_contents('math.html'))
 
         # Expect that after the operation the global cache age is bumped,
-        # unused entries removed and used entries age bumped as well
-        with open(os.path.join(self.path, 'xml/math.cache'), 'rb') as f:
-            math_cache_actual = pickle.load(f)
+        # used entries age bumped as well and entries not used in this nor
+        # the previous run removed
+        math_cache_actual = read_math_cache(os.path.join(self.path, 'xml/math.cache'))
         math_cache_expected = (0, 6, {
             self.tau_half_hash: (6, 0.344841, self.tau_half),
-            self.fermat_hash: (6, 0.0, self.fermat)})
+            self.fermat_hash: (6, 0.0, self.fermat),
+            b'used by another build': (5, 0.0, 'something')})
         self.assertEqual(math_cache_actual, math_cache_expected)
 
     @unittest.skipUnless(shutil.which('latex'),
                          "Math rendering requires LaTeX installed")
     def test_uncached(self):
         # Write some bullshit there, which gets immediately reset
-        with open(os.path.join(self.path, 'xml/math.cache'), 'wb') as f:
-            pickle.dump((1337, 0, {"something different"}), f)
+        write_math_cache(os.path.join(self.path, 'xml/math.cache'), (1337, 0, {b'something different': (0, 0.0, 'something')}))
 
         self.run_doxygen(wildcard='math-uncached.xml')
 
@@ -233,8 +274,7 @@ class MathCached(IntegrationTestCase):
         self.assertEqual(actual_contents, expected_contents)
 
         # Expect that after the operation the global cache is filled
-        with open(os.path.join(self.path, 'xml/math.cache'), 'rb') as f:
-            math_cache_actual = pickle.load(f)
+        math_cache_actual = read_math_cache(os.path.join(self.path, 'xml/math.cache'))
         math_cache_expected = (0, 0, {
             sha1("$ \\frac{\\tau}{2} $".encode('utf-8')).digest():
                 (0, 0.344841, self.tau_half),
@@ -411,6 +451,29 @@ class Dot(IntegrationTestCase):
         self.run_doxygen(wildcard='warnings.xml')
         self.assertEqual(*self.actual_expected_contents('warnings.html'))
 
+    @unittest.skipUnless(LooseVersion(dot_version()) >= LooseVersion("2.40.1"),
+                         "Dot < 2.40.1 has a completely different output.")
+    def test_cached(self):
+        if os.path.exists(os.path.join(self.path, 'm.dot.cache')):
+            os.remove(os.path.join(self.path, 'm.dot.cache'))
+
+        # The first run fills the cache with all rendered graphs
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual(*self.actual_expected_contents('index.html'))
+        with open(os.path.join(self.path, 'm.dot.cache'), 'rb') as f:
+            dot_cache = pickle.load(f)
+        self.assertEqual(dot_cache[1], 0)
+        self.assertTrue(dot_cache[2])
+
+        # The second run reuses them, producing the same output and bumping
+        # the age of all entries
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual(*self.actual_expected_contents('index.html'))
+        with open(os.path.join(self.path, 'm.dot.cache'), 'rb') as f:
+            dot_cache_actual = pickle.load(f)
+        self.assertEqual(dot_cache_actual, (dot_cache[0], 1, {
+            hash: (1, svg) for hash, (age, svg) in dot_cache[2].items()}))
+
 class Htmlinclude(IntegrationTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'htmlinclude', *args, **kwargs)
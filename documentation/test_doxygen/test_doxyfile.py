@@ -54,10 +54,17 @@ class Doxyfile(unittest.TestCase):
             'M_LINKS_NAVBAR1': ['pages', 'modules'],
             'M_LINKS_NAVBAR2': ['files', 'annotated'], # different order
             'M_MATH_CACHE_FILE': 'm.math.cache',
+            'M_CODE_CACHE_FILE': 'm.code.cache',
+            'M_DOT_CACHE_FILE': 'm.dot.cache',
+            'M_METADATA_CACHE_FILE': '',
             'M_PAGE_FINE_PRINT': 'this is "quotes"',
             'M_PAGE_HEADER': 'this is "quotes" \'apostrophes\'',
+            'M_PRECOMPRESS_GZIP': 0,
+            'M_PRECOMPRESS_BROTLI': 0,
             'M_SEARCH_DISABLED': False,
             'M_SEARCH_DOWNLOAD_BINARY': False,
+            'M_SEARCH_SHARDED': False,
+            'M_SEARCH_WORKER': False,
             'M_SEARCH_BASE_URL': '',
             'M_SEARCH_EXTERNAL_URL': '',
             'M_SEARCH_HELP':
@@ -22,8 +22,20 @@
 #   DEALINGS IN THE SOFTWARE.
 #
 
+import gc
+import gzip
+import multiprocessing
 import os
+import pickle
+import shutil
 import subprocess
+import unittest
+import warnings
+
+from unittest import mock
+
+import doxygen
+from doxygen import brotli, xmlbackend
 
 from . import BaseTestCase
 
@@ -39,6 +51,57 @@ class Layout(BaseTestCase):
         self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'searchdata.js')))
         self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'favicon-light.png')))
 
+class Parallel(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, '', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='*.xml', jobs=2)
+        self.assertEqual(*self.actual_expected_contents('pages.html'))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'index.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'searchdata.js')))
+
+# The default on macOS and Windows. Everything sent to the workers has to be
+# picklable, with both XML backends.
+class ParallelSpawn(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'parallel_spawn', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(xmlbackend.use, xmlbackend.backend)
+
+    def test_etree(self):
+        xmlbackend.use('etree')
+        self._test()
+
+    @unittest.skipUnless(xmlbackend.lxml, "the lxml module is not installed")
+    def test_lxml(self):
+        xmlbackend.use('lxml')
+        self._test()
+
+    def _test(self):
+        self.run_doxygen()
+        with open(os.path.join(self.path, 'html', 'classFoo.html')) as f:
+            contents = f.read()
+
+        shutil.rmtree(os.path.join(self.path, 'html'))
+        with mock.patch('doxygen.multiprocessing', multiprocessing.get_context('spawn')):
+            self.run_doxygen(jobs=2)
+        with open(os.path.join(self.path, 'html', 'classFoo.html')) as f:
+            self.assertEqual(f.read(), contents)
+
+class OutputThreads(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, '', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='*.xml', output_threads=2)
+        self.assertEqual(*self.actual_expected_contents('pages.html'))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'index.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'searchdata.js')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'favicon-light.png')))
+
 class GeneratedDoxyfile(BaseTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'generated_doxyfile', *args, **kwargs)
@@ -59,6 +122,277 @@ class Minimal(BaseTestCase):
         self.run_doxygen(wildcard='indexpage.xml')
         self.assertEqual(*self.actual_expected_contents('index.html'))
 
+class Incremental(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'incremental', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        if os.path.exists(os.path.join(self.path, 'm.incremental.cache')):
+            os.remove(os.path.join(self.path, 'm.incremental.cache'))
+
+    def test(self):
+        self.run_doxygen(wildcard='*.xml', incremental=True)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'm.incremental.cache')))
+        with open(os.path.join(self.path, 'html', 'index.html')) as f:
+            contents = f.read()
+        with open(os.path.join(self.path, 'html', 'page.html')) as f:
+            self.assertIn('A page', f.read())
+
+        # Nothing changed, so no file should get written again. That includes
+        # the class with just a detailed description, which used to have an
+        # unstable signature.
+        for i in ['index.html', 'page.html', 'classFoo.html']:
+            os.utime(os.path.join(self.path, 'html', i), (0, 0))
+        self.run_doxygen(wildcard='*.xml', incremental=True)
+        for i in ['index.html', 'page.html', 'classFoo.html']:
+            self.assertEqual(os.path.getmtime(os.path.join(self.path, 'html', i)), 0)
+
+        # Change the page input, only the page should get rendered again. The
+        # original input is restored after.
+        with open(os.path.join(self.path, 'page.xml')) as f:
+            page = f.read()
+        self.addCleanup(self._restore_page, page)
+        with open(os.path.join(self.path, 'page.xml'), 'w') as f:
+            f.write(page.replace('<title>A page</title>', '<title>A changed page</title>'))
+        self.run_doxygen(wildcard='*.xml', incremental=True)
+        self.assertEqual(os.path.getmtime(os.path.join(self.path, 'html', 'index.html')), 0)
+        self.assertEqual(os.path.getmtime(os.path.join(self.path, 'html', 'classFoo.html')), 0)
+        self.assertNotEqual(os.path.getmtime(os.path.join(self.path, 'html', 'page.html')), 0)
+        with open(os.path.join(self.path, 'html', 'page.html')) as f:
+            self.assertIn('A changed page', f.read())
+
+        # If the output is removed, it gets regenerated
+        os.remove(os.path.join(self.path, 'html', 'index.html'))
+        self.run_doxygen(wildcard='*.xml', incremental=True)
+        with open(os.path.join(self.path, 'html', 'index.html')) as f:
+            self.assertEqual(f.read(), contents)
+
+    def _restore_page(self, contents):
+        with open(os.path.join(self.path, 'page.xml'), 'w') as f:
+            f.write(contents)
+
+class TemplateCache(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'minimal', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        if os.path.exists(os.path.join(self.path, 'm.templates.cache')):
+            shutil.rmtree(os.path.join(self.path, 'm.templates.cache'))
+
+    def test(self):
+        # Disabled, nothing gets written
+        self.run_doxygen(wildcard='indexpage.xml', template_cache=False)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'm.templates.cache')))
+
+        # By default the cache is in the output directory
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertTrue(os.listdir(os.path.join(self.path, 'm.templates.cache')))
+
+class WriteIfChanged(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'minimal', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='indexpage.xml', write_if_changed=True)
+
+        # Nothing changed, so neither the rendered files nor the copied
+        # files should get written again
+        for i in ['index.html', 'searchdata.js', 'search.js']:
+            os.utime(os.path.join(self.path, 'html', i), (0, 0))
+        self.run_doxygen(wildcard='indexpage.xml', write_if_changed=True)
+        for i in ['index.html', 'searchdata.js', 'search.js']:
+            self.assertEqual(os.path.getmtime(os.path.join(self.path, 'html', i)), 0)
+
+        # A file with different contents gets overwritten
+        with open(os.path.join(self.path, 'html', 'index.html'), 'a') as f:
+            f.write('modified')
+        self.run_doxygen(wildcard='indexpage.xml', write_if_changed=True)
+        self.assertNotEqual(os.path.getmtime(os.path.join(self.path, 'html', 'index.html')), 0)
+        with open(os.path.join(self.path, 'html', 'index.html')) as f:
+            self.assertNotIn('modified', f.read())
+
+class Precompressed(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'precompressed', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='indexpage.xml')
+
+        # Rendered, generated and copied files have a compressed sibling with
+        # the same contents
+        for i in ['index.html', 'searchdata.js', 'search.js']:
+            with open(os.path.join(self.path, 'html', i), 'rb') as f:
+                contents = f.read()
+            with open(os.path.join(self.path, 'html', i + '.gz'), 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), contents)
+
+        # Brotli is not enabled in the Doxyfile
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'html', 'index.html.br')))
+
+        # The output is reproducible, so nothing gets written again. As the
+        # output itself didn't change, it isn't even compressed again.
+        for i in ['index.html.gz', 'searchdata.js.gz', 'search.js.gz']:
+            os.utime(os.path.join(self.path, 'html', i), (0, 0))
+        with mock.patch('doxygen._compress', wraps=doxygen._compress) as compress:
+            self.run_doxygen(wildcard='indexpage.xml', write_if_changed=True)
+        self.assertEqual(compress.call_count, 0)
+        for i in ['index.html.gz', 'searchdata.js.gz', 'search.js.gz']:
+            self.assertEqual(os.path.getmtime(os.path.join(self.path, 'html', i)), 0)
+
+        # Missing siblings get written again even if the output is unchanged
+        for i in ['index.html', 'search.js']:
+            os.remove(os.path.join(self.path, 'html', i + '.gz'))
+        with mock.patch('doxygen._compress', wraps=doxygen._compress) as compress:
+            self.run_doxygen(wildcard='indexpage.xml', write_if_changed=True)
+        self.assertEqual(compress.call_count, 2)
+        for i in ['index.html', 'search.js']:
+            with open(os.path.join(self.path, 'html', i), 'rb') as f:
+                contents = f.read()
+            with open(os.path.join(self.path, 'html', i + '.gz'), 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), contents)
+
+class PrecompressedBrotli(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'precompressed_brotli', *args, **kwargs)
+
+    @unittest.skipUnless(brotli, "the brotli module is not installed")
+    def test(self):
+        self.run_doxygen(wildcard='indexpage.xml', output_threads=2)
+
+        for i in ['index.html', 'searchdata.js', 'search.js']:
+            with open(os.path.join(self.path, 'html', i), 'rb') as f:
+                contents = f.read()
+            with open(os.path.join(self.path, 'html', i + '.br'), 'rb') as f:
+                self.assertEqual(brotli.decompress(f.read()), contents)
+            with open(os.path.join(self.path, 'html', i + '.gz'), 'rb') as f:
+                self.assertEqual(gzip.decompress(f.read()), contents)
+
+class XmlBackendLxml(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'minimal', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(xmlbackend.use, xmlbackend.backend)
+
+    @unittest.skipUnless(xmlbackend.lxml, "the lxml module is not installed")
+    def test(self):
+        xmlbackend.use('etree')
+        self.run_doxygen(wildcard='indexpage.xml')
+        with open(os.path.join(self.path, 'html', 'index.html')) as f:
+            contents = f.read()
+
+        # The output should be the same, without any warnings about
+        # truth-testing elements leaking from doxygen.py
+        xmlbackend.use('lxml')
+        with warnings.catch_warnings(record=True) as caught:
+            self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual([str(i.message) for i in caught if i.category is FutureWarning], [])
+        with open(os.path.join(self.path, 'html', 'index.html')) as f:
+            self.assertEqual(f.read(), contents)
+
+        # The warning is silenced just for doxygen.py, not the whole process
+        element = xmlbackend.parse(os.path.join(self.path, 'indexpage.xml')).getroot().find('compounddef/briefdescription')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('default', FutureWarning)
+            self.assertTrue(not element)
+        self.assertEqual([i.category for i in caught], [FutureWarning])
+
+class XmlStreamed(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'xml_streamed', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(xmlbackend.use, xmlbackend.backend)
+
+    def test_etree(self):
+        xmlbackend.use('etree')
+        self._test()
+
+    @unittest.skipUnless(xmlbackend.lxml, "the lxml module is not installed")
+    def test_lxml(self):
+        xmlbackend.use('lxml')
+        self._test()
+
+    def _test(self):
+        self.run_doxygen(wildcard='*.xml')
+        with open(os.path.join(self.path, 'html', 'classFoo.html')) as f:
+            contents = f.read()
+
+        # Streamed parsing should produce the same output, including the
+        # member made documented by M_SHOW_UNDOCUMENTED
+        self.run_doxygen(wildcard='*.xml', xml_streaming_threshold=1.0e-6)
+        with open(os.path.join(self.path, 'html', 'classFoo.html')) as f:
+            self.assertEqual(f.read(), contents)
+
+        # The members are elements of the same type as in trees that are not
+        # streamed and survive garbage collection in the meantime
+        state = mock.Mock()
+        state.doxyfile = {'M_SHOW_UNDOCUMENTED': True}
+        tree = doxygen._parse_xml_streamed(state, os.path.join(self.path, 'classFoo.xml'))
+        gc.collect()
+        sectiondefs = [i for i in tree.getroot()[0] if i.tag == 'sectiondef']
+        members = [[(type(memberdef), memberdef.find('name').text) for memberdef in sectiondef] for sectiondef in sectiondefs]
+        element = type(xmlbackend.parse(os.path.join(self.path, 'classFoo.xml')).getroot())
+        self.assertEqual(members, [[(element, 'a'), (element, 'b')], [(element, 'c')]])
+
+class MetadataCache(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'metadata_cache', *args, **kwargs)
+
+    def setUp(self):
+        super().setUp()
+        if os.path.exists(os.path.join(self.path, 'm.metadata.cache')):
+            os.remove(os.path.join(self.path, 'm.metadata.cache'))
+        self.addCleanup(xmlbackend.use, xmlbackend.backend)
+
+    def test_etree(self):
+        xmlbackend.use('etree')
+        self._test()
+
+    @unittest.skipUnless(xmlbackend.lxml, "the lxml module is not installed")
+    def test_lxml(self):
+        xmlbackend.use('lxml')
+        self._test()
+
+    def _test(self):
+        with mock.patch('doxygen.extract_metadata', wraps=doxygen.extract_metadata) as extract_metadata:
+            self.run_doxygen()
+        self.assertEqual(extract_metadata.call_count, 2)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'm.metadata.cache')))
+        contents = {}
+        for i in ['index.html', 'classFoo.html']:
+            with open(os.path.join(self.path, 'html', i)) as f:
+                contents[i] = f.read()
+
+        # The class has an empty brief, so has_details is taken from the
+        # detailed description. It should get cached as a plain value and not
+        # the XML element, which lxml can't pickle.
+        with open(os.path.join(self.path, 'm.metadata.cache'), 'rb') as f:
+            _, _, entries = pickle.load(f)
+        self.assertIs(entries['classFoo.xml'].compound.has_details, True)
+
+        # Second run takes the metadata from the cache without extracting
+        # them again, the output should be the same. Touching the file
+        # changes only its mtime, so it should still be reused.
+        os.utime(os.path.join(self.path, 'indexpage.xml'))
+        shutil.rmtree(os.path.join(self.path, 'html'))
+        with mock.patch('doxygen.extract_metadata', wraps=doxygen.extract_metadata) as extract_metadata:
+            self.run_doxygen()
+        self.assertEqual(extract_metadata.call_count, 0)
+        for i in ['index.html', 'classFoo.html']:
+            with open(os.path.join(self.path, 'html', i)) as f:
+                self.assertEqual(f.read(), contents[i])
+
+        # Without the cache, the metadata get extracted again
+        os.remove(os.path.join(self.path, 'm.metadata.cache'))
+        with mock.patch('doxygen.extract_metadata', wraps=doxygen.extract_metadata) as extract_metadata:
+            self.run_doxygen()
+        self.assertEqual(extract_metadata.call_count, 2)
+
 class TemplateFallback(BaseTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'template_fallback', *args, **kwargs)
@@ -100,6 +434,14 @@ class SearchBinary(BaseTestCase):
         self.assertEqual(*self.actual_expected_contents('index.html'))
         self.assertTrue(os.path.exists(os.path.join(self.path, 'html', 'searchdata.bin')))
 
+class SearchWorker(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, 'search_worker', *args, **kwargs)
+
+    def test(self):
+        self.run_doxygen(wildcard='indexpage.xml')
+        self.assertEqual(*self.actual_expected_contents('index.html'))
+
 class SearchOpenSearch(BaseTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, 'search_opensearch', *args, **kwargs)
@@ -26,15 +26,16 @@
 
 import argparse
 import os
+import struct
 import sys
 import unittest
 from types import SimpleNamespace as Empty
 
-from doxygen import Trie, ResultMap, ResultFlag, serialize_search_data, search_data_header_struct
+from doxygen import Trie, ResultMap, ResultFlag, serialize_search_data, serialize_search_data_sharded, search_data_header_struct, search_data_header_v1_struct, search_manifest_header_struct
 
 from test_doxygen import IntegrationTestCase
 
-def _pretty_print_trie(serialized: bytearray, hashtable, stats, base_offset, indent, show_merged, show_lookahead_barriers, color_map) -> str:
+def _pretty_print_trie(serialized: bytearray, hashtable, stats, base_offset, indent, show_merged, show_lookahead_barriers, color_map, version, result_struct, offset_bytes) -> str:
     # Visualize where the trees were merged
     if show_merged and base_offset in hashtable:
         return color_map['red'] + '#' + color_map['reset']
@@ -46,36 +47,42 @@ def _pretty_print_trie(serialized: bytearray, hashtable, stats, base_offset, ind
     stats.max_node_results = max(result_count, stats.max_node_results)
     stats.max_node_children = max(child_count, stats.max_node_children)
     offset = base_offset + Trie.header_struct.size
+    if version and result_count == 255:
+        result_count = Trie.result_struct.unpack_from(serialized, offset)[0]
+        stats.max_node_results = max(result_count, stats.max_node_results)
+        offset += Trie.result_struct.size
 
     # print results, if any
     if result_count:
         out += color_map['blue'] + ' ['
         for i in range(result_count):
             if i: out += color_map['blue']+', '
-            result = Trie.result_struct.unpack_from(serialized, offset)[0]
+            result = result_struct.unpack_from(serialized, offset)[0]
             stats.max_node_result_index = max(result, stats.max_node_result_index)
             out += color_map['cyan'] + str(result)
-            offset += Trie.result_struct.size
+            offset += result_struct.size
         out += color_map['blue'] + ']'
 
-    # print children, if any
+    # print children, if any. The char is after the offset, which has the
+    # lookahead barrier in the topmost bit.
+    barrier_mask = 1 << (offset_bytes*8 - 1)
     for i in range(child_count):
         if result_count or i:
             out += color_map['reset'] + '\n'
             out += color_map['blue'] + indent + color_map['white']
-        char = Trie.child_char_struct.unpack_from(serialized, offset + 3)[0]
+        char = Trie.child_char_struct.unpack_from(serialized, offset + offset_bytes)[0]
         if char <= 127:
             out += chr(char)
         else:
             out += color_map['reset'] + hex(char)
-        if (show_lookahead_barriers and Trie.child_struct.unpack_from(serialized, offset)[0] & 0x00800000):
+        if (show_lookahead_barriers and Trie.child_struct.unpack_from(serialized, offset)[0] & barrier_mask):
             out += color_map['green'] + '$'
-        if char > 127 or (show_lookahead_barriers and Trie.child_struct.unpack_from(serialized, offset)[0] & 0x00800000):
+        if char > 127 or (show_lookahead_barriers and Trie.child_struct.unpack_from(serialized, offset)[0] & barrier_mask):
             out += color_map['reset'] + '\n' + color_map['blue'] + indent + ' ' + color_map['white']
-        child_offset = Trie.child_struct.unpack_from(serialized, offset)[0] & 0x007fffff
+        child_offset = Trie.child_struct.unpack_from(serialized, offset)[0] & (barrier_mask - 1)
         stats.max_node_child_offset = max(child_offset, stats.max_node_child_offset)
-        offset += Trie.child_struct.size
-        out += _pretty_print_trie(serialized, hashtable, stats, child_offset, indent + ('|' if child_count > 1 else ' '), show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, color_map=color_map)
+        offset += offset_bytes + 1
+        out += _pretty_print_trie(serialized, hashtable, stats, child_offset, indent + ('|' if child_count > 1 else ' '), show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, color_map=color_map, version=version, result_struct=result_struct, offset_bytes=offset_bytes)
         child_count += 1
 
     hashtable[base_offset] = True
@@ -97,7 +104,7 @@ color_map_dummy = {'blue': '',
                    'yellow': '',
                    'reset': ''}
 
-def pretty_print_trie(serialized: bytes, show_merged=False, show_lookahead_barriers=True, colors=False):
+def pretty_print_trie(serialized: bytes, show_merged=False, show_lookahead_barriers=True, colors=False, version=0, result_id_bytes=2, offset_bytes=3):
     color_map = color_map_colors if colors else color_map_dummy
 
     hashtable = {}
@@ -109,7 +116,7 @@ def pretty_print_trie(serialized: bytes, show_merged=False, show_lookahead_barri
     stats.max_node_result_index = 0
     stats.max_node_child_offset = 0
 
-    out = _pretty_print_trie(serialized, hashtable, stats, Trie.root_offset_struct.unpack_from(serialized, 0)[0], '', show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, color_map=color_map)
+    out = _pretty_print_trie(serialized, hashtable, stats, Trie.root_offset_struct.unpack_from(serialized, 0)[0], '', show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, color_map=color_map, version=version, result_struct=Trie.result_struct if result_id_bytes == 2 else struct.Struct('<I'), offset_bytes=offset_bytes)
     if out: out = color_map['white'] + out
     stats = """
 node count:             {}
@@ -119,25 +126,31 @@ max node result index:  {}
 max node child offset:  {}""".lstrip().format(stats.node_count, stats.max_node_results, stats.max_node_children, stats.max_node_result_index, stats.max_node_child_offset)
     return out, stats
 
-def pretty_print_map(serialized: bytes, colors=False):
+def pretty_print_map(serialized: bytes, colors=False, result_id_bytes=2, offset_bytes=3):
     color_map = color_map_colors if colors else color_map_dummy
 
+    # Flags are after the offset in each entry
+    entry_size = offset_bytes + 1
+    offset_mask = 2**(offset_bytes*8) - 1
+    alias_struct = ResultMap.alias_struct if result_id_bytes == 2 else struct.Struct('<I')
+    prefix_struct = ResultMap.prefix_struct if result_id_bytes == 2 else struct.Struct('<IB')
+
     # The first item gives out offset of first value, which can be used to
     # calculate total value count
-    offset = ResultMap.offset_struct.unpack_from(serialized, 0)[0] & 0x00ffffff
-    size = int(offset/4 - 1)
+    offset = ResultMap.offset_struct.unpack_from(serialized, 0)[0] & offset_mask
+    size = int(offset/entry_size - 1)
 
     out = ''
     for i in range(size):
         if i: out += '\n'
-        flags = ResultFlag(ResultMap.flags_struct.unpack_from(serialized, i*4 + 3)[0])
+        flags = ResultFlag(ResultMap.flags_struct.unpack_from(serialized, i*entry_size + offset_bytes)[0])
         extra = []
         if flags & ResultFlag._TYPE == ResultFlag.ALIAS:
-            extra += ['alias={}'.format(ResultMap.alias_struct.unpack_from(serialized, offset)[0])]
-            offset += ResultMap.alias_struct.size
+            extra += ['alias={}'.format(alias_struct.unpack_from(serialized, offset)[0])]
+            offset += alias_struct.size
         if flags & ResultFlag.HAS_PREFIX:
-            extra += ['prefix={}[:{}]'.format(*ResultMap.prefix_struct.unpack_from(serialized, offset))]
-            offset += ResultMap.prefix_struct.size
+            extra += ['prefix={}[:{}]'.format(*prefix_struct.unpack_from(serialized, offset))]
+            offset += prefix_struct.size
         if flags & ResultFlag.HAS_SUFFIX:
             extra += ['suffix_length={}'.format(ResultMap.suffix_length_struct.unpack_from(serialized, offset)[0])]
             offset += ResultMap.suffix_length_struct.size
@@ -147,19 +160,25 @@ def pretty_print_map(serialized: bytes, colors=False):
             extra += ['deleted']
         if flags & ResultFlag._TYPE:
             extra += ['type={}'.format((flags & ResultFlag._TYPE).name)]
-        next_offset = ResultMap.offset_struct.unpack_from(serialized, (i + 1)*4)[0] & 0x00ffffff
+        next_offset = ResultMap.offset_struct.unpack_from(serialized, (i + 1)*entry_size)[0] & offset_mask
         name, _, url = serialized[offset:next_offset].partition(b'\0')
         out += color_map['cyan'] + str(i) + color_map['blue'] + ': ' + color_map['white'] + name.decode('utf-8') + color_map['blue'] + ' [' + color_map['yellow'] + (color_map['blue'] + ', ' + color_map['yellow']).join(extra) + color_map['blue'] + '] ->' + (' ' + color_map['reset'] + url.decode('utf-8') if url else '')
         offset = next_offset
     return out
 
 def pretty_print(serialized: bytes, show_merged=False, show_lookahead_barriers=True, colors=False):
-    magic, version, symbol_count, map_offset = search_data_header_struct.unpack_from(serialized)
+    if serialized[3] == 0:
+        magic, version, symbol_count, map_offset = search_data_header_struct.unpack_from(serialized)
+        result_id_bytes, trie_offset_bytes, map_offset_bytes = 2, 3, 3
+        header_size = search_data_header_struct.size
+    else:
+        magic, version, result_id_bytes, trie_offset_bytes, map_offset_bytes, symbol_count, map_offset = search_data_header_v1_struct.unpack_from(serialized)
+        header_size = search_data_header_v1_struct.size
     assert magic == b'MCS'
-    assert version == 0
+    assert version in [0, 1]
 
-    pretty_trie, stats = pretty_print_trie(serialized[search_data_header_struct.size:map_offset], show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, colors=colors)
-    pretty_map = pretty_print_map(serialized[map_offset:], colors=colors)
+    pretty_trie, stats = pretty_print_trie(serialized[header_size:map_offset], show_merged=show_merged, show_lookahead_barriers=show_lookahead_barriers, colors=colors, version=version, result_id_bytes=result_id_bytes, offset_bytes=trie_offset_bytes)
+    pretty_map = pretty_print_map(serialized[map_offset:], colors=colors, result_id_bytes=result_id_bytes, offset_bytes=map_offset_bytes)
     return '{} symbols\n'.format(symbol_count) + pretty_trie + '\n' + pretty_map, stats
 
 class TrieSerialization(unittest.TestCase):
@@ -167,8 +186,8 @@ class TrieSerialization(unittest.TestCase):
         super().__init__(*args, **kwargs)
         self.maxDiff = None
 
-    def compare(self, serialized: bytes, expected: str):
-        pretty = pretty_print_trie(serialized)[0]
+    def compare(self, serialized: bytes, expected: str, **kwargs):
+        pretty = pretty_print_trie(serialized, **kwargs)[0]
         #print(pretty)
         self.assertEqual(pretty, expected.strip())
 
@@ -277,13 +296,45 @@ h0xc3
 """)
         self.assertEqual(len(serialized), 82)
 
+    def test_32bit(self):
+        trie = Trie()
+
+        trie.insert("math", 0)
+        trie.insert("math::vector", 1, lookahead_barriers=[4])
+        trie.insert("vector", 1)
+
+        serialized = trie.serialize(result_id_bytes=4, offset_bytes=4)
+        self.compare(serialized, """
+math [0]
+|   :$
+|    :vector [1]
+vector [1]
+""", result_id_bytes=4, offset_bytes=4)
+        self.assertEqual(len(serialized), 103)
+
+    def test_many_results(self):
+        trie = Trie()
+
+        for i in range(300):
+            trie.insert("magnum", i)
+        trie.insert("magnum::math", 300, lookahead_barriers=[6])
+
+        # The result count is stored in an extra field
+        serialized = trie.serialize()
+        self.compare(serialized, """
+magnum [{}]
+      :$
+       :math [300]
+""".format(', '.join(str(i) for i in range(300))), version=1)
+        self.assertEqual(len(serialized), 682)
+
 class MapSerialization(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.maxDiff = None
 
-    def compare(self, serialized: bytes, expected: str):
-        pretty = pretty_print_map(serialized)
+    def compare(self, serialized: bytes, expected: str, **kwargs):
+        pretty = pretty_print_map(serialized, **kwargs)
         #print(pretty)
         self.assertEqual(pretty, expected.strip())
 
@@ -327,6 +378,25 @@ class MapSerialization(unittest.TestCase):
 """)
         self.assertEqual(len(serialized), 203)
 
+    def test_32bit(self):
+        map = ResultMap()
+
+        self.assertEqual(map.add("Math", "namespaceMath.html", flags=ResultFlag.NAMESPACE), 0)
+        self.assertEqual(map.add("Math::Vector", "classMath_1_1Vector.html", flags=ResultFlag.CLASS), 1)
+        self.assertEqual(map.add("Math::min()", "namespaceMath.html#abcdef2875", flags=ResultFlag.FUNC), 2)
+        self.assertEqual(map.add("Math::max(int, int)", "namespaceMath.html#abcdef1234", suffix_length=8, flags=ResultFlag.FUNC|ResultFlag.DEPRECATED), 3)
+        self.assertEqual(map.add("Rectangle", "", alias=1), 4)
+
+        serialized = map.serialize(result_id_bytes=4, offset_bytes=4)
+        self.compare(serialized, """
+0: Math [type=NAMESPACE] -> namespaceMath.html
+1: ::Vector [prefix=0[:0], type=CLASS] -> classMath_1_1Vector.html
+2: ::min() [prefix=0[:18], type=FUNC] -> #abcdef2875
+3: ::max(int, int) [prefix=0[:18], suffix_length=8, deprecated, type=FUNC] -> #abcdef1234
+4: Rectangle [alias=1] ->
+""", result_id_bytes=4, offset_bytes=4)
+        self.assertEqual(len(serialized), 161)
+
 class Serialization(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -363,6 +433,87 @@ range [2]
 """)
         self.assertEqual(len(serialized), 241)
 
+    def test_many_symbols(self):
+        trie = Trie()
+        map = ResultMap()
+
+        trie.insert("math", map.add("Math", "namespaceMath.html", flags=ResultFlag.NAMESPACE))
+
+        # The symbol count doesn't fit into 16 bits, version 1 is used, but
+        # with the narrow fields
+        serialized = serialize_search_data(trie, map, 65536)
+        self.assertEqual(serialized[:7], b'MCS\x01\x02\x03\x03')
+        self.compare(serialized, """
+65536 symbols
+math [0]
+0: Math [type=NAMESPACE] -> namespaceMath.html
+""")
+        self.assertEqual(len(serialized), 78)
+
+    def test_many_results(self):
+        trie = Trie()
+        map = ResultMap()
+
+        for i in range(255):
+            trie.insert("math", map.add("Math", "namespaceMath{}.html".format(i), flags=ResultFlag.NAMESPACE))
+
+        # The node result count doesn't fit into 8 bits, version 1 is used
+        serialized = serialize_search_data(trie, map, 255)
+        self.assertEqual(serialized[:7], b'MCS\x01\x02\x03\x03')
+        self.assertEqual(pretty_print(serialized)[0].splitlines()[:2], [
+            '255 symbols',
+            'math [{}]'.format(', '.join(str(i) for i in range(255)))])
+
+class ShardedSerialization(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.maxDiff = None
+
+    def test(self):
+        trie = Trie()
+        map = ResultMap()
+
+        trie.insert("math", map.add("Math", "namespaceMath.html", flags=ResultFlag.NAMESPACE))
+        index = map.add("Math::Vector", "classMath_1_1Vector.html", flags=ResultFlag.CLASS)
+        trie.insert("math::vector", index)
+        trie.insert("vector", index)
+        index = map.add("Math::Range", "classMath_1_1Range.html", flags=ResultFlag.CLASS)
+        trie.insert("math::range", index)
+        trie.insert("range", index)
+        trie.insert("rect", map.add("Rect", "", alias=index))
+
+        manifest, shards = serialize_search_data_sharded(trie, map, 4)
+        self.assertEqual(search_manifest_header_struct.unpack_from(manifest), (b'MCM', 0, 4, 522, 3))
+        self.assertEqual(manifest[search_manifest_header_struct.size:], b'mvr')
+        self.assertEqual(len(manifest) + sum(len(shard) for shard in shards.values()), 522)
+
+        # Each shard has only the results it needs, renumbered, plus the
+        # prefixes and aliased results they reference
+        self.assertEqual(list(shards.keys()), [ord('m'), ord('v'), ord('r')])
+        self.assertEqual(pretty_print(shards[ord('m')])[0], """
+0 symbols
+math [0]
+    ::vector [1]
+      range [2]
+0: Math [type=NAMESPACE] -> namespaceMath.html
+1: ::Vector [prefix=0[:0], type=CLASS] -> classMath_1_1Vector.html
+2: ::Range [prefix=0[:0], type=CLASS] -> classMath_1_1Range.html
+""".strip())
+        self.assertEqual(pretty_print(shards[ord('v')])[0], """
+0 symbols
+vector [0]
+0: ::Vector [prefix=1[:0], type=CLASS] -> classMath_1_1Vector.html
+1: Math [type=NAMESPACE] -> namespaceMath.html
+""".strip())
+        self.assertEqual(pretty_print(shards[ord('r')])[0], """
+0 symbols
+range [0]
+ ect [1]
+0: ::Range [prefix=2[:0], type=CLASS] -> classMath_1_1Range.html
+1: Rect [alias=0] ->
+2: Math [type=NAMESPACE] -> namespaceMath.html
+""".strip())
+
 class Search(IntegrationTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, '', *args, **kwargs)
@@ -61,3 +61,26 @@ class Layout(BaseTestCase):
         self.assertTrue(os.path.exists(os.path.join(self.path, 'output/m-dark+documentation.compiled.css')))
         self.assertTrue(os.path.exists(os.path.join(self.path, 'output/favicon-light.png')))
         self.assertTrue(os.path.exists(os.path.join(self.path, 'output/sitemap.xml')))
+
+class WriteIfChanged(BaseTestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(__file__, '', *args, **kwargs)
+
+    def test(self):
+        self.run_python({'WRITE_IF_CHANGED': True})
+
+        # Nothing changed, so neither the rendered files nor the copied
+        # files should get written again
+        for i in ['index.html', 'm-dark+documentation.compiled.css']:
+            os.utime(os.path.join(self.path, 'output', i), (0, 0))
+        self.run_python({'WRITE_IF_CHANGED': True})
+        for i in ['index.html', 'm-dark+documentation.compiled.css']:
+            self.assertEqual(os.path.getmtime(os.path.join(self.path, 'output', i)), 0)
+
+        # A file with different contents gets overwritten
+        with open(os.path.join(self.path, 'output', 'index.html'), 'a') as f:
+            f.write('modified')
+        self.run_python({'WRITE_IF_CHANGED': True})
+        self.assertNotEqual(os.path.getmtime(os.path.join(self.path, 'output', 'index.html')), 0)
+        with open(os.path.join(self.path, 'output', 'index.html')) as f:
+            self.assertNotIn('modified', f.read())
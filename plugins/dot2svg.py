@@ -24,6 +24,9 @@
 
 import re
 import subprocess
+from hashlib import sha1
+
+import rendercache
 
 _patch_src = re.compile(r"""<\?xml version="1\.0" encoding="UTF-8" standalone="no"\?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1\.1//EN"
@@ -65,9 +68,101 @@ _font_size = 0.0
 # converting to rem here
 def _pt2em(pt): return pt/_font_size
 
+# Cache for rendered graphs (sha1 of the source, size, attribs, font and font
+# size -> (age, svg)), see rendercache.Cache. Besides the cache version, the
+# output of `dot -V` is a part of the version tuple, so a Graphviz upgrade
+# discards the whole cache. The version is queried only once, as it needs to
+# spawn a process.
+_cache_version = 0
+_version_tuple = None
+
+def _version():
+    global _version_tuple
+    if _version_tuple is None:
+        try:
+            dot_version = subprocess.run(['dot', '-V'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode('utf-8').strip()
+        except FileNotFoundError: # pragma: no cover
+            dot_version = None
+        _version_tuple = (_cache_version, dot_version)
+    return _version_tuple
+
+# Version of the output stored in the shared render cache. Unlike the per-site
+# cache file, entries there outlive any particular m.css checkout, so this
+# has to be bumped every time the SVG postprocessing in _dot2svg() changes.
+_shared_format_version = 0
+
+# Key in the shared render cache
+def _shared_key(hash):
+    return rendercache.key('dot', _shared_format_version, _version(), hash)
+
+_cache = rendercache.Cache(_version, 'dot', _shared_key)
+
+# Graphs waiting to be rendered in a single batch by render_deferred()
+# (hash -> (source, size, attribs)), None if rendering is not deferred. In
+# place of the graph, dot2svg() returns a placeholder containing the hash,
+# which is then replaced by substitute_deferred() with the rendered SVG from
+# _rendered (hex hash -> svg).
+_pending = None
+_rendered = {}
+_placeholder = '<!--m.dot:{}-->'
+_placeholder_src = re.compile(r"""<!--m\.dot:(?P<hash>[0-9a-f]{40})-->""")
+
+# How many graphs to pass to a single dot invocation
+batch_size = 64
+
+# Fetch a cached graph or render it and add it to the cache. If rendering is
+# deferred, a placeholder is returned for graphs that aren't cached yet.
 def dot2svg(source, size=None, attribs=''):
+    # If just the shared render cache is used, the rendered graphs are kept
+    # in memory in an empty cache
+    if not _cache and rendercache.directory: unpickle_cache(None)
+
+    # Neither cache nor batching used, pass through
+    if not _cache and _pending is None:
+        return _dot2svg(source, size, attribs)
+
+    hash = sha1(repr((source, size, attribs, _font, _font_size)).encode('utf-8')).digest()
+    if _cache:
+        svg = _cache.get(hash)
+        if svg is not None: return svg
+
+    if _pending is not None:
+        _pending[hash] = (source, size, attribs)
+        return _placeholder.format(hash.hex())
+
+    svg = _dot2svg(source, size, attribs)
+    if _cache: _cache.put(hash, svg)
+    return svg
+
+# Makes subsequent dot2svg() calls return a placeholder instead of rendering
+# the graph right away. Graphs from a previous defer() that weren't rendered
+# are discarded.
+def defer():
+    global _pending, _rendered
+    _pending = {}
+    _rendered = {}
+
+# Renders all graphs collected since defer() in a few dot invocations and
+# puts them into the cache. Stops deferring.
+def render_deferred():
+    global _pending
+    pending = list(_pending.items()) if _pending else []
+    _pending = None
+
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        for (hash, _), svg in zip(batch, _dot2svg_batch([args for _, args in batch])):
+            _rendered[hash.hex()] = svg
+            if _cache: _cache.put(hash, svg)
+
+# Replaces placeholders in given text with graphs rendered by
+# render_deferred()
+def substitute_deferred(text):
+    return _placeholder_src.sub(lambda match: _rendered.get(match.group('hash'), match.group(0)), text)
+
+def _run_dot(source):
     try:
-        ret = subprocess.run(['dot', '-Tsvg',
+        return subprocess.run(['dot', '-Tsvg',
             '-Gfontname={}'.format(_font),
             '-Nfontname={}'.format(_font),
             '-Efontname={}'.format(_font),
@@ -76,13 +171,34 @@ def dot2svg(source, size=None, attribs=''):
             '-Efontsize={}'.format(_font_size),
             '-Gbgcolor=transparent',
             ], input=source.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if ret.returncode: print(ret.stderr.decode('utf-8'))
-        ret.check_returncode()
     except FileNotFoundError: # pragma: no cover
         raise RuntimeError("dot not found")
 
+def _dot2svg(source, size, attribs):
+    ret = _run_dot(source)
+    if ret.returncode: print(ret.stderr.decode('utf-8'))
+    ret.check_returncode()
+
+    return _patch(ret.stdout.decode('utf-8'), size, attribs)
+
+# Renders a list of (source, size, attribs) in a single dot invocation. If
+# dot fails or the output can't be matched back to the input graphs (for
+# example because a @dotfile contains more than one graph), falls back to
+# rendering them one by one so errors are reported for the offending graph.
+def _dot2svg_batch(graphs):
+    if len(graphs) > 1:
+        ret = _run_dot('\n'.join(source for source, _, _ in graphs))
+        if not ret.returncode:
+            # Each graph results in a separate SVG document in the output
+            svgs = ['<?xml ' + svg for svg in ret.stdout.decode('utf-8').split('<?xml ')[1:]]
+            if len(svgs) == len(graphs):
+                return [_patch(svg, size, attribs) for svg, (_, size, attribs) in zip(svgs, graphs)]
+
+    return [_dot2svg(source, size, attribs) for source, size, attribs in graphs]
+
+def _patch(svg, size, attribs):
     # First remove comments
-    svg = _comment_src.sub('', ret.stdout.decode('utf-8'))
+    svg = _comment_src.sub('', svg)
 
     # Remove preamble and fixed size
     if size:
@@ -128,3 +244,10 @@ def configure(font, font_size):
     _font = font
     _font_size = font_size
     _text_src = re.compile(_text_src_src.format(font=_font))
+
+unpickle_cache = _cache.load
+pickle_cache = _cache.save
+record_used_cache_entries = _cache.record_used
+take_used_cache_entries = _cache.take_used
+merge_cache_entries = _cache.merge
+mark_cache_entries_used = _cache.mark_used
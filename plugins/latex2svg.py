@@ -46,6 +46,9 @@ default_params = {
     'latex_cmd': latex_cmd,
     'dvisvgm_cmd': dvisvgm_cmd,
     'libgs': None,
+    # Path to a format file created by make_format() with the template
+    # header and preamble already loaded, used if set
+    'fmt': None,
 }
 
 
@@ -59,6 +62,89 @@ if not hasattr(os.environ, 'LIBGS') and not find_library('gs'):
         print('Warning: libgs not found')
 
 
+def _get_size(output, fontsize):
+    regex = r'\b([0-9.]+)pt x ([0-9.]+)pt'
+    match = re.search(regex, output)
+    if match:
+        return (float(match.group(1)) / fontsize,
+                float(match.group(2)) / fontsize)
+    else:
+        return None, None
+
+
+def _get_measure(output, name, fontsize):
+    regex = r'\b%s=([0-9.e-]+)pt' % name
+    match = re.search(regex, output)
+    if match:
+        return float(match.group(1)) / fontsize
+    else:
+        return None
+
+
+_page_id_src = re.compile(r"""<g id='page\d+'>""")
+
+
+def _document(code, params):
+    document = (params['template']
+                .replace('{{ preamble }}', params['preamble'])
+                .replace('{{ fontsize }}', str(params['fontsize']))
+                .replace('{{ code }}', code))
+
+    # Everything before \begin{document} is already in the format file
+    if params.get('fmt'):
+        document = document[document.index('\\begin{document}'):]
+
+    return document
+
+
+def _latex_cmd(params, filename):
+    cmd = shlex.split(params['latex_cmd'])
+    env = None
+    if params.get('fmt'):
+        # Look for the format in its directory first, the trailing separator
+        # makes kpathsea append the default search path
+        env = os.environ.copy()
+        env['TEXFORMATS'] = os.path.dirname(os.path.abspath(params['fmt'])) + os.pathsep
+        cmd += ['-fmt=' + os.path.splitext(os.path.basename(params['fmt']))[0]]
+    return cmd + [filename], env
+
+
+def make_format(params, filename):
+    """Precompile the template header and preamble into a LaTeX format file.
+
+    Passing the resulting file as `fmt` in the conversion parameters avoids
+    loading all packages from scratch for every `latex2svg()` call.
+
+    Parameters
+    ----------
+    params : dict
+        Conversion parameters. The `fmt` parameter is ignored.
+    filename : str
+        Where to put the format file, with a `.fmt` extension. The file is
+        replaced atomically, so concurrent calls with the same parameters
+        are safe.
+    """
+    params = params.copy()
+    params['fmt'] = None
+    document = _document('', params)
+    header = document[:document.index('\\begin{document}')]
+
+    with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(filename))) as tmpdir:
+        with open(os.path.join(tmpdir, 'preamble.tex'), 'w') as f:
+            f.write(header + '\n\\dump\n')
+
+        # Load the LaTeX format, process the header and dump the result
+        try:
+            ret = subprocess.run(shlex.split(params['latex_cmd']) + ['-ini', '-jobname=preamble', '&latex', 'preamble.tex'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 cwd=tmpdir)
+            ret.check_returncode()
+        except FileNotFoundError:
+            raise RuntimeError('latex not found')
+
+        os.replace(os.path.join(tmpdir, 'preamble.fmt'), filename)
+
+
 def latex2svg(code, params=default_params, working_directory=None):
     """Convert LaTeX to SVG using dvisvgm.
 
@@ -86,19 +172,17 @@ def latex2svg(code, params=default_params, working_directory=None):
             return latex2svg(code, params, working_directory=tmpdir)
 
     fontsize = params['fontsize']
-    document = (params['template']
-                .replace('{{ preamble }}', params['preamble'])
-                .replace('{{ fontsize }}', str(fontsize))
-                .replace('{{ code }}', code))
+    document = _document(code, params)
 
     with open(os.path.join(working_directory, 'code.tex'), 'w') as f:
         f.write(document)
 
     # Run LaTeX and create DVI file
     try:
-        ret = subprocess.run(shlex.split(params['latex_cmd']+' code.tex'),
+        cmd, env = _latex_cmd(params, 'code.tex')
+        ret = subprocess.run(cmd,
                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                             cwd=working_directory)
+                             cwd=working_directory, env=env)
         # LaTeX prints errors on stdout instead of stderr (stderr is empty),
         # so print stdout instead
         if ret.returncode: print(ret.stdout.decode('utf-8'))
@@ -125,29 +209,107 @@ def latex2svg(code, params=default_params, working_directory=None):
         svg = f.read()
 
     # Parse dvisvgm output for size and alignment
-    def get_size(output):
-        regex = r'\b([0-9.]+)pt x ([0-9.]+)pt'
-        match = re.search(regex, output)
-        if match:
-            return (float(match.group(1)) / fontsize,
-                    float(match.group(2)) / fontsize)
-        else:
-            return None, None
-
-    def get_measure(output, name):
-        regex = r'\b%s=([0-9.e-]+)pt' % name
-        match = re.search(regex, output)
-        if match:
-            return float(match.group(1)) / fontsize
-        else:
-            return None
-
     output = ret.stderr.decode('utf-8')
-    width, height = get_size(output)
-    depth = get_measure(output, 'depth')
+    width, height = _get_size(output, fontsize)
+    depth = _get_measure(output, 'depth', fontsize)
     return {'svg': svg, 'depth': depth, 'width': width, 'height': height}
 
 
+def latex2svg_batch(codes, params=default_params, working_directory=None):
+    """Convert a list of LaTeX snippets to SVG in a single LaTeX and dvisvgm run.
+
+    Each snippet is typeset as a separate preview page of one document, which
+    is then converted with a single dvisvgm call. The template is expected to
+    have ``{{ code }}`` inside a ``preview`` environment.
+
+    Parameters
+    ----------
+    codes : list of str
+        LaTeX code snippets to render.
+    params : dict
+        Conversion parameters.
+    working_directory : str or None
+        Working directory for external commands and place for temporary files.
+
+    Returns
+    -------
+    list of dict
+        Output information for each snippet, in the same format as returned
+        by `latex2svg()`.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If LaTeX or dvisvgm fails for any of the snippets. Unlike
+        `latex2svg()`, the output is not printed, so the caller can fall back
+        to rendering the snippets one by one.
+    """
+    if working_directory is None:
+        with TemporaryDirectory() as tmpdir:
+            return latex2svg_batch(codes, params, working_directory=tmpdir)
+
+    fontsize = params['fontsize']
+
+    # Each snippet is in its own group and with the equation counter reset,
+    # so definitions and equation numbers don't leak into the following
+    # pages and the output is the same as when rendering it alone
+    snippets = ['\\begingroup\\setcounter{equation}{0}%\n' + code + '\n\\endgroup' for code in codes]
+    document = _document('\n\\end{preview}\n\\begin{preview}\n'.join(snippets), params)
+
+    with open(os.path.join(working_directory, 'code.tex'), 'w') as f:
+        f.write(document)
+
+    # Run LaTeX and create DVI file with one page per snippet
+    try:
+        cmd, env = _latex_cmd(params, 'code.tex')
+        ret = subprocess.run(cmd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=working_directory, env=env)
+        ret.check_returncode()
+    except FileNotFoundError:
+        raise RuntimeError('latex not found')
+
+    # Add LIBGS to environment if supplied
+    env = os.environ.copy()
+    if params['libgs']:
+        env['LIBGS'] = params['libgs']
+
+    # Convert all DVI pages to SVG, each to a separate file
+    try:
+        ret = subprocess.run(shlex.split(params['dvisvgm_cmd']+' --page=1- code.dvi'),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=working_directory, env=env)
+        ret.check_returncode()
+    except FileNotFoundError:
+        raise RuntimeError('dvisvgm not found')
+
+    # The dvisvgm output has a "processing page N" section for every page,
+    # containing its size, alignment and name of the file it was written to
+    output = ret.stderr.decode('utf-8')
+    pages = re.split(r'^processing page \d+', output, flags=re.MULTILINE)[1:]
+    if len(pages) != len(codes):
+        raise subprocess.CalledProcessError(0, ret.args, ret.stdout, ret.stderr)
+
+    out = []
+    for page in pages:
+        # Treat an unexpected log format the same as a failure, so the caller
+        # falls back to rendering the snippets one by one
+        filename = re.search(r'output written to (.+\.svg)', page)
+        if not filename:
+            raise subprocess.CalledProcessError(0, ret.args, ret.stdout, ret.stderr)
+        with open(os.path.join(working_directory, filename.group(1)), 'r') as f:
+            svg = f.read()
+
+        # The page number is used as an ID in the SVG, make it the same as
+        # with a single snippet
+        svg = _page_id_src.sub("<g id='page1'>", svg)
+
+        width, height = _get_size(page, fontsize)
+        depth = _get_measure(page, 'depth', fontsize)
+        out += [{'svg': svg, 'depth': depth, 'width': width, 'height': height}]
+    return out
+
+
 def main():
     """Simple command line interface to latex2svg.
 
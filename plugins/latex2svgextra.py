@@ -22,12 +22,18 @@
 #   DEALINGS IN THE SOFTWARE.
 #
 
+import glob
 import html
-import pickle
+import multiprocessing
+import os
 import re
+import shlex
+import sqlite3
+import subprocess
 from hashlib import sha1
 
 import latex2svg
+import rendercache
 
 # Extracted common code used by both doxygen.py and the m.math plugin to
 # avoid dependency of doxygen.py on Pelican
@@ -70,6 +76,63 @@ params.update({
     'dvisvgm_cmd': 'dvisvgm --no-fonts -Z 1.25',
     })
 
+# Directory in which a LaTeX format file with the preamble from params gets
+# precompiled on first use, so LaTeX doesn't need to load all the packages
+# again for every formula. The filename contains a hash of the preamble and
+# the TeX installation, so it gets rebuilt when either of them changes. None
+# if not used.
+_format_directory = None
+_format_params = None
+
+def configure_format(directory):
+    global _format_directory, _format_params
+    _format_directory = directory
+    _format_params = None
+
+def _format_hash():
+    hash = sha1(repr((params['template'], params['preamble'], params['fontsize'], params['latex_cmd'])).encode('utf-8'))
+
+    # LaTeX version and path and modification time of the LaTeX format
+    # the custom one is built from, which changes on a TeX installation update
+    try:
+        hash.update(subprocess.run([shlex.split(params['latex_cmd'])[0], '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout)
+        latex_fmt = subprocess.run(['kpsewhich', '-engine=pdftex', '-progname=latex', 'latex.fmt'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8').strip()
+    except FileNotFoundError: # pragma: no cover
+        latex_fmt = ''
+    if latex_fmt and os.path.exists(latex_fmt):
+        hash.update(repr((latex_fmt, os.path.getmtime(latex_fmt))).encode('utf-8'))
+
+    return hash.hexdigest()
+
+# Params to render the formulas with, pointing to the format file if enabled.
+# If the format can't be created, falls back to the original params.
+def _params():
+    global _format_params
+    if not _format_directory: return params
+
+    if _format_params is None:
+        _format_params = params
+        fmt = os.path.join(_format_directory, 'm.math.{}.fmt'.format(_format_hash()))
+        if not os.path.exists(fmt):
+            try:
+                latex2svg.make_format(params, fmt)
+            except (subprocess.CalledProcessError, RuntimeError, OSError):
+                return params
+
+            # Remove formats for a different preamble or TeX installation.
+            # Another process may be doing the same.
+            for i in glob.glob(os.path.join(_format_directory, 'm.math.*.fmt')):
+                if i == fmt: continue
+                try:
+                    os.remove(i)
+                except FileNotFoundError: # pragma: no cover
+                    pass
+
+        _format_params = params.copy()
+        _format_params['fmt'] = fmt
+
+    return _format_params
+
 # Mapping from color codes to CSS classes. Keep in sync with m.plots.
 _class_mapping = {
     ('fill=\'#cafe03\'', 'class=\'m-default\''),
@@ -104,59 +167,256 @@ _unique_dst = r"""\g<name>='\g<ref>eq{counter}-\g<id>'"""
 # Reset back to zero on start of a new page for reproducible behavior.
 counter = 0
 
-# Cache for rendered formulas (source formula sha1 -> (depth, svg data)). The
-# counter is not included
+# Cache for rendered formulas (source formula sha1 -> (age, (depth, svg
+# data))), see rendercache.Cache. The counter is not included.
 _cache_version = 0
-_cache = None
+
+# How long to wait for other processes holding a lock on the database, in
+# seconds
+_db_timeout = 60
+
+def _open_db(file):
+    db = sqlite3.connect(file, timeout=_db_timeout)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS meta (version INTEGER, age INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS formulas (hash BLOB PRIMARY KEY, age INTEGER, depth REAL, svg TEXT)')
+
+    # Locked by another process for longer than the timeout or an I/O error.
+    # The file may be a perfectly fine cache used by another build right now,
+    # so it's definitely not deleted.
+    except sqlite3.OperationalError:
+        db.close()
+        raise
+
+    # Not a database, probably a cache pickled by an older version. Replace
+    # it with an empty one.
+    except sqlite3.DatabaseError:
+        db.close()
+        os.remove(file)
+        return _open_db(file)
+
+    return db
+
+# Unlike the other caches, this one is stored in an SQLite database, from which
+# entries are loaded into memory only when looked up, so rebuilding a single
+# page doesn't need to load everything. Multiple processes can read and update
+# the same file at the same time. The age of each entry is the age of the last
+# save that used it, see save() for how it's used for pruning. If the shared
+# render cache is configured, the database is not used at all.
+class _FormulaCache(rendercache.Cache):
+    def __init__(self):
+        super().__init__(lambda: _cache_version, 'math', lambda hash: _shared_key(hash))
+        self.db = None
+        self.db_file = None
+        # Whether the database has entries of the expected version. If not,
+        # they're not looked up and get replaced on save.
+        self.db_valid = False
+
+    # Opens the database and bumps the cache age
+    def load(self, file):
+        self.shared = bool(rendercache.directory)
+        if self.shared: file = None
+        self.db = _open_db(file) if file else None
+        self.db_file = file
+        self.version = _cache_version
+        self.entries = {}
+        row = self.db.execute('SELECT version, age FROM meta').fetchone() if self.db else None
+
+        # Reset the cache if not valid or not expected version. The database
+        # itself is left untouched until save(), as other processes may be
+        # still using it.
+        self.db_valid = bool(row) and row[0] == _cache_version
+        if not self.db_valid:
+            self.age = 0
+
+        # Otherwise bump cache age
+        else: self.age = row[1] + 1
+
+    # Saves entries used in this run to the database and prunes entries that
+    # were used neither in this run nor by the previous save. The previous
+    # save can be from another build using the same file, which may have
+    # started before or after this one, so the age is taken from the database
+    # again. All that is done in a single transaction that blocks other
+    # writers, so concurrent builds keep each other's entries from their last
+    # run.
+    def save(self, file):
+        # Don't save any file if there is nothing or the shared render cache
+        # is used instead
+        if self.shared or not self.entries: return
+
+        db = self.db if self.db and self.db_file == file else _open_db(file)
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT version, age FROM meta').fetchone()
+
+            # A different version, replace everything
+            if not row or row[0] != _cache_version:
+                age = self.age
+                db.execute('DELETE FROM formulas')
+            else:
+                age = row[1] + 1
+                db.execute('DELETE FROM formulas WHERE age < ?', (row[1], ))
+
+            db.executemany('INSERT OR REPLACE INTO formulas VALUES (?, ?, ?, ?)',
+                [(hash, age) + entry[1] for hash, entry in self.entries.items() if entry[0] == self.age])
+            db.execute('DELETE FROM meta')
+            db.execute('INSERT INTO meta VALUES (?, ?)', (_cache_version, age))
+
+    # Loads the entry from the database if it's not in memory yet
+    def lookup(self, hash):
+        if hash not in self.entries and self.db_valid:
+            row = self.db.execute('SELECT age, depth, svg FROM formulas WHERE hash = ?', (hash, )).fetchone()
+            if row: self.entries[hash] = (row[0], (row[1], row[2]))
+
+        return super().lookup(hash)
+
+    def _from_json(self, value):
+        return tuple(value)
+
+_cache = _FormulaCache()
+
+# Version of the output stored in the shared render cache. Unlike the per-site
+# cache above, entries there outlive any particular m.css checkout, so this
+# has to be bumped every time the SVG postprocessing in latex2svg changes.
+_shared_format_version = 0
+
+# Key in the shared render cache. Unlike with the cache above, which is
+# specific to given site, the conversion parameters are a part of it.
+def _shared_key(hash):
+    return rendercache.key('math', _shared_format_version, _cache_version, params['template'], params['preamble'], params['fontsize'], params['latex_cmd'], params['dvisvgm_cmd'], hash)
 
 # Fetch cached formula or render it and add to the cache. The formula has to
 # be already wrapped in $, $$ etc. environment.
 def fetch_cached_or_render(formula):
-    global _cache
-
-    # Cache not used, pass through
+    # Cache not used, pass through. If just the shared render cache is used,
+    # the rendered formulas are kept in memory in an empty cache.
     if not _cache:
-        out = latex2svg.latex2svg(formula, params=params)
-        return out['depth'], out['svg']
+        if rendercache.directory: unpickle_cache(None)
+        else:
+            out = latex2svg.latex2svg(formula, params=_params())
+            return out['depth'], out['svg']
 
     hash = sha1(formula.encode('utf-8')).digest()
-    if not hash in _cache[2]:
-        out = latex2svg.latex2svg(formula, params=params)
-        _cache[2][hash] = (_cache[1], out['depth'], out['svg'])
-    else:
-        _cache[2][hash] = (_cache[1], _cache[2][hash][1], _cache[2][hash][2])
-    return (_cache[2][hash][1], _cache[2][hash][2])
+    cached = _cache.get(hash)
+    if cached is None:
+        out = latex2svg.latex2svg(formula, params=_params())
+        cached = (out['depth'], out['svg'])
+        _cache.put(hash, cached)
+    return cached
+
+# At most how many formulas to render in a single LaTeX run in
+# render_batch()
+batch_size = 100
+
+def _render_batch(args):
+    formulas, params = args
+    try:
+        return latex2svg.latex2svg_batch(formulas, params=params)
+    except subprocess.CalledProcessError:
+        return None
+
+# Renders formulas that aren't in the cache yet and puts them into the cache
+# so subsequent fetch_cached_or_render() calls don't need to spawn any
+# processes. The formulas are split into batches rendered in a single LaTeX
+# and dvisvgm run each, which are distributed among a pool of `jobs`
+# processes, by default as many as there are CPU cores. If a batch fails, its
+# formulas are left to be rendered by fetch_cached_or_render(), which then
+# reports the error for the offending formula. Returns the newly added cache
+# entries.
+def render_batch(formulas, jobs=None):
+    if not _cache: return {}
+
+    pending = {}
+    for formula in formulas:
+        hash = sha1(formula.encode('utf-8')).digest()
+        if not _cache.lookup(hash): pending[hash] = formula
+    pending = list(pending.items())
+    if not pending: return {}
 
-def unpickle_cache(file):
-    global _cache
+    # Daemonic processes (such as doxygen.py --jobs workers) can't have
+    # children
+    if jobs is None: jobs = os.cpu_count() or 1
+    if multiprocessing.current_process().daemon: jobs = 1
 
-    if file:
-        with open(file, 'rb') as f:
-            _cache = pickle.load(f)
+    # Make the batches small enough to keep all processes busy. The format
+    # file, if any, is created here so the processes don't race for it.
+    size = max(1, min(batch_size, -(-len(pending)//jobs)))
+    batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+    args = [([formula for _, formula in batch], _params()) for batch in batches]
+    if jobs > 1 and len(batches) > 1:
+        with multiprocessing.Pool(min(jobs, len(batches))) as pool:
+            outs = pool.map(_render_batch, args)
     else:
-        _cache = None
+        outs = map(_render_batch, args)
 
-    # Reset the cache if not valid or not expected version
-    if not _cache or _cache[0] != _cache_version:
-        _cache = (_cache_version, 0, {})
+    entries = {}
+    for batch, out in zip(batches, outs):
+        if out is None: continue
+        for (hash, _), out in zip(batch, out):
+            entries[hash] = (_cache.age, (out['depth'], out['svg']))
+    _cache.merge(entries, rendered=True)
+    return entries
 
-    # Otherwise bump cache age
-    else: _cache = (_cache[0], _cache[1] + 1, _cache[2])
+# Formulas waiting to be rendered and patched by render_deferred(), as a list
+# of (formula, text, attribs, inline), None if rendering is not deferred. In
+# place of each, fetch_cached_or_render_and_patch() returns a placeholder
+# with its index, which is then replaced by substitute_deferred() with the
+# patched SVG from _patched.
+_pending = None
+_patched = []
+_placeholder = '<!--m.math:{}-->'
+_placeholder_src = re.compile(r"""<!--m\.math:(?P<index>\d+)-->""")
 
-def pickle_cache(file):
-    global _cache
+# Fetch cached formula or render it and patch it with the formula text and
+# attributes, see patch(). The depth is used only for inline formulas. If
+# rendering is deferred, returns a placeholder instead.
+def fetch_cached_or_render_and_patch(formula, text, attribs, inline):
+    if _pending is None:
+        depth, svg = fetch_cached_or_render(formula)
+        return patch(text, svg, depth if inline else None, attribs)
 
-    # Don't save any file if there is nothing
-    if not _cache or not _cache[2]: return
+    _pending.append((formula, text, attribs, inline))
+    return _placeholder.format(len(_pending) - 1)
 
-    # Prune entries that were not used
-    cache_to_save = (_cache_version, _cache[1], {})
-    for hash, entry in _cache[2].items():
-        if entry[0] != _cache[1]: continue
-        cache_to_save[2][hash] = entry
+# Makes subsequent fetch_cached_or_render_and_patch() calls return a
+# placeholder instead of rendering the formula right away. Formulas from a
+# previous defer() that weren't rendered are discarded.
+def defer():
+    global _pending, _patched
+    _pending = []
+    _patched = []
+
+# Renders all formulas collected since defer() that aren't cached yet in
+# parallel using render_batch() and patches them. That's done in the order
+# the formulas were collected in, so the IDs made unique using the counter
+# are the same as without deferring. Stops deferring.
+def render_deferred():
+    global _pending, _patched
+    pending = _pending or []
+    _pending = None
+
+    # Rendered formulas need to be stored somewhere even if the cache is not
+    # used
+    if not _cache: unpickle_cache(None)
+
+    render_batch([formula for formula, _, _, _ in pending])
+    _patched = [fetch_cached_or_render_and_patch(*i) for i in pending]
+
+# Replaces placeholders in given text with formulas rendered by
+# render_deferred()
+def substitute_deferred(text):
+    def repl(match):
+        index = int(match.group('index'))
+        return _patched[index] if index < len(_patched) else match.group(0)
+    return _placeholder_src.sub(repl, text)
 
-    with open(file, 'wb') as f:
-        pickle.dump(cache_to_save, f)
+# The names are kept from when the cache was a pickled dict
+unpickle_cache = _cache.load
+pickle_cache = _cache.save
+record_used_cache_entries = _cache.record_used
+take_used_cache_entries = _cache.take_used
+merge_cache_entries = _cache.merge
+mark_cache_entries_used = _cache.mark_used
 
 # Patches the output from dvisvgm
 def patch(formula, svg, depth, attribs):
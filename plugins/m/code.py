@@ -33,25 +33,20 @@ import docutils.parsers.rst.directives.misc
 from docutils import io, nodes, utils, statemachine
 
 from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import TextLexer, BashSessionLexer, get_lexer_by_name
+from pygments.lexers import TextLexer, BashSessionLexer
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 import ansilexer
+import pygmentsextra
 
 def _highlight(code, language, options, is_block):
-    # Use our own lexer for ANSI
-    if language == 'ansi':
-        lexer = ansilexer.AnsiLexer()
-    else:
-        try:
-            lexer = get_lexer_by_name(language)
-        except ValueError:
-            logger.warning("No lexer found for language '{}', code highlighting disabled".format(language))
-            lexer = TextLexer()
+    lexer = pygmentsextra.lexer_for_name(language)
+    if not lexer:
+        logger.warning("No lexer found for language '{}', code highlighting disabled".format(language))
+        lexer = TextLexer()
 
     if (isinstance(lexer, BashSessionLexer) or
         isinstance(lexer, ansilexer.AnsiLexer)):
@@ -59,10 +54,7 @@ def _highlight(code, language, options, is_block):
     else:
         class_ = 'm-code'
 
-    if isinstance(lexer, ansilexer.AnsiLexer):
-        formatter = ansilexer.HtmlAnsiFormatter(**options)
-    else:
-        formatter = HtmlFormatter(nowrap=True, **options)
+    formatter = pygmentsextra.formatter_for(lexer, **options)
     parsed = highlight(code, lexer, formatter).rstrip()
     if not is_block: parsed.lstrip()
 
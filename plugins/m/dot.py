@@ -22,6 +22,8 @@
 #   DEALINGS IN THE SOFTWARE.
 #
 
+import copy
+import os
 import pelican
 import re
 import subprocess
@@ -30,8 +32,19 @@ from docutils import nodes
 from docutils.parsers import rst
 from docutils.parsers.rst import directives
 from docutils.parsers.rst.roles import set_classes
+from docutils.transforms import Transform
 
 import dot2svg
+import rendercache
+
+default_settings = {
+    'INPUT': '',
+    'M_DOT_FONT': 'Source Sans Pro',
+    'M_DOT_FONT_SIZE': 16.0,
+    'M_DOT_CACHE_FILE': 'm.dot.cache'
+}
+
+settings = None
 
 def _is_graph_figure(parent):
     # The parent has to be a figure, marked as m-figure
@@ -44,6 +57,21 @@ def _is_graph_figure(parent):
 
     return True
 
+class RenderDeferredGraphs(Transform):
+    """
+    Renders all graphs of a document in a single batch once it's parsed and
+    replaces their placeholders in the raw HTML nodes
+    """
+
+    default_priority = 850
+
+    def apply(self):
+        dot2svg.render_deferred()
+        for node in self.document.traverse(nodes.raw):
+            text = node.astext()
+            substituted = dot2svg.substitute_deferred(text)
+            if substituted != text: node.replace(node[0], nodes.Text(substituted))
+
 class Dot(rst.Directive):
     has_content = True
     optional_arguments = 1
@@ -54,6 +82,13 @@ class Dot(rst.Directive):
     def run(self, source):
         set_classes(self.options)
 
+        # Defer rendering of all graphs in the document to a single batch
+        # done by RenderDeferredGraphs once the whole document is parsed
+        document = self.state.document
+        if not any(transform[1] is RenderDeferredGraphs for transform in document.transformer.transforms):
+            dot2svg.defer()
+            document.transformer.add_transform(RenderDeferredGraphs)
+
         # If this is the first real node inside a graph figure, put the SVG
         # directly inside
         parent = self.state.parent
@@ -102,17 +137,37 @@ class StrictGraph(Dot):
             self.arguments[0] if self.arguments else '',
             '\n'.join(self.content)))
 
-def register_mcss(mcss_settings, **kwargs):
-    dot2svg.configure(
-        mcss_settings.get('M_DOT_FONT', 'Source Sans Pro'),
-        mcss_settings.get('M_DOT_FONT_SIZE', 16.0))
+def save_cache(*args):
+    if settings['M_DOT_CACHE_FILE']:
+        dot2svg.pickle_cache(settings['M_DOT_CACHE_FILE'])
+    rendercache.evict()
+
+def register_mcss(mcss_settings, hooks_post_run, **kwargs):
+    global default_settings, settings
+    settings = copy.deepcopy(default_settings)
+    for key in settings.keys():
+        if key in mcss_settings: settings[key] = mcss_settings[key]
+
+    dot2svg.configure(settings['M_DOT_FONT'], settings['M_DOT_FONT_SIZE'])
+
+    if settings['M_DOT_CACHE_FILE']:
+        settings['M_DOT_CACHE_FILE'] = os.path.join(settings['INPUT'], settings['M_DOT_CACHE_FILE'])
+
+        if os.path.exists(settings['M_DOT_CACHE_FILE']):
+            dot2svg.unpickle_cache(settings['M_DOT_CACHE_FILE'])
+        else:
+            dot2svg.unpickle_cache(None)
+
+    hooks_post_run += [save_cache]
+
     rst.directives.register_directive('digraph', Digraph)
     rst.directives.register_directive('strict-digraph', StrictDigraph)
     rst.directives.register_directive('graph', Graph)
     rst.directives.register_directive('strict-graph', StrictGraph)
 
 def _pelican_configure(pelicanobj):
-    register_mcss(mcss_settings=pelicanobj.settings)
+    register_mcss(mcss_settings=pelicanobj.settings, hooks_post_run=[])
 
 def register(): # for Pelican
     pelican.signals.initialized.connect(_pelican_configure)
+    pelican.signals.finalized.connect(save_cache)
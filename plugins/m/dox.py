@@ -28,12 +28,13 @@ from docutils.parsers import rst
 from docutils.parsers.rst.roles import set_classes
 
 from pelican import signals
-import xml.etree.ElementTree as ET
 import os
 import re
 
 import logging
 
+import xmlbackend
+
 logger = logging.getLogger(__name__)
 
 # Modified from __init__ to add support for queries and hashes
@@ -69,7 +70,7 @@ def init(tagfiles, input):
         tagfile_basenames += [(os.path.splitext(os.path.basename(tagfile))[0], path, css_classes)]
         symbol_prefixes += prefixes
 
-        tree = ET.parse(os.path.join(input, tagfile))
+        tree = xmlbackend.parse(os.path.join(input, tagfile))
         root = tree.getroot()
         for child in root:
             if child.tag == 'compound' and 'kind' in child.attrib:
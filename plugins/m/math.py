@@ -31,11 +31,13 @@ from docutils import nodes, utils
 from docutils.parsers import rst
 from docutils.parsers.rst import directives
 from docutils.parsers.rst.roles import set_classes
+from docutils.transforms import Transform
 
 import pelican.signals
 
 import latex2svg
 import latex2svgextra
+import rendercache
 
 default_settings = {
     'INPUT': '',
@@ -56,6 +58,28 @@ def _is_math_figure(parent):
 
     return True
 
+class RenderDeferredMath(Transform):
+    """
+    Renders all formulas of a document that aren't cached yet in parallel
+    once it's parsed and replaces their placeholders in the raw HTML nodes
+    """
+
+    default_priority = 850
+
+    def apply(self):
+        latex2svgextra.render_deferred()
+        for node in self.document.traverse(nodes.raw):
+            text = node.astext()
+            substituted = latex2svgextra.substitute_deferred(text)
+            if substituted != text: node.replace(node[0], nodes.Text(substituted))
+
+# Defer rendering of all formulas in the document to RenderDeferredMath, done
+# once the whole document is parsed
+def _defer(document):
+    if not any(transform[1] is RenderDeferredMath for transform in document.transformer.transforms):
+        latex2svgextra.defer()
+        document.transformer.add_transform(RenderDeferredMath)
+
 class Math(rst.Directive):
     option_spec = {'class': directives.class_option,
                    'name': directives.unchanged}
@@ -81,18 +105,18 @@ class Math(rst.Directive):
 
         content = '\n'.join(self.content)
 
-        _, svg = latex2svgextra.fetch_cached_or_render("$$" + content + "$$")
+        _defer(self.state.document)
 
         # If this is the first real node inside a math figure, put the SVG
         # directly inside
         if _is_math_figure(parent):
-            node = nodes.raw(self.block_text, latex2svgextra.patch(content, svg, None, ' class="{}"'.format(' '.join(['m-math'] + self.options.get('classes', [])))), format='html')
+            node = nodes.raw(self.block_text, latex2svgextra.fetch_cached_or_render_and_patch("$$" + content + "$$", content, ' class="{}"'.format(' '.join(['m-math'] + self.options.get('classes', []))), inline=False), format='html')
             node.line = self.content_offset + 1
             self.add_name(node)
             return [node]
 
         # Otherwise wrap it in a <div class="m-math">
-        node = nodes.raw(self.block_text, latex2svgextra.patch(content, svg, None, ''), format='html')
+        node = nodes.raw(self.block_text, latex2svgextra.fetch_cached_or_render_and_patch("$$" + content + "$$", content, '', inline=False), format='html')
         node.line = self.content_offset + 1
         self.add_name(node)
         container = nodes.container(**self.options)
@@ -128,15 +152,16 @@ def math(role, rawtext, text, lineno, inliner, options={}, content=[]):
         classes += ' ' + ' '.join(options['classes'])
         del options['classes']
 
-    depth, svg = latex2svgextra.fetch_cached_or_render("$" + text + "$")
+    _defer(inliner.document)
 
     attribs = ' class="{}"'.format(classes)
-    node = nodes.raw(rawtext, latex2svgextra.patch(text, svg, depth, attribs), format='html', **options)
+    node = nodes.raw(rawtext, latex2svgextra.fetch_cached_or_render_and_patch("$" + text + "$", text, attribs, inline=True), format='html', **options)
     return [node], []
 
 def save_cache(*args):
     if settings['M_MATH_CACHE_FILE']:
         latex2svgextra.pickle_cache(settings['M_MATH_CACHE_FILE'])
+    rendercache.evict()
 
 def register_mcss(mcss_settings, hooks_pre_page, hooks_post_run, **kwargs):
     global default_settings, settings
@@ -152,6 +177,11 @@ def register_mcss(mcss_settings, hooks_pre_page, hooks_post_run, **kwargs):
         else:
             latex2svgextra.unpickle_cache(None)
 
+        # Precompile the math preamble next to the cache file
+        latex2svgextra.configure_format(os.path.dirname(os.path.abspath(settings['M_MATH_CACHE_FILE'])))
+    else:
+        latex2svgextra.configure_format(None)
+
     hooks_pre_page += [new_page]
     hooks_post_run += [save_cache]
 
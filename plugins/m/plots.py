@@ -37,6 +37,8 @@ import io
 
 import pelican.signals
 
+import rendercache
+
 mpl.rcParams['font.size'] = '11'
 mpl.rcParams['axes.titlesize'] = '13'
 
@@ -130,6 +132,11 @@ _bar_titles_src = '<g id="plot{}-value{}">'
 _bar_titles_dst = '<g id="plot{}-value{}"><title>{} {}</title>'
 _bar_titles_dst_error = '<g id="plot{}-value{}"><title>{} ± {} {}</title>'
 
+# Version of the output stored in the shared render cache. The cache outlives
+# any particular m.css checkout, so this has to be bumped every time the
+# patching above changes.
+_shared_format_version = 0
+
 class Plot(rst.Directive):
     required_arguments = 1
     optional_arguments = 0
@@ -185,52 +192,59 @@ class Plot(rst.Directive):
         # Increase hashsalt for every plot to ensure (hopefully) unique SVG IDs
         mpl.rcParams['svg.hashsalt'] = int(mpl.rcParams['svg.hashsalt']) + 1
 
-        # Setup the graph
-        fig, ax = plt.subplots()
-        # TODO: let matplotlib calculate the height somehow
-        fig.set_size_inches(8, 0.78 + len(values)*bar_height)
-        yticks = np.arange(len(labels))
-        plot = ax.barh(yticks, values, xerr=errors,
-                       align='center', color=colors, ecolor='#cafe0a', capsize=5*bar_height/0.4)
-        for i, v in enumerate(plot):
-            v.set_gid('plot{}-value{}'.format(mpl.rcParams['svg.hashsalt'], i))
-        ax.set_yticks(yticks)
-        ax.invert_yaxis() # top-to-bottom
-        ax.set_xlabel(units)
-        ax.set_title(title)
-
-        # Value labels. If extra label is specified, create two multiline texts
-        # with first having the second line empty and second having the first
-        # line empty.
-        if labels_extra:
-            ax.set_yticklabels([y + ('' if labels_extra[i] == '..' else '\n') for i, y in enumerate(labels)])
-            for i, label in enumerate(ax.get_yticklabels()):
-                if labels_extra[i] == '..': continue
-                ax.text(0, i + 0.05, '\n' + labels_extra[i],
-                        va='center', ha='right',
-                        transform=label.get_transform(), color='#cafe0b')
-        else: ax.set_yticklabels(labels)
-
-        # Export to SVG
-        fig.patch.set_visible(False) # hide the white background
-        imgdata = io.StringIO()
-        fig.savefig(imgdata, format='svg')
-        plt.close() # otherwise it consumes a lot of memory in autoreload mode
-
-        # Patch the rendered output: remove preable and hardcoded size
-        imgdata = _patch_src.sub(_patch_dst, imgdata.getvalue())
-        # Remove needless newlines and trailing whitespace in path data
-        imgdata = _path_patch2_src.sub(_path_patch2_dst, _path_patch_src.sub(_path_patch_dst, imgdata))
-        # Replace color codes with CSS classes
-        for src, dst in _class_mapping: imgdata = imgdata.replace(src, dst)
-        # Add titles for bars
-        for i in range(len(values)):
-            if errors: imgdata = imgdata.replace(
-                _bar_titles_src.format(mpl.rcParams['svg.hashsalt'], i),
-                _bar_titles_dst_error.format(mpl.rcParams['svg.hashsalt'], i, values[i], errors[i], units))
-            else: imgdata = imgdata.replace(
-                _bar_titles_src.format(mpl.rcParams['svg.hashsalt'], i),
-                _bar_titles_dst.format(mpl.rcParams['svg.hashsalt'], i, values[i], units))
+        # Fetch the plot from the shared render cache, if enabled. The salt is
+        # a part of the key as it's used in element IDs.
+        cache_key = rendercache.key('plot', _shared_format_version, mpl.__version__, mpl.rcParams['font.family'], mpl.rcParams['svg.hashsalt'], title, units, labels, labels_extra, values, errors, colors, bar_height)
+        imgdata = rendercache.get('plot', cache_key)
+        if imgdata is None:
+            # Setup the graph
+            fig, ax = plt.subplots()
+            # TODO: let matplotlib calculate the height somehow
+            fig.set_size_inches(8, 0.78 + len(values)*bar_height)
+            yticks = np.arange(len(labels))
+            plot = ax.barh(yticks, values, xerr=errors,
+                           align='center', color=colors, ecolor='#cafe0a', capsize=5*bar_height/0.4)
+            for i, v in enumerate(plot):
+                v.set_gid('plot{}-value{}'.format(mpl.rcParams['svg.hashsalt'], i))
+            ax.set_yticks(yticks)
+            ax.invert_yaxis() # top-to-bottom
+            ax.set_xlabel(units)
+            ax.set_title(title)
+
+            # Value labels. If extra label is specified, create two multiline
+            # texts with first having the second line empty and second having
+            # the first line empty.
+            if labels_extra:
+                ax.set_yticklabels([y + ('' if labels_extra[i] == '..' else '\n') for i, y in enumerate(labels)])
+                for i, label in enumerate(ax.get_yticklabels()):
+                    if labels_extra[i] == '..': continue
+                    ax.text(0, i + 0.05, '\n' + labels_extra[i],
+                            va='center', ha='right',
+                            transform=label.get_transform(), color='#cafe0b')
+            else: ax.set_yticklabels(labels)
+
+            # Export to SVG
+            fig.patch.set_visible(False) # hide the white background
+            imgdata = io.StringIO()
+            fig.savefig(imgdata, format='svg')
+            plt.close() # otherwise it consumes a lot of memory in autoreload
+                        # mode
+
+            # Patch the rendered output: remove preable and hardcoded size
+            imgdata = _patch_src.sub(_patch_dst, imgdata.getvalue())
+            # Remove needless newlines and trailing whitespace in path data
+            imgdata = _path_patch2_src.sub(_path_patch2_dst, _path_patch_src.sub(_path_patch_dst, imgdata))
+            # Replace color codes with CSS classes
+            for src, dst in _class_mapping: imgdata = imgdata.replace(src, dst)
+            # Add titles for bars
+            for i in range(len(values)):
+                if errors: imgdata = imgdata.replace(
+                    _bar_titles_src.format(mpl.rcParams['svg.hashsalt'], i),
+                    _bar_titles_dst_error.format(mpl.rcParams['svg.hashsalt'], i, values[i], errors[i], units))
+                else: imgdata = imgdata.replace(
+                    _bar_titles_src.format(mpl.rcParams['svg.hashsalt'], i),
+                    _bar_titles_dst.format(mpl.rcParams['svg.hashsalt'], i, values[i], units))
+            rendercache.put('plot', cache_key, imgdata)
 
         container = nodes.container(**self.options)
         container['classes'] += ['m-plot']
@@ -241,7 +255,10 @@ class Plot(rst.Directive):
 def new_page(*args):
     mpl.rcParams['svg.hashsalt'] = 0
 
-def register_mcss(mcss_settings, hooks_pre_page, **kwargs):
+def save_cache(*args):
+    rendercache.evict()
+
+def register_mcss(mcss_settings, hooks_pre_page, hooks_post_run, **kwargs):
     font = mcss_settings.get('M_PLOTS_FONT', 'Source Sans Pro')
     for i in range(len(_class_mapping)):
         src, dst = _class_mapping[i]
@@ -249,12 +266,14 @@ def register_mcss(mcss_settings, hooks_pre_page, **kwargs):
     mpl.rcParams['font.family'] = font
 
     hooks_pre_page += [new_page]
+    hooks_post_run += [save_cache]
 
     rst.directives.register_directive('plot', Plot)
 
 def _pelican_configure(pelicanobj):
-    register_mcss(mcss_settings=pelicanobj.settings, hooks_pre_page=[])
+    register_mcss(mcss_settings=pelicanobj.settings, hooks_pre_page=[], hooks_post_run=[])
 
 def register(): # for Pelican
     pelican.signals.initialized.connect(_pelican_configure)
+    pelican.signals.finalized.connect(save_cache)
     pelican.signals.content_object_init.connect(new_page)
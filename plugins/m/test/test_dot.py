@@ -22,6 +22,8 @@
 #   DEALINGS IN THE SOFTWARE.
 #
 
+import os
+import pickle
 import re
 import subprocess
 import sys
@@ -44,7 +46,8 @@ class Dot(PelicanPluginTestCase):
     def test(self):
         self.run_pelican({
             'PLUGINS': ['m.htmlsanity', 'm.components', 'm.dot'],
-            'M_DOT_FONT': 'DejaVu Sans'
+            'M_DOT_FONT': 'DejaVu Sans',
+            'M_DOT_CACHE_FILE': None
         })
 
         self.assertEqual(*self.actual_expected_contents('page.html'))
@@ -55,7 +58,40 @@ class Dot(PelicanPluginTestCase):
     def test_238(self):
         self.run_pelican({
             'PLUGINS': ['m.htmlsanity', 'm.components', 'm.dot'],
-            'M_DOT_FONT': 'DejaVu Sans'
+            'M_DOT_FONT': 'DejaVu Sans',
+            'M_DOT_CACHE_FILE': None
         })
 
         self.assertEqual(*self.actual_expected_contents('page.html', 'page-238.html'))
+
+    @unittest.skipUnless(LooseVersion(sys.version) >= LooseVersion("3.5") and
+                         LooseVersion(dot_version()) >= LooseVersion("2.40.1"),
+                         "The dot plugin requires at least Python 3.5 installed. Dot < 2.40.1 has a completely different output.")
+    def test_cached(self):
+        cache_file = os.path.join(self.path, 'dot.cache')
+        if os.path.exists(cache_file): os.remove(cache_file)
+
+        # The first run fills the cache with all rendered graphs
+        self.run_pelican({
+            'PLUGINS': ['m.htmlsanity', 'm.components', 'm.dot'],
+            'M_DOT_FONT': 'DejaVu Sans',
+            'M_DOT_CACHE_FILE': cache_file
+        })
+        self.assertEqual(*self.actual_expected_contents('page.html'))
+        with open(cache_file, 'rb') as f:
+            dot_cache = pickle.load(f)
+        self.assertEqual(dot_cache[1], 0)
+        self.assertTrue(dot_cache[2])
+
+        # The second run reuses them, producing the same output and bumping
+        # the age of all entries
+        self.run_pelican({
+            'PLUGINS': ['m.htmlsanity', 'm.components', 'm.dot'],
+            'M_DOT_FONT': 'DejaVu Sans',
+            'M_DOT_CACHE_FILE': cache_file
+        })
+        self.assertEqual(*self.actual_expected_contents('page.html'))
+        with open(cache_file, 'rb') as f:
+            dot_cache_actual = pickle.load(f)
+        self.assertEqual(dot_cache_actual, (dot_cache[0], 1, {
+            hash: (1, svg) for hash, (age, svg) in dot_cache[2].items()}))
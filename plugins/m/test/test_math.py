@@ -23,17 +23,41 @@
 #
 
 import os
-import pickle
 import sys
 import shutil
+import sqlite3
+import subprocess
+import tempfile
 import unittest
 
 from hashlib import sha1
 
 from distutils.version import LooseVersion
 
+import latex2svg
+import latex2svgextra
+
 from . import PelicanPluginTestCase
 
+# The math cache is an SQLite database, convert it from / to a (version, age,
+# {hash: (age, depth, svg)}) tuple for easier comparison
+def write_math_cache(file, cache):
+    if os.path.exists(file): os.remove(file)
+    db = sqlite3.connect(file)
+    db.execute('CREATE TABLE meta (version INTEGER, age INTEGER)')
+    db.execute('CREATE TABLE formulas (hash BLOB PRIMARY KEY, age INTEGER, depth REAL, svg TEXT)')
+    db.execute('INSERT INTO meta VALUES (?, ?)', cache[:2])
+    db.executemany('INSERT INTO formulas VALUES (?, ?, ?, ?)', [(hash, ) + entry for hash, entry in cache[2].items()])
+    db.commit()
+    db.close()
+
+def read_math_cache(file):
+    db = sqlite3.connect(file)
+    version, age = db.execute('SELECT version, age FROM meta').fetchone()
+    entries = {hash: (age, depth, svg) for hash, age, depth, svg in db.execute('SELECT hash, age, depth, svg FROM formulas')}
+    db.close()
+    return (version, age, entries)
+
 class Math(PelicanPluginTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(__file__, '', *args, **kwargs)
@@ -116,9 +140,9 @@ class Cached(PelicanPluginTestCase):
         math_cache = (0, 5, {
             tau_half_hash: (5, 0.344841, tau_half),
             fermat_hash: (5, 0.0, fermat),
-            b'does not exist': (5, 0.0, 'something')})
-        with open(cache_file, 'wb') as f:
-            pickle.dump(math_cache, f)
+            b'used by another build': (5, 0.0, 'something'),
+            b'does not exist': (4, 0.0, 'something')})
+        write_math_cache(cache_file, math_cache)
 
         self.run_pelican({
             'PLUGINS': ['m.htmlsanity', 'm.math'],
@@ -128,12 +152,13 @@ class Cached(PelicanPluginTestCase):
         self.assertEqual(*self.actual_expected_contents('page.html'))
 
         # Expect that after the operation the global cache age is bumped,
-        # unused entries removed and used entries age bumped as well
-        with open(cache_file, 'rb') as f:
-            math_cache_actual = pickle.load(f)
+        # used entries age bumped as well and entries not used in this nor
+        # the previous run removed
+        math_cache_actual = read_math_cache(cache_file)
         math_cache_expected = (0, 6, {
             tau_half_hash: (6, 0.344841, tau_half),
-            fermat_hash: (6, 0.0, fermat)})
+            fermat_hash: (6, 0.0, fermat),
+            b'used by another build': (5, 0.0, 'something')})
         self.assertEqual(math_cache_actual, math_cache_expected)
 
 class Uncached(PelicanPluginTestCase):
@@ -146,8 +171,7 @@ class Uncached(PelicanPluginTestCase):
         cache_file = os.path.join(self.path, 'math.cache')
 
         # Write some bullshit there, which gets immediately reset
-        with open(cache_file, 'wb') as f:
-            pickle.dump((1337, 0, {"something different"}), f)
+        write_math_cache(cache_file, (1337, 0, {b'something different': (0, 0.0, 'something')}))
 
         self.run_pelican({
             'PLUGINS': ['m.htmlsanity', 'm.math'],
@@ -164,11 +188,107 @@ class Uncached(PelicanPluginTestCase):
         self.assertEqual(actual_contents, expected_contents)
 
         # Expect that after the operation the global cache is filled
-        with open(cache_file, 'rb') as f:
-            math_cache_actual = pickle.load(f)
+        math_cache_actual = read_math_cache(cache_file)
         math_cache_expected = (0, 0, {
             sha1("$\\frac{\\tau}{2}$".encode('utf-8')).digest():
                 (0, 0.344841, tau_half),
             sha1("$$a^3 + b^3 \\neq c^3$$".encode('utf-8')).digest():
                 (0, 0.0, fermat)})
         self.assertEqual(math_cache_actual, math_cache_expected)
+
+class Batch(unittest.TestCase):
+    # Defines a macro that would fail to be defined again if it leaked to the
+    # next page, and both are numbered so their equation counters would
+    # continue from the previous page
+    definition = r"""\newcommand{\foo}{x}
+\begin{align}
+a &= \foo
+\end{align}"""
+    equations = r"""\begin{align}
+b &= c \\
+d &= e
+\end{align}"""
+
+    @unittest.skipUnless(shutil.which('latex'),
+                         "Math rendering requires LaTeX installed")
+    def test(self):
+        batch = latex2svg.latex2svg_batch([self.definition, self.equations, self.definition])
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch[0], latex2svg.latex2svg(self.definition))
+        self.assertEqual(batch[1], latex2svg.latex2svg(self.equations))
+        self.assertEqual(batch[2], batch[0])
+
+    # Doesn't need LaTeX, as the processes are faked
+    def test_unexpected_dvisvgm_output(self):
+        def run(cmd, *args, **kwargs):
+            return subprocess.CompletedProcess(cmd, 0, b'', b'processing page 1\n  something unexpected\n')
+
+        run_original = latex2svg.subprocess.run
+        latex2svg.subprocess.run = run
+        try:
+            with self.assertRaises(subprocess.CalledProcessError):
+                latex2svg.latex2svg_batch(['$a$'])
+        finally:
+            latex2svg.subprocess.run = run_original
+
+# Doesn't need LaTeX, the cache is filled directly
+class CacheDatabase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.file = os.path.join(tmpdir.name, 'math.cache')
+
+    def test_locked(self):
+        write_math_cache(self.file, (0, 5, {b'formula': (5, 0.0, 'svg')}))
+
+        # Another process holding the database locked for longer than the
+        # timeout is an error, but the database isn't touched
+        db = sqlite3.connect(self.file, isolation_level=None)
+        db.execute('BEGIN EXCLUSIVE')
+        timeout = latex2svgextra._db_timeout
+        latex2svgextra._db_timeout = 0.1
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                latex2svgextra.unpickle_cache(self.file)
+        finally:
+            latex2svgextra._db_timeout = timeout
+            db.execute('ROLLBACK')
+            db.close()
+
+        self.assertEqual(read_math_cache(self.file), (0, 5, {b'formula': (5, 0.0, 'svg')}))
+
+    def test_concurrent(self):
+        write_math_cache(self.file, (0, 5, {
+            b'first': (5, 0.0, 'first svg'),
+            b'second': (5, 0.0, 'second svg'),
+            b'old': (3, 0.0, 'old svg')}))
+
+        # One build uses the first formula and saves. Another that starts
+        # after uses just the second one and shouldn't remove the first
+        # formula, as it was used by the previous save.
+        latex2svgextra.unpickle_cache(self.file)
+        latex2svgextra.mark_cache_entries_used([b'first'])
+        latex2svgextra.pickle_cache(self.file)
+        self.assertEqual(read_math_cache(self.file), (0, 6, {
+            b'first': (6, 0.0, 'first svg'),
+            b'second': (5, 0.0, 'second svg')}))
+
+        latex2svgextra.unpickle_cache(self.file)
+        latex2svgextra.mark_cache_entries_used([b'second'])
+        latex2svgextra.pickle_cache(self.file)
+        self.assertEqual(read_math_cache(self.file), (0, 7, {
+            b'first': (6, 0.0, 'first svg'),
+            b'second': (7, 0.0, 'second svg')}))
+
+    def test_version_mismatch(self):
+        write_math_cache(self.file, (1337, 5, {b'formula': (5, 0.0, 'svg')}))
+
+        # Entries of a different version are not used, but removed only on
+        # save, as another process may be still reading them
+        latex2svgextra.unpickle_cache(self.file)
+        latex2svgextra.mark_cache_entries_used([b'formula'])
+        self.assertEqual(read_math_cache(self.file), (1337, 5, {b'formula': (5, 0.0, 'svg')}))
+
+        latex2svgextra.merge_cache_entries({b'another': (0, (0.0, 'another svg'))})
+        latex2svgextra.pickle_cache(self.file)
+        self.assertEqual(read_math_cache(self.file), (0, 0, {b'another': (0, 0.0, 'another svg')}))
@@ -25,6 +25,8 @@
 import os
 import unittest
 
+import rendercache
+
 from . import PelicanPluginTestCase
 
 class Plots(PelicanPluginTestCase):
@@ -38,3 +40,27 @@ class Plots(PelicanPluginTestCase):
         })
 
         self.assertEqual(*self.actual_expected_contents('page.html'))
+
+    def test_shared_cache(self):
+        cache_dir = os.path.join(self.path, 'output/cache')
+        rendercache.configure(cache_dir)
+        try:
+            self.run_pelican({
+                'PLUGINS': ['m.htmlsanity', 'm.plots'],
+                'M_PLOTS_FONT': 'DejaVu Sans'
+            })
+            self.assertEqual(*self.actual_expected_contents('page.html'))
+
+            # All plots should be in the shared cache now
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(os.path.join(cache_dir, 'plot'))), 2)
+
+            # Second run takes the plots from the cache, the output should be
+            # the same
+            os.remove(os.path.join(self.path, 'output/page.html'))
+            self.run_pelican({
+                'PLUGINS': ['m.htmlsanity', 'm.plots'],
+                'M_PLOTS_FONT': 'DejaVu Sans'
+            })
+            self.assertEqual(*self.actual_expected_contents('page.html'))
+        finally:
+            rendercache.configure(None)
@@ -0,0 +1,123 @@
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+import os
+import pickle
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+import rendercache
+
+class RenderCache(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.addCleanup(rendercache.configure, rendercache.directory, rendercache.size_limit)
+        rendercache.configure(tmpdir.name)
+        rendercache.take_added()
+
+    def test(self):
+        key = rendercache.key('math', 'a^2')
+        self.assertIsNone(rendercache.get('math', key))
+
+        rendercache.put('math', key, (0.5, '<svg></svg>'))
+        self.assertEqual(rendercache.get('math', key), [0.5, '<svg></svg>'])
+
+        # The entries are plain JSON
+        with open(os.path.join(rendercache.directory, 'math', key[:2], key)) as f:
+            self.assertEqual(f.read(), '[0.5, "<svg></svg>"]')
+
+    def test_pickle_not_loaded(self):
+        # Anybody with write access to the directory could put a pickle
+        # executing arbitrary code there, which should be treated as a
+        # broken entry instead
+        class Payload:
+            def __reduce__(self):
+                return (exec, ("raise AssertionError('unpickled')", ))
+
+        key = rendercache.key('dot', 'digraph {}')
+        os.makedirs(os.path.dirname(os.path.join(rendercache.directory, 'dot', key[:2], key)))
+        with open(os.path.join(rendercache.directory, 'dot', key[:2], key), 'wb') as f:
+            pickle.dump(Payload(), f)
+        self.assertIsNone(rendercache.get('dot', key))
+
+    def test_evict(self):
+        rendercache.configure(rendercache.directory, 100)
+        walk = Mock(wraps=os.walk)
+        with patch('os.walk', walk):
+            # Nothing put, nothing done
+            rendercache.evict()
+            self.assertEqual(walk.call_count, 0)
+            self.assertFalse(os.path.exists(os.path.join(rendercache.directory, 'size')))
+
+            # The total is unknown at first, so the tree is walked once
+            rendercache.put('dot', rendercache.key('a'), 'a'*40)
+            rendercache.evict()
+            self.assertEqual(walk.call_count, 1)
+
+            # Then only the remembered total gets updated while it fits
+            rendercache.put('dot', rendercache.key('b'), 'b'*40)
+            rendercache.evict()
+            self.assertEqual(walk.call_count, 1)
+            with open(os.path.join(rendercache.directory, 'size')) as f:
+                self.assertEqual(f.read(), '84')
+
+            # Once it doesn't fit anymore, the tree is walked again and the
+            # least recently used entry gets removed
+            os.utime(os.path.join(rendercache.directory, 'dot', rendercache.key('a')[:2], rendercache.key('a')), (0, 0))
+            rendercache.put('dot', rendercache.key('c'), 'c'*40)
+            rendercache.evict()
+            self.assertEqual(walk.call_count, 2)
+            self.assertIsNone(rendercache.get('dot', rendercache.key('a')))
+            self.assertEqual(rendercache.get('dot', rendercache.key('b')), 'b'*40)
+            with open(os.path.join(rendercache.directory, 'size')) as f:
+                self.assertEqual(f.read(), '84')
+
+            # Size put by other processes counts as well
+            rendercache.merge_added(10)
+            rendercache.evict()
+            self.assertEqual(walk.call_count, 2)
+            with open(os.path.join(rendercache.directory, 'size')) as f:
+                self.assertEqual(f.read(), '94')
+
+    def test_cache(self):
+        cache = rendercache.Cache(lambda: 0, 'code', lambda hash: rendercache.key('code', hash))
+        cache.load(None)
+        cache.put(b'a', 'highlighted')
+
+        # Nothing saved to the per-site file, the shared directory is used
+        # instead
+        file = os.path.join(rendercache.directory, 'code.cache')
+        cache.save(file)
+        self.assertFalse(os.path.exists(file))
+        self.assertEqual(rendercache.get('code', rendercache.key('code', b'a')), 'highlighted')
+
+        # A new run finds it there and ignores the per-site file
+        with open(file, 'wb') as f:
+            pickle.dump((0, 0, {b'b': (0, 'stale')}), f)
+        cache = rendercache.Cache(lambda: 0, 'code', lambda hash: rendercache.key('code', hash))
+        cache.load(file)
+        self.assertEqual(cache.get(b'a'), 'highlighted')
+        self.assertIsNone(cache.get(b'b'))
@@ -0,0 +1,130 @@
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+import os
+from hashlib import sha1
+
+import pygments
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, find_lexer_class_for_filename
+
+import ansilexer
+import rendercache
+
+# Lexer and formatter instances, shared by all highlighted code in a run.
+# Looking up a lexer by filename goes through the glob patterns of every lexer
+# Pygments knows and for short snippets that alone takes about as long as the
+# highlighting itself. Lexers and formatters keep only their options, so the
+# instances can be reused. Lookups that found nothing are remembered as None.
+_lexers_by_name = {}
+_lexers_by_filename = {}
+_formatters = {}
+
+def lexer_for_name(name):
+    if name not in _lexers_by_name:
+        # Our own lexer for ANSI
+        if name == 'ansi':
+            lexer = ansilexer.AnsiLexer()
+        else:
+            try:
+                lexer = get_lexer_by_name(name)
+            except ValueError:
+                lexer = None
+        _lexers_by_name[name] = lexer
+    return _lexers_by_name[name]
+
+# Custom mapping of filenames to languages, checked before asking Pygments.
+# The result is remembered for the whole filename and not just the extension,
+# as Pygments has patterns such as CMakeLists.txt.
+_filename_mapping = [('.h', 'c++'),
+                     ('.h.cmake', 'c++'),
+                     # Pygments knows only .vert, .frag, .geo
+                     ('.glsl', 'glsl'),
+                     ('.conf', 'ini'),
+                     ('.xml-jinja', 'xml+jinja'),
+                     ('.html-jinja', 'html+jinja'),
+                     ('.jinja', 'jinja'),
+                     ('.ansi', 'ansi')]
+
+def lexer_for_filename(filename):
+    if filename not in _lexers_by_filename:
+        for suffix, name in _filename_mapping:
+            if filename.endswith(suffix):
+                lexer = lexer_for_name(name)
+                break
+
+        # Put some bogus prefix to the filename in case it is just `.ext`
+        else:
+            lexer = find_lexer_class_for_filename("code" + filename)
+            if lexer: lexer = lexer()
+        _lexers_by_filename[filename] = lexer
+    return _lexers_by_filename[filename]
+
+def formatter_for(lexer, **options):
+    if isinstance(lexer, ansilexer.AnsiLexer):
+        type_ = ansilexer.HtmlAnsiFormatter
+    else:
+        type_ = HtmlFormatter
+        options['nowrap'] = True
+
+    key = (type_, repr(sorted(options.items())))
+    if key not in _formatters:
+        _formatters[key] = type_(**options)
+    return _formatters[key]
+
+# Cache for highlighted code (sha1 of the code, lexer and formatter ->
+# (age, highlighted code)), see rendercache.Cache. Besides the cache version,
+# the Pygments version and the contents of the ansilexer module (which is
+# maintained here and thus can change without a version bump) are part of the
+# version tuple, so an update of either discards the whole cache.
+_cache_version = 0
+
+def _version():
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ansilexer.py'), 'rb') as f:
+        return (_cache_version, pygments.__version__, sha1(f.read()).digest())
+
+_cache = rendercache.Cache(_version)
+
+# Highlight the code or fetch it from the cache. Lexer and formatter options
+# are part of the key, the instances are expected to not carry any other
+# state.
+def highlight_cached(code, lexer, formatter):
+    key = sha1(code.encode('utf-8'))
+    for i in [lexer, formatter]:
+        key.update(repr((type(i).__module__, type(i).__qualname__, sorted(i.options.items()))).encode('utf-8'))
+    hash = key.digest()
+
+    highlighted = _cache.get(hash)
+    if highlighted is None:
+        highlighted = highlight(code, lexer, formatter)
+        _cache.put(hash, highlighted)
+    return highlighted
+
+unpickle_cache = _cache.load
+pickle_cache = _cache.save
+record_used_cache_entries = _cache.record_used
+take_used_cache_entries = _cache.take_used
+merge_cache_entries = _cache.merge
+mark_cache_entries_used = _cache.mark_used
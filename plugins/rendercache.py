@@ -0,0 +1,311 @@
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+import json
+import os
+import pickle
+import tempfile
+from hashlib import sha1
+
+# Render cache shared by doxygen.py, python.py and the Pelican plugins. It's
+# a directory shared by all of them, so a formula rendered for the C++ docs
+# doesn't need to be rendered again for the Python docs or the project
+# website. If configured, it's used instead of the per-site cache files for
+# math and graphs, see the Cache class below. Entries are files named after a
+# hash of everything the output depends on, stored in
+# <directory>/<kind>/<first two hash digits>/<hash>. Values are stored as
+# JSON and not pickled, as anybody who can write to the directory could then
+# execute arbitrary code in every build using it. Files are written
+# atomically, so multiple processes can use the same directory at the same
+# time. Modification time of each file is bumped every time the entry is
+# used and once the total size of the directory exceeds the limit, least
+# recently used entries get removed by evict().
+#
+# Configured with the MCSS_CACHE_DIR environment variable, with
+# MCSS_CACHE_SIZE being the size limit in megabytes. Disabled if
+# MCSS_CACHE_DIR is not set.
+default_size_limit = 256*1024*1024
+
+directory = None
+size_limit = default_size_limit
+
+# How many bytes were put into the directory by this process since the last
+# evict() or take_added()
+_added = 0
+
+# File in the directory remembering its total size as of the last evict(), so
+# the whole tree doesn't need to be walked every time. It's updated without
+# any locking, so concurrent builds may lose each other's updates, but the
+# tree is walked and the total corrected every time the limit is reached.
+_size_file = 'size'
+
+def configure(dir, limit=default_size_limit):
+    global directory, size_limit
+    directory = dir or None
+    size_limit = limit
+
+def _configure_from_environment():
+    size = os.environ.get('MCSS_CACHE_SIZE')
+    configure(os.environ.get('MCSS_CACHE_DIR'), int(float(size)*1024*1024) if size else default_size_limit)
+
+_configure_from_environment()
+
+# Makes a hash from everything given output depends on, to be used as a key
+# for get() and put()
+def key(*args):
+    return sha1(repr(args).encode('utf-8')).hexdigest()
+
+def _path(kind, key):
+    return os.path.join(directory, kind, key[:2], key)
+
+# Returns a cached value of given kind or None if there's no such entry or the
+# cache is disabled. Lists (such as the (depth, svg) tuples for math) are
+# returned as lists.
+def get(kind, key):
+    if not directory: return None
+
+    path = _path(kind, key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            value = json.load(f)
+
+    # Not there (or just evicted by another process) or broken, which is
+    # treated the same. Invalid JSON and UTF-8 are both a ValueError.
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # Mark as recently used. Another process may have evicted it meanwhile.
+    try:
+        os.utime(path)
+    except FileNotFoundError: # pragma: no cover
+        pass
+
+    return value
+
+# Puts a value of given kind into the cache. The value has to be
+# representable in JSON. Does nothing if the cache is disabled.
+def put(kind, key, value):
+    global _added
+    if not directory: return
+
+    path = _path(kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first and then move it in place so other
+    # processes never see a partially written file. The JSON is ASCII-only,
+    # so its length is the file size.
+    data = json.dumps(value)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+    _added += len(data)
+
+# Returns how many bytes this process put into the directory since the last
+# call and resets the counter. Used by doxygen.py to pass the counts from its
+# worker processes to the parent via merge_added(), which then calls evict().
+def take_added():
+    global _added
+    added, _added = _added, 0
+    return added
+
+def merge_added(added):
+    global _added
+    _added += added
+
+def _read_size():
+    try:
+        with open(os.path.join(directory, _size_file), 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_size(size):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(size))
+    os.replace(tmp, os.path.join(directory, _size_file))
+
+# If the cache exceeds the size limit, removes least recently used entries
+# until it fits again. Does nothing if nothing was put into the cache since
+# the last call. Otherwise the size is only added to the remembered total
+# and the tree is walked only if the total exceeds the limit.
+def evict():
+    global _added
+    if not directory or not _added: return
+    added, _added = _added, 0
+
+    size = _read_size()
+    if size is not None and size + added <= size_limit:
+        _write_size(size + added)
+        return
+
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            # Temporary files of other processes currently writing and the
+            # remembered total size
+            if filename.startswith('.tmp') or (dirpath == directory and filename == _size_file): continue
+
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # pragma: no cover
+                continue
+            entries += [(stat.st_mtime, stat.st_size, path)]
+            total += stat.st_size
+
+    if total > size_limit:
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError: # pragma: no cover
+                pass
+            total -= size
+            if total <= size_limit: break
+
+    _write_size(total)
+
+# Per-site cache of rendered output, used by latex2svgextra, pygmentsextra and
+# dot2svg. Unlike the shared directory above, it's a single file specific to
+# given site. Every time it's loaded, the cache age is bumped, entries used in
+# the run get the new age and on save everything that has an older age (i.e.,
+# wasn't used in the last run) is pruned. The whole cache is discarded if the
+# version returned by the `version` function differs.
+#
+# If `kind` is set and the shared directory is configured, the directory is
+# used instead of the file, with `shared_key` making a key for it from the
+# per-site hash. Entries are then kept in memory only for the duration of the
+# run and nothing is pruned on save, that's left to evict().
+#
+# In addition, entries used since the last call to record_used() can be taken
+# by take_used(). That's used by parallel and incremental rendering in
+# doxygen.py to merge cache updates from worker processes back and to know
+# which entries a file needs. Entries are (age, value) tuples.
+class Cache:
+    def __init__(self, version, kind=None, shared_key=None):
+        self._version = version
+        self._kind = kind
+        self._shared_key = shared_key
+        self.version = None
+        self.age = 0
+        # None if not loaded, in which case the cache is not used
+        self.entries = None
+        self.used = None
+        # Whether the shared directory is used instead of the file
+        self.shared = False
+
+    def __bool__(self):
+        return self.entries is not None
+
+    # Loads the cache from a file or creates an empty one if the file is
+    # None or the shared directory is used instead, and bumps the cache age
+    def load(self, file):
+        self.shared = bool(self._kind and directory)
+        cache = None
+        if file and not self.shared:
+            with open(file, 'rb') as f:
+                cache = pickle.load(f)
+
+        # Reset the cache if not valid or not expected version
+        self.version = self._version()
+        if not cache or cache[0] != self.version:
+            self.age, self.entries = 0, {}
+
+        # Otherwise bump cache age
+        else: self.age, self.entries = cache[1] + 1, cache[2]
+
+    # Saves the entries used in this run to a file, pruning the rest. Doesn't
+    # create any file if there's nothing or if the shared directory is used.
+    def save(self, file):
+        if self.shared or not self.entries: return
+
+        with open(file, 'wb') as f:
+            pickle.dump((self.version, self.age, {hash: entry for hash, entry in self.entries.items() if entry[0] == self.age}), f)
+
+    # Returns an entry without marking it as used, or None if it's not there.
+    # Entries not in memory yet are loaded from the shared directory, which
+    # marks them as recently used there. Subclasses can load entries lazily
+    # from elsewhere as well.
+    def lookup(self, hash):
+        entry = self.entries.get(hash)
+        if entry is None and self.shared:
+            value = get(self._kind, self._shared_key(hash))
+            if value is None: return None
+            entry = self.entries[hash] = (self.age, self._from_json(value))
+        return entry
+
+    # JSON has no tuples, subclasses can convert values loaded from the shared
+    # directory back here
+    def _from_json(self, value):
+        return value
+
+    # Returns a value and marks it as used in this run, or None if it's not
+    # there
+    def get(self, hash):
+        if self.used is not None: self.used.add(hash)
+        entry = self.lookup(hash)
+        if entry is None: return None
+
+        self.entries[hash] = (self.age, entry[1])
+        return entry[1]
+
+    # Adds a newly rendered value, marking it as used in this run
+    def put(self, hash, value):
+        if self.used is not None: self.used.add(hash)
+        self.entries[hash] = (self.age, value)
+        if self.shared: put(self._kind, self._shared_key(hash), value)
+
+    def record_used(self):
+        self.used = set()
+
+    def take_used(self):
+        if not self.used: return {}
+
+        entries = {hash: self.entries[hash] for hash in self.used if hash in self.entries}
+        self.used = set()
+        return entries
+
+    # Merges entries taken by take_used() in another process, which put them
+    # into the shared directory already. If `rendered` is set, the entries
+    # were newly rendered by this process instead and get put there as well.
+    def merge(self, entries, rendered=False):
+        self.entries.update(entries)
+        if self.shared and rendered:
+            for hash, entry in entries.items():
+                put(self._kind, self._shared_key(hash), entry[1])
+
+    # Marks entries as used in this run without rendering them so they don't
+    # get pruned on save. Entries not present in the cache are ignored.
+    def mark_used(self, hashes):
+        if self.entries is None: return
+        for hash in hashes:
+            entry = self.lookup(hash)
+            if entry: self.entries[hash] = (self.age, entry[1])
@@ -0,0 +1,110 @@
+#
+#   This file is part of m.css.
+#
+#   Copyright © 2017, 2018, 2019 Vladimír Vondruš <mosra@centrum.cz>
+#
+#   Permission is hereby granted, free of charge, to any person obtaining a
+#   copy of this software and associated documentation files (the "Software"),
+#   to deal in the Software without restriction, including without limitation
+#   the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#   and/or sell copies of the Software, and to permit persons to whom the
+#   Software is furnished to do so, subject to the following conditions:
+#
+#   The above copyright notice and this permission notice shall be included
+#   in all copies or substantial portions of the Software.
+#
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#   THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#   FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#   DEALINGS IN THE SOFTWARE.
+#
+
+# Thin abstraction over the XML parser used for Doxygen XML output and tag
+# files. If lxml is available, it's used for parsing, as it's considerably
+# faster than xml.etree.ElementTree, otherwise it falls back to the builtin
+# implementation. Both produce trees with the same API for everything that
+# the consumers use (find(), findall(), iter(), attrib, text, tail...); new
+# elements should be created using makeelement() on an existing element
+# so they're of the same type as the rest of the tree.
+
+import contextlib
+import warnings
+import xml.etree.ElementTree as ET
+
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+# Catch this instead of ET.ParseError
+if lxml:
+    ParseError = (ET.ParseError, lxml.etree.ParseError)
+else:
+    ParseError = ET.ParseError
+
+backend = 'lxml' if lxml else 'etree'
+
+_lxml_parser = None
+
+# The code relies on `not element` being true for elements without children
+# in many places. That's the behavior of both backends, but lxml warns about
+# it on every such use. Code doing that is wrapped in this (or decorated with
+# it) to silence the warning just there and not in the whole process.
+@contextlib.contextmanager
+def ignore_truth_testing_warnings():
+    with warnings.catch_warnings():
+        if lxml:
+            warnings.filterwarnings('ignore', category=FutureWarning, message="Truth-testing of elements")
+        yield
+
+# Switch the backend explicitly, for example to compare the two
+def use(name):
+    global backend
+    if name == 'lxml' and not lxml:
+        raise ImportError("lxml is not installed")
+    assert name in ['lxml', 'etree']
+    backend = name
+
+def parse(file):
+    if backend == 'lxml':
+        # Comments and processing instructions would appear as elements in
+        # the tree with lxml, unlike with ElementTree. Doxygen output can also
+        # contain huge text nodes (such as code listings) that lxml refuses
+        # to parse by default.
+        global _lxml_parser
+        if not _lxml_parser:
+            _lxml_parser = lxml.etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+        return lxml.etree.parse(file, _lxml_parser)
+    return ET.parse(file)
+
+# Same as ET.iterparse(), the root element is available in the `root`
+# attribute of the returned iterator once it's exhausted. Parser options are
+# the same as in parse().
+def iterparse(file, events):
+    if backend == 'lxml':
+        return lxml.etree.iterparse(file, events=events, remove_comments=True, remove_pis=True, huge_tree=True)
+    return ET.iterparse(file, events=events)
+
+def element_tree(root):
+    if backend == 'lxml': return lxml.etree.ElementTree(root)
+    return ET.ElementTree(root)
+
+_element_classes = {}
+
+# Creates an element of a class derived from both `mixin` and the element
+# type of the current backend, for overriding some of the element API. With
+# lxml, Python attributes of such element are kept only as long as there's a
+# reference to it, so whoever creates it has to keep it alive.
+def make_custom_element(mixin, tag, attrib):
+    cls = _element_classes.get((mixin, backend))
+    if not cls:
+        cls = _element_classes[(mixin, backend)] = type(mixin.__name__, (mixin, lxml.etree.ElementBase if backend == 'lxml' else ET.Element), {})
+
+    if backend == 'lxml':
+        element = cls(attrib=attrib)
+        element.tag = tag
+        return element
+    return cls(tag, attrib)